@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-from keras.utils import np_utils
 import os
 import cv2
 import numpy as np
@@ -132,7 +131,7 @@ def label_encoder(class_set: List[str]):
         :return: エンコードされたクラス名
         """
         label_encoded = class_set.index(base_class)
-        return np_utils.to_categorical(label_encoded, len(class_set))
+        return np.eye(len(class_set), dtype="float32")[label_encoded]
     return encode
 
 
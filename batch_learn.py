@@ -5,12 +5,24 @@ from network_model import model_builder as mb
 import os
 from network_model.learner import split_learn as sl
 from keras.callbacks import TensorBoard
+from network_model.wrapper.fit_setting import FitSetting
+from network_model.wrapper.pytorch.util.distributed import launch, is_main_process
+from network_model.learner.batch_size_finder import BatchSizeFinder
+from network_model.builder.pytorch_builder import PytorchModelBuilder
+from util.runtime_config import RuntimeConfig, set_runtime_config
+from network_model.wrapper.feature_cache import FeatureCache
 
 cmd_params = sys.argv
 conf_path = cmd_params[1]
+will_resume = "--resume" in cmd_params[2:]
+procs = int(cmd_params[cmd_params.index("--procs") + 1]) if "--procs" in cmd_params[2:] else 1
+compute_threads = int(cmd_params[cmd_params.index("--threads") + 1]) if "--threads" in cmd_params[2:] else None
+will_pin_cores = "--pin-cores" in cmd_params[2:]
 conf_builder = ParamBuilder.build_from_yaml(conf_path)
 path_params = conf_builder.build_path_params()
 batch_params = conf_builder.build_batch_params()
+enqueuer_params = conf_builder.build_enqueuer_params()
+runtime_params = conf_builder.build_runtime_params()
 
 IMG_DIR = path_params.dataset_dir
 RESULT_DIR = path_params.result_dir
@@ -42,28 +54,97 @@ test_datagen = ImageDataGenerator(
 )
 
 TEMP_MODEL_PATH = None
-model_generator = mb.build_wrapper(IMG_SIZE,
-                                   channel,
-                                   MODEL_NAME
-                                   )
 
-class_list = os.listdir(os.path.join(IMG_DIR, "train"))
-class_list.sort()
-print(class_list)
-callbacks = [TensorBoard(TENSORBOARD_LOG_DIR)]
-model_learner = sl.ModelLearner(model_generator,
-                                datagen,
-                                test_datagen,
-                                class_list,
-                                callbacks=callbacks,
-                                will_save_h5=True)
 
-built_model = model_learner.train_with_validation(IMG_DIR,
-                                                  os.path.join(os.getcwd(), RESULT_DIR),
-                                                  epoch_num=epoch_num,
-                                                  batch_size=generator_batch_size,
-                                                  result_name=MODEL_RESULT_NAME,
-                                                  model_name=MODEL_RESULT_NAME,
-                                                  tmp_model_path=TEMP_MODEL_PATH,
-                                                  monitor='val_acc',
-                                                  save_weights_only=False)
+def learn():
+    model_generator = mb.build_wrapper(IMG_SIZE,
+                                       channel,
+                                       MODEL_NAME,
+                                       mixed_precision=batch_params.mixed_precision,
+                                       will_use_channels_last=batch_params.will_use_channels_last,
+                                       compile_mode=batch_params.compile_mode,
+                                       activation_checkpoint=batch_params.activation_checkpoint,
+                                       frozen_layer_depth=batch_params.frozen_layer_depth
+                                       )
+    set_runtime_config(RuntimeConfig(runtime_params.compute_threads if compute_threads is None else compute_threads,
+                                     runtime_params.interop_threads,
+                                     enqueuer_params.workers if runtime_params.decode_workers is None
+                                     else runtime_params.decode_workers,
+                                     runtime_params.decode_threads,
+                                     runtime_params.augment_threads,
+                                     runtime_params.tf_intra_threads,
+                                     runtime_params.tf_inter_threads,
+                                     will_pin_cores or runtime_params.will_pin_cores),
+                       # Pytorchのモデルの場合はTensorFlowのセッションを作らない
+                       not isinstance(model_generator, PytorchModelBuilder))
+
+    class_list = os.listdir(os.path.join(IMG_DIR, "train"))
+    class_list.sort()
+    print(class_list)
+    callbacks = [TensorBoard(TENSORBOARD_LOG_DIR)]
+    fit_setting = FitSetting(enqueuer_params.workers,
+                             enqueuer_params.use_multiprocessing,
+                             enqueuer_params.max_queue_size,
+                             enqueuer_params.autotune_steps,
+                             enqueuer_params.autotune_window,
+                             enqueuer_params.max_workers,
+                             enqueuer_params.val_workers,
+                             enqueuer_params.val_max_queue_size,
+                             enqueuer_params.preprocess_buffer_size,
+                             enqueuer_params.will_record_timing,
+                             enqueuer_params.timing_log_path,
+                             enqueuer_params.log_flush_steps,
+                             enqueuer_params.checkpoint_dir,
+                             enqueuer_params.checkpoint_every_steps,
+                             enqueuer_params.checkpoint_every_minutes,
+                             will_resume,
+                             enqueuer_params.accumulation_steps,
+                             enqueuer_params.validation_freq,
+                             enqueuer_params.validation_subset_size,
+                             enqueuer_params.eval_batch_size)
+    batch_size_finder = None
+    if batch_params.will_find_batch_size:
+        batch_size_finder = BatchSizeFinder(batch_params.memory_budget_mb,
+                                            batch_params.min_batch_size,
+                                            batch_params.max_batch_size,
+                                            batch_params.probe_steps,
+                                            process_num=procs)
+    feature_cache = None if batch_params.feature_cache_dir is None else FeatureCache(batch_params.feature_cache_dir)
+    model_learner = sl.ModelLearner(model_generator,
+                                    datagen,
+                                    test_datagen,
+                                    class_list,
+                                    callbacks=callbacks,
+                                    will_save_h5=True,
+                                    batch_size_finder=batch_size_finder,
+                                    feature_cache=feature_cache)
+    saved_conf_path = os.path.join(os.getcwd(), RESULT_DIR, MODEL_RESULT_NAME, "learn_conf.yaml")
+    if batch_size_finder is not None and will_resume and os.path.exists(saved_conf_path):
+        # 再開する場合は、中断前の学習の位置がずれないよう、計測し直さずに中断前に計測した値を使う
+        saved_batch_params = ParamBuilder.build_from_yaml(saved_conf_path).build_batch_params()
+        if saved_batch_params.will_find_batch_size is False:
+            model_learner.set_found_batch_size(saved_batch_params.batch_size)
+
+    def write_found_batch_size(batch_size: int):
+        # 学習が中断しても計測した値が残るよう、計測した直後に設定を保存する
+        if is_main_process() is False:
+            return
+        os.makedirs(os.path.dirname(saved_conf_path), exist_ok=True)
+        conf_builder.set_batch_size(batch_size)
+        conf_builder.write_yaml(saved_conf_path)
+    model_learner.set_batch_size_listener(write_found_batch_size)
+
+    built_model = model_learner.train_with_validation(IMG_DIR,
+                                                      os.path.join(os.getcwd(), RESULT_DIR),
+                                                      epoch_num=epoch_num,
+                                                      batch_size=generator_batch_size,
+                                                      result_name=MODEL_RESULT_NAME,
+                                                      model_name=MODEL_RESULT_NAME,
+                                                      tmp_model_path=TEMP_MODEL_PATH,
+                                                      monitor='val_acc',
+                                                      save_weights_only=False,
+                                                      fit_setting=fit_setting)
+
+
+if __name__ == "__main__":
+    launch(procs, learn)
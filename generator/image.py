@@ -1,5 +1,6 @@
 from keras.preprocessing.image import ImageDataGenerator
 from generator.module.directory import DirectoryIteratorWithPreprocess
+from generator.zca import ZCAWhitening
 from typing import Callable, Optional
 import numpy as np
 
@@ -30,13 +31,14 @@ class ImageDataGeneratorWithPreprocess(ImageDataGenerator):
                  preprocessing_function=None,
                  data_format=None,
                  validation_split=0.0,
-                 dtype=None):
+                 dtype=None,
+                 zca_engine: Optional[ZCAWhitening] = None):
 
         super().__init__(featurewise_center,
                          samplewise_center,
                          featurewise_std_normalization,
                          samplewise_std_normalization,
-                         zca_whitening,
+                         zca_whitening and zca_engine is None,
                          zca_epsilon,
                          rotation_range,
                          width_shift_range,
@@ -57,6 +59,23 @@ class ImageDataGeneratorWithPreprocess(ImageDataGenerator):
 
         self.__x_preprocess = x_preprocess
         self.__y_preprocess = y_preprocess
+        self.__zca_engine = zca_engine
+
+    @property
+    def zca_engine(self):
+        return self.__zca_engine
+
+    def set_zca_engine(self, zca_engine: Optional[ZCAWhitening]):
+        """
+        kerasのzca_whiteningを無効にして、事前に推定した白色化をflow_from_directoryのバッチに適用する
+        :param zca_engine: 事前に推定したZCA白色化
+        :return:
+        """
+        self.__zca_engine = zca_engine
+        if zca_engine is not None:
+            self.zca_whitening = False
+            self.principal_components = None
+        return self
 
     def flow_from_directory(self,
                             directory,
@@ -90,4 +109,5 @@ class ImageDataGeneratorWithPreprocess(ImageDataGenerator):
                                                subset=subset,
                                                interpolation=interpolation,
                                                x_preprocess=self.__x_preprocess,
-                                               y_preprocess=self.__y_preprocess)
+                                               y_preprocess=self.__y_preprocess,
+                                               zca_engine=self.__zca_engine)
@@ -1,6 +1,7 @@
 from keras_preprocessing.image.directory_iterator import DirectoryIterator
 from typing import Callable, Optional
 import numpy as np
+from generator.zca import ZCAWhitening
 
 
 class DirectoryIteratorWithPreprocess(DirectoryIterator):
@@ -24,7 +25,9 @@ class DirectoryIteratorWithPreprocess(DirectoryIterator):
                  interpolation='nearest',
                  dtype='float32',
                  x_preprocess: Optional[Callable[[np.ndarray], np.ndarray]] = None,
-                 y_preprocess: Optional[Callable[[np.ndarray], np.ndarray]] = None):
+                 y_preprocess: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+                 zca_engine: Optional[ZCAWhitening] = None):
+        self.__zca_engine = zca_engine
         super().__init__(directory,
                          image_data_generator,
                          target_size,
@@ -53,6 +56,18 @@ class DirectoryIteratorWithPreprocess(DirectoryIterator):
     def y_preprocess(self):
         return self.__y_preprocess
 
+    @property
+    def zca_engine(self):
+        return self.__zca_engine
+
+    def _get_batches_of_transformed_samples(self, index_array):
+        base_params = super()._get_batches_of_transformed_samples(index_array)
+        if self.zca_engine is None:
+            return base_params
+        if not isinstance(base_params, tuple):
+            return self.zca_engine.transform(base_params)
+        return (self.zca_engine.transform(base_params[0]),) + tuple(base_params[1:])
+
     def next(self):
         base_params = super().next()
         batch_x = base_params[0] if self.x_preprocess is None else self.x_preprocess(base_params[0])
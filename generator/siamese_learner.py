@@ -1,49 +1,85 @@
 import numpy as np
 from generator.transpose import transpose
 from typing import Optional
+from util_types.input_pair import SiameseIndexedInput
 
 
 def build_batch_for_siameselearner(data_batch, teachers, margin=1, build_set_num=1):
     return build_other_teacher_and_labels(data_batch, teachers, margin, build_set_num)
 
 
+def build_pair_index(data_num: int, build_set_num: int = 1) -> np.ndarray:
+    """
+    バッチ内で組にするデータのインデックスを作る 1行目は元の並び、2行目はセットごとに並べ替えた並び
+    :param data_num: バッチのデータ数
+    :param build_set_num: 並べ替えを作る数
+    :return: 2行data_num * build_set_num列の配列
+    """
+    base_index = np.tile(np.arange(data_num), build_set_num)
+    other_index = np.concatenate([np.random.permutation(data_num) for _ in range(build_set_num)])
+    return np.stack([base_index, other_index])
+
+
+def gather_pair(data_batch, pair_index: np.ndarray) -> np.ndarray:
+    """
+    組のインデックスでバッチからデータを集め、先頭の軸が組の2つ目になる配列にする
+    確保した配列に直接書き込むので、データを1つずつリストに入れてからコピーしない
+    """
+    data_batch = np.asarray(data_batch)
+    pair = np.empty((2, pair_index.shape[1]) + data_batch.shape[1:], dtype=data_batch.dtype)
+    np.take(data_batch, pair_index[0], axis=0, out=pair[0])
+    np.take(data_batch, pair_index[1], axis=0, out=pair[1])
+    return pair
+
+
 def build_other_batch(data_batch, teachers):
-    data_teacher_pair = [(data, teacher) for data, teacher in zip(data_batch, teachers)]
-    shuffled_dataset = np.random.permutation(data_teacher_pair)
-    other_batch = np.array([data[0] for data in shuffled_dataset])
-    other_teachers = [data[1] for data in shuffled_dataset]
-    return other_batch, other_teachers
+    other_index = np.random.permutation(len(data_batch))
+    return np.asarray(data_batch)[other_index], np.asarray(teachers)[other_index]
 
 
 def build_siamese_labels(teachers, other_teachers, margin):
-    return [build_siamese_label(base_label, other_label, margin) for (base_label, other_label)
-            in zip(teachers, other_teachers)]
+    """
+    組にしたデータの教師が同じなら1、違えば0のラベルを作る 教師がスカラーなら差がmargin未満のものを同じとみなす
+    """
+    teachers = np.asarray(teachers)
+    if teachers.ndim == 1:
+        return build_siamese_labels_for_space(teachers, other_teachers, margin)
+    is_same = teachers == np.asarray(other_teachers)
+    return np.all(is_same.reshape(len(is_same), -1), axis=1).astype("f4")
 
 
 def build_siamese_labels_for_space(teachers, other_teachers, margin):
-    return [build_siamese_label_for_space(base_label, other_label, margin) for (base_label, other_label)
-            in zip(teachers, other_teachers)]
+    return (np.abs(np.asarray(teachers) - np.asarray(other_teachers)) < margin).astype("f4")
+
+
+def build_siamese_labels_for_space_from_index(teachers, pair_index: np.ndarray, margin=1) -> np.ndarray:
+    teachers = np.asarray(teachers)
+    return build_siamese_labels_for_space(teachers[pair_index[0]], teachers[pair_index[1]], margin)
+
+
+def build_siamese_labels_from_index(teachers, pair_index: np.ndarray, margin=1) -> np.ndarray:
+    teachers = np.asarray(teachers)
+    return build_siamese_labels(teachers[pair_index[0]], teachers[pair_index[1]], margin)
 
 
 def build_other_teacher_and_label(data_batch, teachers, margin=1):
-    other_batch, other_teachers = build_other_batch(data_batch, teachers)
-    shame_labels = build_siamese_labels(data_batch, teachers, margin)
-    return data_batch, other_batch, shame_labels
+    pair_index = build_pair_index(len(data_batch))
+    pair = gather_pair(data_batch, pair_index)
+    return pair[0], pair[1], build_siamese_labels_from_index(teachers, pair_index, margin)
+
+
+def build_pair_batch(data_batch, teachers, margin=1, build_set_num=1):
+    """
+    build_set_num回並べ替えた組をまとめて作る
+    :return: 先頭の軸が組の2つ目になる配列とラベル
+    """
+    pair_index = build_pair_index(len(data_batch), build_set_num)
+    return gather_pair(data_batch, pair_index), build_siamese_labels_from_index(teachers, pair_index, margin)
 
 
 def build_other_teacher_and_labels(data_batch, teachers, margin=1, build_set_num=1):
-    use_data_batch = []
-    use_other_batch = []
-    use_labels = []
-    for _ in range(build_set_num):
-        built_batch, built_other, built_labels = build_other_teacher_and_label(data_batch, teachers, margin)
-        for data in built_batch:
-            use_data_batch.append(data)
-        for data in built_other:
-            use_other_batch.append(data)
-        for label in built_labels:
-            use_labels.append(label)
-    return [np.array(use_data_batch), np.array(use_other_batch)], np.array(use_labels, dtype="f4")
+    pair, labels = build_pair_batch(data_batch, teachers, margin, build_set_num)
+    return [pair[0], pair[1]], labels
 
 
 def build_siamese_label_for_space(base_label, other_label, margin=1):
@@ -51,12 +87,9 @@ def build_siamese_label_for_space(base_label, other_label, margin=1):
 
 
 def build_siamese_label(base_label, other_label, margin=1):
-    if type(base_label) is np.float32:
+    if np.ndim(base_label) == 0:
         return build_siamese_label_for_space(base_label, other_label, margin)
-    for base_index, other_index in zip(base_label, other_label):
-        if base_index != other_index:
-            return 0
-    return 1
+    return 1 if np.array_equal(base_label, other_label) else 0
 
 
 def build_batchbuilder_for_siamese(will_transpose: bool,
@@ -71,13 +104,12 @@ def build_batchbuilder_for_siamese(will_transpose: bool,
         return build_batch_for_siameselearner(use_batch, teachers, use_margin, build_set_num)
 
     def transpose_builder_with_convert_numpy(data_batch, teachers, will_use_aux: bool = False):
-        batch, teachers = transpose_builder(data_batch, teachers)
-        return np.array(batch), teachers
+        use_margin = aux_margin if will_use_aux else margin
+        return build_pair_batch(transpose(data_batch), teachers, use_margin, build_set_num)
 
     def build_batch_for_siameselearner_with_convert_numpy(data_batch, teachers, will_use_aux: bool = False):
         use_margin = aux_margin if will_use_aux else margin
-        batch, teachers = build_batch_for_siameselearner(data_batch, teachers, use_margin, build_set_num)
-        return np.array(batch), teachers
+        return build_pair_batch(data_batch, teachers, use_margin, build_set_num)
 
     if convert_numpy:
         return transpose_builder_with_convert_numpy if will_transpose else build_batch_for_siameselearner_with_convert_numpy
@@ -91,9 +123,21 @@ class SiameseLearnerDataBuilder(object):
                  convert_numpy: bool,
                  build_set_num: int,
                  margin: int,
-                 aux_margin: Optional[int] = None):
+                 aux_margin: Optional[int] = None,
+                 will_embed_once: bool = False):
+        """
+
+        :param will_transpose: Trueならバッチをchannels_firstに転置する
+        :param convert_numpy: Trueなら組にした入力を1つのnumpyの配列にする
+        :param build_set_num: 1つのバッチから作る組の数の倍率
+        :param margin: 教師がスカラーの場合に同じとみなす差
+        :param aux_margin: 補助出力の教師で同じとみなす差 指定しなければmarginと同じ
+        :param will_embed_once: Trueならバッチと組のインデックスをSiameseIndexedInputで返し、
+                                モデルではバッチを1度だけ埋め込んで組を作る
+        """
 
         self.__will_transpose = will_transpose
+        self.__will_embed_once = will_embed_once
         self.__build_set_num = build_set_num
         self.__margin = margin
         self.__aux_margin = margin if aux_margin is None else aux_margin
@@ -119,5 +163,17 @@ class SiameseLearnerDataBuilder(object):
     def build_set_num(self):
         return self.__build_set_num
 
+    @property
+    def will_embed_once(self):
+        return self.__will_embed_once
+
+    def build_indexed_batch(self, data_batch):
+        use_batch = transpose(data_batch) if self.will_transpose else np.asarray(data_batch)
+        return SiameseIndexedInput(use_batch, build_pair_index(len(use_batch), self.build_set_num))
+
     def __call__(self, data_batch, teachers, will_use_aux: bool = False):
+        if self.__will_embed_once:
+            indexed_batch = self.build_indexed_batch(data_batch)
+            use_margin = self.aux_margin if will_use_aux else self.margin
+            return indexed_batch, build_siamese_labels_from_index(teachers, indexed_batch.pair_index, use_margin)
         return self.__data_builder(data_batch, teachers, will_use_aux)
@@ -1,4 +1,5 @@
-from generator.siamese_learner import SiameseLearnerDataBuilder,  build_other_batch, build_siamese_labels_for_space
+from generator.siamese_learner import SiameseLearnerDataBuilder, build_pair_index, gather_pair
+from generator.siamese_learner import build_siamese_labels_for_space_from_index
 import numpy as np
 from generator.transpose import transpose
 from abc import ABC, abstractmethod
@@ -39,27 +40,33 @@ class SiameseLearnerDataBuilderForInceptionV3(SiameseLearnerDataBuilder):
                  build_set_num: int,
                  margin: int,
                  teacher_preprocessor: TeacherPreprocessor,
-                 aux_margin: Optional[int] = None):
+                 aux_margin: Optional[int] = None,
+                 will_embed_once: bool = False):
         super(SiameseLearnerDataBuilderForInceptionV3, self).__init__(will_transpose,
                                                                       convert_numpy,
                                                                       build_set_num,
                                                                       margin,
-                                                                      aux_margin)
+                                                                      aux_margin,
+                                                                      will_embed_once)
         self.__teacher_preprocessor = teacher_preprocessor
 
+    def build_label_pair(self, teachers, pair_index: np.ndarray) -> np.ndarray:
+        """
+        主出力と補助出力の教師それぞれで組のラベルを作り、確保した2行の配列に書き込む
+        """
+        main_teacher, aux_teacher = self.build_teachers_for_train(teachers)
+        siamese_label_pair = np.empty((2, pair_index.shape[1]), dtype="f4")
+        siamese_label_pair[0] = build_siamese_labels_for_space_from_index(main_teacher, pair_index, self.margin)
+        siamese_label_pair[1] = build_siamese_labels_for_space_from_index(aux_teacher, pair_index, self.aux_margin)
+        return siamese_label_pair
+
     def __call__(self, data_batch, teachers, will_use_aux: bool = False):
+        if self.will_embed_once:
+            indexed_batch = self.build_indexed_batch(data_batch)
+            return indexed_batch, self.build_label_pair(teachers, indexed_batch.pair_index)
         use_batch = transpose(data_batch) if self.will_transpose else data_batch
-        converted_teacher = self.__teacher_preprocessor.run_preprpocess(teachers)
-        other_batch, other_teachers = build_other_batch(use_batch, converted_teacher)
-        main_base_teacher = [labels[0] for labels in converted_teacher]
-        main_other_teacher = [labels[0] for labels in other_teachers]
-        main_siamese_label = build_siamese_labels_for_space(main_base_teacher, main_other_teacher, self.margin)
-        aux_base_teacher = [labels[1] for labels in converted_teacher]
-        aux_other_teacher = [labels[1] for labels in other_teachers]
-        aux_siamese_label = build_siamese_labels_for_space(aux_base_teacher, aux_other_teacher, self.aux_margin)
-        batch_pair = [np.array(use_batch), np.array(other_batch)]
-        siamese_label_pair = [main_siamese_label, aux_siamese_label]
-        return np.array(batch_pair), np.array(siamese_label_pair, dtype="f4")
+        pair_index = build_pair_index(len(use_batch))
+        return gather_pair(use_batch, pair_index), self.build_label_pair(teachers, pair_index)
 
     def preprocess_evaluate_original(self, x, y):
         return x, self.__teacher_preprocessor.build_main_teacher(y)
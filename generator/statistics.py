@@ -0,0 +1,189 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from typing import Optional
+from typing import Tuple
+import numpy as np
+from keras.utils import Sequence
+from DataIO.data_loader import NormalizeType
+from DataIO.data_loader import load_dataset_path
+from network_model.generator import DataLoaderFromPaths
+
+Moments = Tuple[int, np.ndarray, np.ndarray]
+
+
+def build_dataset_fingerprint(data_paths: List[str], *extra_params) -> str:
+    """
+    データセットを一意に識別するためのハッシュ値を算出する
+    ファイルのパス、サイズ、更新日時と読み込み設定から作るのでデータが差し替えられた場合は別の値になる
+    :param data_paths: データセットのパスのリスト
+    :param extra_params: リサイズ後のサイズなど読み込み結果に影響する設定
+    :return: ハッシュ値の文字列
+    """
+    hasher = hashlib.sha1()
+    for data_path in sorted(data_paths):
+        stat = os.stat(data_path)
+        hasher.update(str(data_path).encode("utf-8"))
+        hasher.update(str(stat.st_size).encode("utf-8"))
+        hasher.update(str(stat.st_mtime_ns).encode("utf-8"))
+    for param in extra_params:
+        hasher.update(repr(param).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def build_loader_fingerprint(data_loader: DataLoaderFromPaths) -> str:
+    normalize_type = data_loader.normalize_type
+    return build_dataset_fingerprint(list(data_loader.data_paths),
+                                     data_loader.img_resize_val,
+                                     data_loader.color,
+                                     normalize_type.value if isinstance(normalize_type, NormalizeType) else normalize_type)
+
+
+def calc_batch_moments(batch: np.ndarray) -> Moments:
+    """
+    1バッチ分のチャンネルごとのデータ数、平均、偏差平方和を算出する
+    :param batch: (batch, row, col, channel)もしくは白黒画像の(batch, row, col)の配列
+    :return: データ数、平均、偏差平方和のタプル
+    """
+    channel_num = batch.shape[-1] if batch.ndim == 4 else 1
+    flatten = np.asarray(batch, dtype=np.float64).reshape(-1, channel_num)
+    mean = flatten.mean(axis=0)
+    m2 = np.square(flatten - mean).sum(axis=0)
+    return flatten.shape[0], mean, m2
+
+
+def merge_moments(left: Moments, right: Moments) -> Moments:
+    """
+    Chanらの並列版Welfordの手法で2つの集計結果をまとめる
+    """
+    left_count, left_mean, left_m2 = left
+    right_count, right_mean, right_m2 = right
+    if left_count == 0:
+        return right
+    if right_count == 0:
+        return left
+    count = left_count + right_count
+    delta = right_mean - left_mean
+    mean = left_mean + delta * right_count / count
+    m2 = left_m2 + right_m2 + np.square(delta) * left_count * right_count / count
+    return count, mean, m2
+
+
+class FeaturewiseStatistics(object):
+    """
+    ImageDataGeneratorのfeaturewise_center, featurewise_std_normalizationで使う統計量
+    データセット全体をメモリに乗せずにバッチ単位で集計する
+    """
+
+    @staticmethod
+    def build_from_sequence(sequence: Sequence,
+                            workers: Optional[int] = None,
+                            cache_dir: Optional[str] = None,
+                            fingerprint: Optional[str] = None):
+        """
+        Sequenceが返すバッチから統計量を算出する
+        :param sequence: (x, y)を返すSequence DataLoaderFromPathsの場合はパスからキャッシュのキーを作る
+        :param workers: 並列で読み込むスレッド数 デフォルトではCPUのコア数
+        :param cache_dir: 算出結果を保存するディレクトリ 指定しなければ保存しない
+        :param fingerprint: キャッシュのキー 指定しなければDataLoaderFromPathsの場合のみ自動で作成する
+        :return: 算出した統計量
+        """
+        use_fingerprint = fingerprint
+        if use_fingerprint is None and isinstance(sequence, DataLoaderFromPaths):
+            use_fingerprint = build_loader_fingerprint(sequence)
+        cache_path = None
+        if cache_dir is not None and use_fingerprint is not None:
+            cache_path = os.path.join(cache_dir, "featurewise_" + use_fingerprint + ".npz")
+            if os.path.exists(cache_path):
+                print("load featurewise statistics", cache_path)
+                return FeaturewiseStatistics.load(cache_path)
+        use_workers = os.cpu_count() if workers is None else workers
+
+        def calc_moments(index: int) -> Moments:
+            return calc_batch_moments(sequence[index][0])
+
+        moments = (0, None, None)
+        with ThreadPoolExecutor(max_workers=use_workers) as executor:
+            for batch_moments in executor.map(calc_moments, range(len(sequence))):
+                moments = merge_moments(moments, batch_moments)
+        count, mean, m2 = moments
+        statistics = FeaturewiseStatistics(mean, np.sqrt(m2 / count), count)
+        if cache_path is not None:
+            statistics.save(cache_path)
+        return statistics
+
+    @staticmethod
+    def build_from_directory(root_dir: str,
+                             img_resize_val=None,
+                             color: str = "RGB",
+                             normalize_type: NormalizeType = NormalizeType.NotNormalize,
+                             batch_size: int = 32,
+                             workers: Optional[int] = None,
+                             cache_dir: Optional[str] = None):
+        """
+        クラスごとにディレクトリ分けされた画像データから統計量を算出する
+        :param root_dir: 画像データの格納されているルートディレクトリ
+        :param img_resize_val: 画像のサイズをリサイズする際のサイズ　指定しなければオリジナルのサイズのまま読み込み
+        :param color: カラー RGB以外なら白黒扱い
+        :param normalize_type: データ正規化のタイプ 学習時のジェネレータに渡すデータと揃える
+        :param batch_size: 一度に読み込むデータ数 メモリ使用量はおよそこの値とworkersの積に比例する
+        :param workers: 並列で読み込むスレッド数 デフォルトではCPUのコア数
+        :param cache_dir: 算出結果を保存するディレクトリ 指定しなければ保存しない
+        :return: 算出した統計量
+        """
+        path_set, label_set, class_names, class_num = load_dataset_path(root_dir)
+        data_loader = DataLoaderFromPaths(path_set,
+                                          label_set,
+                                          class_num,
+                                          batch_size,
+                                          img_resize_val,
+                                          color,
+                                          normalize_type)
+        return FeaturewiseStatistics.build_from_sequence(data_loader, workers, cache_dir)
+
+    @staticmethod
+    def load(file_path: str):
+        loaded = np.load(file_path)
+        return FeaturewiseStatistics(loaded["mean"], loaded["std"], int(loaded["count"]))
+
+    def __init__(self, mean: np.ndarray, std: np.ndarray, count: int):
+        """
+        :param mean: チャンネルごとの平均
+        :param std: チャンネルごとの標準偏差
+        :param count: 集計したピクセル数
+        """
+        self.__mean = mean
+        self.__std = std
+        self.__count = count
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.__mean
+
+    @property
+    def std(self) -> np.ndarray:
+        return self.__std
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    def save(self, file_path: str):
+        dir_path = os.path.dirname(file_path)
+        if dir_path != "" and os.path.exists(dir_path) is False:
+            os.makedirs(dir_path)
+        np.savez(file_path, mean=self.mean, std=self.std, count=self.count)
+
+    def apply(self, image_generator):
+        """
+        fitを呼び出さずにジェネレータへ統計量を設定する
+        :param image_generator: 設定対象のImageDataGenerator
+        :return: 統計量を設定したジェネレータ
+        """
+        broadcast_shape = [1, 1, 1]
+        broadcast_shape[image_generator.channel_axis - 1] = len(self.mean)
+        dtype = getattr(image_generator, "dtype", None) or np.float32
+        image_generator.mean = np.reshape(self.mean, broadcast_shape).astype(dtype)
+        image_generator.std = np.reshape(self.std, broadcast_shape).astype(dtype)
+        return image_generator
@@ -0,0 +1,249 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import Optional
+from typing import Tuple
+import numpy as np
+from keras.utils import Sequence
+from DataIO.data_loader import NormalizeType
+from DataIO.data_loader import load_dataset_path
+from network_model.generator import DataLoaderFromPaths
+from generator.statistics import build_loader_fingerprint
+
+
+def flatten_batch(batch: np.ndarray) -> np.ndarray:
+    return np.asarray(batch, dtype=np.float64).reshape(batch.shape[0], -1)
+
+
+class ZCAWhitening(object):
+    """
+    ランダム化SVDによるZCA白色化
+    (H*W*C)^2の共分散行列を作らずに、データセットを数回走査して上位の主成分だけを求める
+    上位以外の成分は残りの分散の平均で一様にスケールする
+    """
+
+    @staticmethod
+    def build_from_sequence(sequence: Sequence,
+                            component_num: int = 256,
+                            oversampling: int = 16,
+                            power_iteration_num: int = 1,
+                            epsilon: float = 1e-6,
+                            workers: Optional[int] = None,
+                            cache_dir: Optional[str] = None,
+                            fingerprint: Optional[str] = None,
+                            seed: int = 0):
+        """
+        Sequenceが返すバッチから白色化行列を推定する
+        :param sequence: (x, y)を返すSequence DataLoaderFromPathsの場合はパスからキャッシュのキーを作る
+        :param component_num: 求める主成分の数
+        :param oversampling: ランダム化SVDで余分に取る次元数
+        :param power_iteration_num: 精度を上げるためのべき乗反復の回数 1回ごとにデータセットを1回走査する
+        :param epsilon: keras.ImageDataGeneratorのzca_epsilonと同じ
+        :param workers: 並列で読み込むスレッド数 デフォルトではCPUのコア数
+        :param cache_dir: 算出結果を保存するディレクトリ 指定しなければ保存しない
+        :param fingerprint: キャッシュのキー 指定しなければDataLoaderFromPathsの場合のみ自動で作成する
+        :param seed: ランダム行列の乱数シード
+        :return: 推定した白色化
+        """
+        data_shape = tuple(np.asarray(sequence[0][0]).shape[1:])
+        feature_num = int(np.prod(data_shape))
+        use_component_num = min(component_num, feature_num)
+        use_fingerprint = fingerprint
+        if use_fingerprint is None and isinstance(sequence, DataLoaderFromPaths):
+            use_fingerprint = build_loader_fingerprint(sequence)
+        cache_path = None
+        if cache_dir is not None and use_fingerprint is not None:
+            file_name = "zca_{}_{}_{}_{}_{}_{}_{}.npz".format(use_fingerprint,
+                                                              "x".join([str(size) for size in data_shape]),
+                                                              use_component_num,
+                                                              epsilon,
+                                                              oversampling,
+                                                              power_iteration_num,
+                                                              seed)
+            cache_path = os.path.join(cache_dir, file_name)
+            if os.path.exists(cache_path):
+                print("load zca whitening", cache_path)
+                return ZCAWhitening.load(cache_path)
+        use_workers = os.cpu_count() if workers is None else workers
+
+        def calc_loaded_batch(calc_batch: Callable[[np.ndarray], Tuple], index: int):
+            return calc_batch(flatten_batch(sequence[index][0]))
+
+        def reduce_batches(calc_batch: Callable[[np.ndarray], Tuple]):
+            # バッチごとの結果は(H*W*C, 主成分数)の行列になり得るので、取り出していない結果をワーカー数までに抑える
+            totals = None
+            with ThreadPoolExecutor(max_workers=use_workers) as executor:
+                futures = deque()
+                for index in range(len(sequence) + use_workers):
+                    if index < len(sequence):
+                        futures.append(executor.submit(calc_loaded_batch, calc_batch, index))
+                    if len(futures) == 0 or (len(futures) < use_workers and index < len(sequence)):
+                        continue
+                    result = futures.popleft().result()
+                    totals = result if totals is None else tuple(total + param for total, param
+                                                                 in zip(totals, result))
+            return totals
+
+        count, feature_sum, square_sum = reduce_batches(lambda flat: (flat.shape[0],
+                                                                      flat.sum(axis=0),
+                                                                      np.square(flat).sum(axis=0)))
+        mean = feature_sum / count
+        total_variance = float(np.maximum(square_sum / count - np.square(mean), 0).sum())
+
+        def multiply_covariance(basis: np.ndarray) -> np.ndarray:
+            def calc_batch(flat: np.ndarray):
+                centered = flat - mean
+                return (centered.T @ (centered @ basis),)
+            return reduce_batches(calc_batch)[0] / count
+
+        sample_num = min(use_component_num + oversampling, feature_num)
+        random_state = np.random.RandomState(seed)
+        basis, _ = np.linalg.qr(multiply_covariance(random_state.standard_normal((feature_num, sample_num))))
+        for _ in range(power_iteration_num):
+            basis, _ = np.linalg.qr(multiply_covariance(basis))
+
+        def project_batch(flat: np.ndarray):
+            projected = (flat - mean) @ basis
+            return (projected.T @ projected,)
+
+        small_covariance = reduce_batches(project_batch)[0] / count
+        eigen_values, eigen_vectors = np.linalg.eigh(small_covariance)
+        order = np.argsort(eigen_values)[::-1][:use_component_num]
+        eigen_values = np.maximum(eigen_values[order], 0)
+        components = basis @ eigen_vectors[:, order]
+        rest_num = feature_num - use_component_num
+        rest_variance = max(total_variance - float(eigen_values.sum()), 0) / rest_num if rest_num > 0 else 0.
+        whitening = ZCAWhitening(mean,
+                                 components,
+                                 1 / np.sqrt(eigen_values + epsilon),
+                                 1 / np.sqrt(rest_variance + epsilon),
+                                 data_shape)
+        if cache_path is not None:
+            whitening.save(cache_path)
+        return whitening
+
+    @staticmethod
+    def build_from_directory(root_dir: str,
+                             img_resize_val=None,
+                             color: str = "RGB",
+                             normalize_type: NormalizeType = NormalizeType.Div255,
+                             batch_size: int = 32,
+                             component_num: int = 256,
+                             oversampling: int = 16,
+                             power_iteration_num: int = 1,
+                             epsilon: float = 1e-6,
+                             workers: Optional[int] = None,
+                             cache_dir: Optional[str] = None):
+        """
+        クラスごとにディレクトリ分けされた画像データから白色化行列を推定する
+        :param root_dir: 画像データの格納されているルートディレクトリ
+        :param img_resize_val: 画像のサイズをリサイズする際のサイズ 学習時の入力サイズと揃える
+        :param color: カラー RGB以外なら白黒扱い
+        :param normalize_type: データ正規化のタイプ 学習時のジェネレータのrescaleと揃える
+        :param batch_size: 一度に読み込むデータ数
+        :param component_num: 求める主成分の数
+        :param oversampling: ランダム化SVDで余分に取る次元数
+        :param power_iteration_num: 精度を上げるためのべき乗反復の回数
+        :param epsilon: keras.ImageDataGeneratorのzca_epsilonと同じ
+        :param workers: 並列で読み込むスレッド数 デフォルトではCPUのコア数
+        :param cache_dir: 算出結果を保存するディレクトリ 指定しなければ保存しない
+        :return: 推定した白色化
+        """
+        path_set, label_set, class_names, class_num = load_dataset_path(root_dir)
+        data_loader = DataLoaderFromPaths(path_set,
+                                          label_set,
+                                          class_num,
+                                          batch_size,
+                                          img_resize_val,
+                                          color,
+                                          normalize_type)
+        return ZCAWhitening.build_from_sequence(data_loader,
+                                                component_num,
+                                                oversampling,
+                                                power_iteration_num,
+                                                epsilon,
+                                                workers,
+                                                cache_dir)
+
+    @staticmethod
+    def load(file_path: str):
+        loaded = np.load(file_path)
+        return ZCAWhitening(loaded["mean"],
+                            loaded["components"],
+                            loaded["scales"],
+                            float(loaded["rest_scale"]),
+                            tuple(loaded["data_shape"]))
+
+    def __init__(self,
+                 mean: np.ndarray,
+                 components: np.ndarray,
+                 scales: np.ndarray,
+                 rest_scale: float,
+                 data_shape: Tuple[int, ...],
+                 dense_max_feature_num: int = 4096):
+        """
+        :param mean: 各画素の平均
+        :param components: 上位の主成分 (H*W*C, component_num)
+        :param scales: 各主成分にかける係数 1/sqrt(固有値+epsilon)
+        :param rest_scale: 上位以外の成分にかける係数
+        :param data_shape: 1データの形状
+        :param dense_max_feature_num: 1データの要素数がこれ以下なら白色化行列を展開して1回の行列積で変換する
+        """
+        self.__mean = mean.astype(np.float32)
+        self.__components = components.astype(np.float32)
+        self.__scales = scales.astype(np.float32)
+        self.__rest_scale = rest_scale
+        self.__data_shape = data_shape
+        self.__matrix = None
+        if len(mean) <= dense_max_feature_num:
+            scaled = self.__components * (self.__scales - self.__rest_scale)
+            self.__matrix = scaled @ self.__components.T + np.eye(len(mean), dtype=np.float32) * self.__rest_scale
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.__mean
+
+    @property
+    def components(self) -> np.ndarray:
+        return self.__components
+
+    @property
+    def scales(self) -> np.ndarray:
+        return self.__scales
+
+    @property
+    def rest_scale(self) -> float:
+        return self.__rest_scale
+
+    @property
+    def data_shape(self) -> Tuple[int, ...]:
+        return self.__data_shape
+
+    def save(self, file_path: str):
+        dir_path = os.path.dirname(file_path)
+        if dir_path != "" and os.path.exists(dir_path) is False:
+            os.makedirs(dir_path)
+        np.savez(file_path,
+                 mean=self.mean,
+                 components=self.components,
+                 scales=self.scales,
+                 rest_scale=self.rest_scale,
+                 data_shape=np.array(self.data_shape))
+
+    def transform(self, batch: np.ndarray) -> np.ndarray:
+        """
+        バッチ全体をまとめて白色化する
+        :param batch: (batch, row, col, channel)の配列
+        :return: 白色化したバッチ
+        """
+        centered = np.asarray(batch, dtype=np.float32).reshape(batch.shape[0], -1) - self.mean
+        if self.__matrix is not None:
+            whitened = centered @ self.__matrix
+        else:
+            projected = (centered @ self.components) * (self.scales - self.rest_scale)
+            whitened = projected @ self.components.T + centered * self.rest_scale
+        return whitened.reshape(batch.shape)
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        return self.transform(batch)
@@ -42,6 +42,169 @@ class BatchParams(object):
     def bagging_choice_rate(self):
         return self.__params["bagging_choice_rate"]
 
+    @property
+    def mixed_precision(self):
+        return self.__params.get("mixed_precision", None)
+
+    @property
+    def will_use_channels_last(self):
+        return self.__params.get("channels_last", False)
+
+    @property
+    def compile_mode(self):
+        # torch.compileを使うのでtorch 2.0以降が必要 それより前のtorchでは指定してもeagerで実行する
+        return self.__params.get("compile_mode", None)
+
+    @property
+    def activation_checkpoint(self):
+        return self.__params.get("activation_checkpoint", None)
+
+    @property
+    def frozen_layer_depth(self):
+        return self.__params.get("frozen_layer_depth", 0)
+
+    @property
+    def feature_cache_dir(self):
+        return self.__params.get("feature_cache_dir", None)
+
+    @property
+    def will_find_batch_size(self):
+        return self.__params.get("find_batch_size", False)
+
+    @property
+    def memory_budget_mb(self):
+        return self.__params.get("memory_budget_mb", None)
+
+    @property
+    def min_batch_size(self):
+        return self.__params.get("min_batch_size", 2)
+
+    @property
+    def max_batch_size(self):
+        return self.__params.get("max_batch_size", 256)
+
+    @property
+    def probe_steps(self):
+        return self.__params.get("probe_steps", 3)
+
+
+class EnqueuerParams(object):
+    def __init__(self, raw_params):
+        self.__params = raw_params
+
+    @property
+    def workers(self):
+        return self.__params.get("workers", 1)
+
+    @property
+    def use_multiprocessing(self):
+        return self.__params.get("use_multiprocessing", False)
+
+    @property
+    def max_queue_size(self):
+        return self.__params.get("max_queue_size", 10)
+
+    @property
+    def autotune_steps(self):
+        return self.__params.get("autotune_steps", 0)
+
+    @property
+    def autotune_window(self):
+        return self.__params.get("autotune_window", 20)
+
+    @property
+    def max_workers(self):
+        return self.__params.get("max_workers", None)
+
+    @property
+    def val_workers(self):
+        return self.__params.get("val_workers", 1)
+
+    @property
+    def val_max_queue_size(self):
+        return self.__params.get("val_max_queue_size", 10)
+
+    @property
+    def preprocess_buffer_size(self):
+        return self.__params.get("preprocess_buffer_size", 1)
+
+    @property
+    def will_record_timing(self):
+        return self.__params.get("will_record_timing", False)
+
+    @property
+    def timing_log_path(self):
+        return self.__params.get("timing_log_path", None)
+
+    @property
+    def log_flush_steps(self):
+        return self.__params.get("log_flush_steps", 10)
+
+    @property
+    def checkpoint_dir(self):
+        return self.__params.get("checkpoint_dir", None)
+
+    @property
+    def checkpoint_every_steps(self):
+        return self.__params.get("checkpoint_every_steps", 0)
+
+    @property
+    def checkpoint_every_minutes(self):
+        return self.__params.get("checkpoint_every_minutes", 0.)
+
+    @property
+    def accumulation_steps(self):
+        return self.__params.get("accumulation_steps", 1)
+
+    @property
+    def validation_freq(self):
+        return self.__params.get("validation_freq", 1)
+
+    @property
+    def validation_subset_size(self):
+        return self.__params.get("validation_subset_size", 0)
+
+    @property
+    def eval_batch_size(self):
+        return self.__params.get("eval_batch_size", None)
+
+
+class RuntimeParams(object):
+    def __init__(self, raw_params):
+        self.__params = raw_params
+
+    @property
+    def compute_threads(self):
+        return self.__params.get("compute_threads", None)
+
+    @property
+    def interop_threads(self):
+        return self.__params.get("interop_threads", None)
+
+    @property
+    def decode_workers(self):
+        return self.__params.get("decode_workers", None)
+
+    @property
+    def decode_threads(self):
+        return self.__params.get("decode_threads", 1)
+
+    @property
+    def augment_threads(self):
+        return self.__params.get("augment_threads", 1)
+
+    @property
+    def tf_intra_threads(self):
+        return self.__params.get("tf_intra_threads", None)
+
+    @property
+    def tf_inter_threads(self):
+        return self.__params.get("tf_inter_threads", None)
+
+    @property
+    def will_pin_cores(self):
+        return self.__params.get("pin_cores", False)
+
 
 class ParamBuilder(object):
 
@@ -60,3 +223,21 @@ class ParamBuilder(object):
 
     def build_batch_params(self):
         return BatchParams(self.__params["batch"])
+
+    def build_enqueuer_params(self):
+        return EnqueuerParams(self.__params.get("enqueuer", {}))
+
+    def build_runtime_params(self):
+        return RuntimeParams(self.__params.get("runtime", {}))
+
+    def set_batch_size(self, batch_size: int):
+        """
+        計測して決めたバッチサイズを設定に書き戻す 書き戻した後は自動で計測しない設定にする
+        """
+        self.__params["batch"]["batch_size"] = batch_size
+        self.__params["batch"]["find_batch_size"] = False
+        return self
+
+    def write_yaml(self, yaml_path: str):
+        with open(yaml_path, 'w', encoding='utf8') as fw:
+            yaml.dump(self.__params, fw, allow_unicode=True, default_flow_style=False)
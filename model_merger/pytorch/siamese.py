@@ -1,6 +1,20 @@
 import torch
 from torch import Tensor
-from typing import Tuple, List
+from typing import Tuple, List, Union
+from util_types.input_pair import SiameseIndexedInput
+
+
+def select_rows(outputs, index: Tensor):
+    """
+    モデルの出力からindexの行を選ぶ InceptionOutputsのような出力のタプルはそれぞれの要素から選ぶ
+    """
+    if outputs is None:
+        return None
+    if isinstance(outputs, Tensor):
+        return outputs.index_select(0, index)
+    if hasattr(outputs, "_fields"):
+        return type(outputs)(*[select_rows(output, index) for output in outputs])
+    return type(outputs)(select_rows(output, index) for output in outputs)
 
 
 class SiameseNetworkPT(torch.nn.Module):
@@ -11,12 +25,22 @@ class SiameseNetworkPT(torch.nn.Module):
 
         self.__base_model = base_model
 
-    def forward(self, inputs: List[Tensor]) -> Tuple[Tensor, Tensor]:
+    def forward(self, inputs: Union[List[Tensor], SiameseIndexedInput]) -> Tuple[Tensor, Tensor]:
+        if isinstance(inputs, SiameseIndexedInput):
+            return self.forward_indexed(inputs)
 
         output1 = self.__base_model(inputs[0])
         output2 = self.__base_model(inputs[1])
         return output1, output2
 
+    def forward_indexed(self, inputs: SiameseIndexedInput) -> Tuple[Tensor, Tensor]:
+        """
+        バッチを1度だけ埋め込み、組のインデックスで埋め込みを選んで2つの出力にする
+        組の数を増やしても順伝播するのはバッチ1回分で、選んだ埋め込みの勾配は元の埋め込みに足し合わされる
+        """
+        outputs = self.__base_model(inputs.data)
+        return select_rows(outputs, inputs.pair_index[0]), select_rows(outputs, inputs.pair_index[1])
+
     @property
     def original_model(self):
         return self.__base_model
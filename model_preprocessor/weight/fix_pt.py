@@ -0,0 +1,103 @@
+import torch
+import torch.nn
+from typing import Callable
+from typing import List
+from typing import Tuple
+from model_merger.pytorch.siamese import SiameseNetworkPT
+
+
+class FrozenBatchNorm2d(torch.nn.BatchNorm2d):
+    """
+    model.train()を呼ばれても評価モードのままで、学習済みの移動平均を更新しないBatchNorm2d
+    """
+
+    def train(self, mode: bool = True):
+        return super(FrozenBatchNorm2d, self).train(False)
+
+
+def list_named_layers(model: torch.nn.Module) -> List[Tuple[torch.nn.Module, str, torch.nn.Module]]:
+    """
+    モデルを入力側から順に、親のモジュールと親の中での名前とレイヤーの組のリストにする
+    torch.nn.Sequentialはその中身に展開する Siameseネットワークは共有しているバックボーンのレイヤーを返す
+    """
+    if isinstance(model, SiameseNetworkPT):
+        return list_named_layers(model.original_model)
+    layers = []
+    for name, child in model.named_children():
+        if type(child) is torch.nn.Sequential:
+            layers.extend(list_named_layers(child))
+        else:
+            layers.append((model, name, child))
+    return layers
+
+
+def list_layers(model: torch.nn.Module) -> List[torch.nn.Module]:
+    """
+    モデルを入力側から順にレイヤーのリストにする
+    """
+    return [layer for _, _, layer in list_named_layers(model)]
+
+
+def is_frozen(layer: torch.nn.Module) -> bool:
+    return all([param.requires_grad is False for param in layer.parameters()])
+
+
+def has_params(layer: torch.nn.Module) -> bool:
+    return next(layer.parameters(), None) is not None
+
+
+def count_frozen_layers(model: torch.nn.Module) -> int:
+    """
+    入力側から続いている固定したレイヤーの数 パラメータを持たないレイヤーは、後ろに固定したレイヤーが続く場合だけ数える
+    """
+    depth = 0
+    for index, layer in enumerate(list_layers(model)):
+        if is_frozen(layer) is False:
+            break
+        if has_params(layer):
+            depth = index + 1
+    return depth
+
+
+def disable_grad(module: torch.nn.Module, inputs):
+    module.grad_mode_before_frozen = torch.is_grad_enabled()
+    torch.set_grad_enabled(False)
+
+
+def restore_grad(module: torch.nn.Module, inputs, outputs):
+    torch.set_grad_enabled(module.grad_mode_before_frozen)
+
+
+def freeze_layer(layer: torch.nn.Module):
+    """
+    レイヤーのパラメータを更新しないようにし、BatchNormを評価モードに固定して、順伝播をno_gradで実行する
+    """
+    for param in layer.parameters():
+        param.requires_grad = False
+    for module in layer.modules():
+        if type(module) is torch.nn.BatchNorm2d:
+            module.__class__ = FrozenBatchNorm2d
+            module.eval()
+    layer.register_forward_pre_hook(disable_grad)
+    layer.register_forward_hook(restore_grad)
+
+
+def fix_layer_weight(layer_depth: int) -> Callable[[torch.nn.Module], torch.nn.Module]:
+    """
+    Pytorchのモデルの入力側からlayer_depth個のレイヤーを固定する関数を返す
+    固定したレイヤーでは計算グラフを作らないので、逆伝播とパラメータの更新は固定していないレイヤーの分だけになる
+    オプティマイザを作る前に適用し、オプティマイザには勾配を計算するパラメータだけを渡す
+    """
+    def fix_weight(target_model: torch.nn.Module):
+        layers = list_layers(target_model)
+        print("fix weight", len(layers[:layer_depth]), "of", len(layers), "layers")
+        for layer in layers[:layer_depth]:
+            freeze_layer(layer)
+        trainable_num = sum(param.numel() for param in target_model.parameters() if param.requires_grad)
+        print("trainable params", trainable_num)
+        return target_model
+    return fix_weight
+
+
+def get_trainable_params(model: torch.nn.Module) -> List[torch.nn.Parameter]:
+    return [param for param in model.parameters() if param.requires_grad]
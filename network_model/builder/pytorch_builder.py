@@ -4,6 +4,7 @@ from typing import Callable
 from typing import Tuple
 from typing import List
 from typing import Union
+from typing import Optional
 from util_types import types_of_loco
 from network_model.distillation.distillation_model_builder import DistllationModelIncubator
 from network_model.build_model import builder_pt, builder_with_merge
@@ -13,7 +14,11 @@ from torch.optim.optimizer import Optimizer
 from torch.optim import SGD
 from torch.nn.modules.loss import _Loss
 from torch.nn import CrossEntropyLoss, Module
-from network_model.wrapper.pytorch.model_pt import ModelForPytorch
+from network_model.wrapper.pytorch.model_pt import ModelForPytorch, check_autocast_available
+from network_model.wrapper.pytorch.util.model_compiler import ModelCompiler
+from network_model.wrapper.pytorch.util.activation_checkpoint import ActivationCheckpointSetting
+from network_model.wrapper.pytorch.util.activation_checkpoint import apply_activation_checkpoint
+from model_preprocessor.weight.fix_pt import fix_layer_weight, get_trainable_params
 from model_merger.pytorch.proc.distance.calculator import L1Norm
 from model_merger.pytorch.proc.distance.abs_calculator import AbstractDistanceCaluclator
 from model_merger.pytorch.proc.loss.calculator import AAEUMLoss
@@ -33,13 +38,30 @@ OptimizerBuilder = Callable[[Module], Optimizer]
 
 def optimizer_builder(optimizer, **kwargs):
     def build(base_model: Module):
-        kwargs["params"] = base_model.parameters()
+        # 固定したレイヤーのパラメータはオプティマイザに渡さない
+        kwargs["params"] = get_trainable_params(base_model)
         return optimizer(**kwargs)
     return build
 
 
 default_optimizer_builder = optimizer_builder(SGD)
 
+AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "bfloat16": torch.bfloat16}
+
+
+def build_autocast_dtype(mixed_precision: Optional[str]) -> Optional[torch.dtype]:
+    """
+    設定ファイルなどで指定した混合精度の名前をtorchの型に変換する
+    :param mixed_precision: bf16かbfloat16 Noneなら混合精度にしない
+    :return: autocastで使う型
+    """
+    if mixed_precision is None:
+        return None
+    if mixed_precision not in AUTOCAST_DTYPES:
+        raise ValueError("mixed_precision must be one of " + ", ".join(AUTOCAST_DTYPES.keys()))
+    check_autocast_available()
+    return AUTOCAST_DTYPES[mixed_precision]
+
 
 class PytorchModelBuilder(object):
 
@@ -51,7 +73,12 @@ class PytorchModelBuilder(object):
                  loss: _Loss = None,
                  decide_dataset_generator=None,
                  nearest_data_ave_num=1,
-                 will_calc_rate_real_data_train=False):
+                 will_calc_rate_real_data_train=False,
+                 mixed_precision: Optional[str] = None,
+                 will_use_channels_last: bool = False,
+                 compile_mode: Optional[str] = None,
+                 activation_checkpoint: Optional[ActivationCheckpointSetting] = None,
+                 frozen_layer_depth: int = 0):
         self.__img_size = img_size
         self.__channels = channels
         self.__model_name = model_name
@@ -60,6 +87,12 @@ class PytorchModelBuilder(object):
         self.__decide_dataset_generator = decide_dataset_generator
         self.__nearest_data_ave_num = nearest_data_ave_num
         self.__will_calc_rate_real_data_train = will_calc_rate_real_data_train
+        self.__autocast_dtype = build_autocast_dtype(mixed_precision)
+        self.__will_use_channels_last = will_use_channels_last
+        # 交差検証の分割ごとに作るモデルで同じコンパイラを使い、コンパイル結果のキャッシュを共有する
+        self.__model_compiler = None if compile_mode is None else ModelCompiler(compile_mode)
+        self.__activation_checkpoint = activation_checkpoint
+        self.__frozen_layer_depth = frozen_layer_depth
 
     def build_raw_model(self, model_builder_input) -> torch.nn.Module:
         if self.__model_name == "tempload":
@@ -67,14 +100,20 @@ class PytorchModelBuilder(object):
         return builder_pt(model_builder_input, self.__img_size, self.__model_name)
 
     def build_model_builder_wrapper(self, model_builder_input):
-        base_model = self.build_raw_model(model_builder_input)
+        base_model = apply_activation_checkpoint(self.build_raw_model(model_builder_input),
+                                                 self.__activation_checkpoint)
+        if self.__frozen_layer_depth > 0:
+            base_model = fix_layer_weight(self.__frozen_layer_depth)(base_model)
         optimizer = self.__opt_builder(base_model)
         return ModelForPytorch.build_wrapper(base_model,
                                              optimizer,
                                              self.__loss,
                                              decide_dataset_generator=self.__decide_dataset_generator,
                                              nearest_data_ave_num=self.__nearest_data_ave_num,
-                                             will_calc_rate_real_data_train=self.__will_calc_rate_real_data_train)
+                                             will_calc_rate_real_data_train=self.__will_calc_rate_real_data_train,
+                                             autocast_dtype=self.__autocast_dtype,
+                                             will_use_channels_last=self.__will_use_channels_last,
+                                             model_compiler=self.__model_compiler)
 
     def __call__(self, model_builder_input):
         return self.build_model_builder_wrapper(model_builder_input)
@@ -93,7 +132,12 @@ class PytorchSiameseModelBuilder(PytorchModelBuilder):
                  is_inceptionv3: bool = False,
                  decide_dataset_generator=None,
                  nearest_data_ave_num=1,
-                 will_calc_rate_real_data_train=False):
+                 will_calc_rate_real_data_train=False,
+                 mixed_precision: Optional[str] = None,
+                 will_use_channels_last: bool = False,
+                 compile_mode: Optional[str] = None,
+                 activation_checkpoint: Optional[ActivationCheckpointSetting] = None,
+                 frozen_layer_depth: int = 0):
         use_loss_calculator = AAEUMLoss(q) if loss_calculator is None else loss_calculator
         loss = SiameseLossForInceptionV3(calc_distance, use_loss_calculator) if is_inceptionv3 else SiameseLoss(calc_distance, use_loss_calculator)
         super(PytorchSiameseModelBuilder, self).__init__(img_size,
@@ -103,7 +147,12 @@ class PytorchSiameseModelBuilder(PytorchModelBuilder):
                                                          loss,
                                                          decide_dataset_generator,
                                                          nearest_data_ave_num,
-                                                         will_calc_rate_real_data_train
+                                                         will_calc_rate_real_data_train,
+                                                         mixed_precision,
+                                                         will_use_channels_last,
+                                                         compile_mode,
+                                                         activation_checkpoint,
+                                                         frozen_layer_depth
                                                          )
 
     def build_raw_model(self, model_builder_input) -> torch.nn.Module:
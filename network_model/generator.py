@@ -50,6 +50,30 @@ class DataLoaderFromPaths(Sequence):
         self.__normalize_type = normalize_type
         print("initialized data_loader")
 
+    @property
+    def data_paths(self) -> List[str]:
+        return self.__data_paths
+
+    @property
+    def data_classes(self) -> List[str]:
+        return self.__data_classes
+
+    @property
+    def batch_size(self) -> int:
+        return self.__batch_size
+
+    @property
+    def img_resize_val(self) -> Optional[img_size]:
+        return self.__img_resize_val
+
+    @property
+    def color(self) -> str:
+        return self.__color
+
+    @property
+    def normalize_type(self) -> NormalizeType:
+        return self.__normalize_type
+
     def __getitem__(self, idx):
         """Get batch data
         :param idx: Index of batch
@@ -1,4 +1,5 @@
 import os
+import gc
 import shutil
 import random
 from typing import Tuple, List, Union, Callable
@@ -13,6 +14,12 @@ from DataIO.data_choicer import BaggingDataPicker, ChoiceDataNum
 from abc import ABC
 from network_model.model_for_distillation import ModelForDistillation
 from network_model.builder.pytorch_builder import PytorchModelBuilder
+from network_model.wrapper.fit_setting import FitSetting
+from network_model.wrapper.resume import FoldProgress
+from network_model.learner.batch_size_finder import BatchSizeFinder
+from network_model.learner.batch_size_finder import tile_batch
+from network_model.wrapper.pytorch.util import distributed
+from network_model.wrapper.feature_cache import FeatureCache
 
 
 LearnModel = Union[md.ModelForManyData, ModelForDistillation]
@@ -114,7 +121,9 @@ class AbsModelLearner(ABC):
                  preprocess_for_model= None,
                  after_learned_process: Optional[Callable[[None], None]] = None,
                  class_mode: Optional[str] = None,
-                 class_num: Optional[int] = None):
+                 class_num: Optional[int] = None,
+                 batch_size_finder: Optional[BatchSizeFinder] = None,
+                 feature_cache: Optional[FeatureCache] = None):
         """
 
         :param model_builder: モデル生成器
@@ -131,6 +140,8 @@ class AbsModelLearner(ABC):
         :param after_learned_process: モデル学習後の後始末
         :param class_mode: flow_from_directoryのクラスモード
         :param class_num: 出力するクラス数　デフォルトではクラスのリスト長と同じになる
+        :param batch_size_finder: 指定すると学習前にバッチサイズを計測して決め、指定したバッチサイズの代わりに使う
+        :param feature_cache: 指定すると水増ししないデータでは入力側の固定したレイヤーの出力を保存して、残りのレイヤーだけを学習する
         """
 
         self.__model_builder = model_builder
@@ -147,6 +158,10 @@ class AbsModelLearner(ABC):
         self.__after_learned_process = after_learned_process
         self.__class_mode = class_mode
         self.__class_num = len(class_list) if class_num is None else class_num
+        self.__batch_size_finder = batch_size_finder
+        self.__found_batch_size = None
+        self.__batch_size_listener = None
+        self.__feature_cache = feature_cache
 
     @property
     def preprocess_for_model(self):
@@ -216,6 +231,36 @@ class AbsModelLearner(ABC):
             return "sparse" if isinstance(self.model_builder, PytorchModelBuilder) else "categorical"
         return "binary"
 
+    @property
+    def found_batch_size(self) -> Optional[int]:
+        """
+
+        :return: 計測して決めたバッチサイズ 計測していなければNone
+        """
+        return self.__found_batch_size
+
+    def set_found_batch_size(self, batch_size: int):
+        """
+        以前に計測したバッチサイズを設定し、計測せずにその値を使う 学習を再開する場合に中断前と同じ値を使うために呼ぶ
+        :param batch_size: 計測済みのバッチサイズ
+        :return: 自身
+        """
+        self.__found_batch_size = batch_size
+        return self
+
+    def set_batch_size_listener(self, listener: Optional[Callable[[int], None]]):
+        """
+        バッチサイズを計測した直後に呼ぶ関数を設定する 学習が中断しても計測した値を残せるよう、設定の保存などに使う
+        :param listener: 計測したバッチサイズを受け取る関数
+        :return: 自身
+        """
+        self.__batch_size_listener = listener
+        return self
+
+    @property
+    def feature_cache(self) -> Optional[FeatureCache]:
+        return self.__feature_cache
+
     @property
     def is_torch(self):
         return isinstance(self.__model_builder, PytorchModelBuilder)
@@ -249,6 +294,60 @@ class AbsModelLearner(ABC):
     def build_train_validation_dir_paths(self, base_dir: str) -> Tuple[str, str]:
         return os.path.join(base_dir, self.train_dir_name), os.path.join(base_dir, self.validation_name)
 
+    def find_batch_size(self,
+                        result_dir_path: str,
+                        result_name: str,
+                        train_dir: str,
+                        data_preprocess=None) -> int:
+        """
+        計測用のモデルを別に作り、学習データの先頭のバッチを繰り返したデータで学習してバッチサイズを決める
+        分散学習している場合は、プロセスごとに試すバッチサイズの数が変わって集団通信が食い違わないよう、
+        代表のプロセスだけがDistributedDataParallelで包まずに計測し、その値を他のプロセスに配る
+        """
+        if self.is_torch is False:
+            return self.probe_batch_size(result_dir_path, result_name, train_dir, data_preprocess)
+        batch_size = 0
+        if distributed.is_main_process():
+            with distributed.run_locally():
+                batch_size = self.probe_batch_size(result_dir_path, result_name, train_dir, data_preprocess)
+        return distributed.broadcast_int(batch_size)
+
+    def probe_batch_size(self,
+                         result_dir_path: str,
+                         result_name: str,
+                         train_dir: str,
+                         data_preprocess=None) -> int:
+        probe_model = self.build_model(result_dir_path, result_name + "_probe")
+        x, y = self.build_train_generator(self.__batch_size_finder.min_batch_size, train_dir)[0][:2]
+
+        def build_batch(batch_size: int):
+            return tile_batch(x, batch_size), tile_batch(y, batch_size)
+
+        def run_step(batch):
+            use_x, use_y = batch if data_preprocess is None else data_preprocess(*batch)
+            probe_model.train_on_batch(use_x, use_y)
+        batch_size = self.__batch_size_finder.find(build_batch, run_step)
+        del probe_model
+        gc.collect()
+        return batch_size
+
+    def decide_batch_size(self,
+                          batch_size: int,
+                          result_dir_path: str,
+                          result_name: str,
+                          train_dir: str,
+                          data_preprocess=None) -> int:
+        """
+        計測する場合は最初に計測した値を、交差検証などの2回目以降の学習でも使う
+        """
+        if self.__batch_size_finder is None:
+            return batch_size
+        if self.__found_batch_size is None:
+            self.__found_batch_size = self.find_batch_size(result_dir_path, result_name, train_dir, data_preprocess)
+            if self.__batch_size_listener is not None:
+                self.__batch_size_listener(self.__found_batch_size)
+        return self.__found_batch_size
+
     def train_with_validation_from_model(self,
                                          model: LearnModel,
                                          result_dir_path: str,
@@ -260,9 +359,19 @@ class AbsModelLearner(ABC):
                                          model_name: str = "model",
                                          save_weights_only: bool = False,
                                          will_use_multi_inputs_per_one_image: bool = False,
-                                         input_data_preprocess_for_building_multi_data=None) -> LearnModel:
+                                         input_data_preprocess_for_building_multi_data=None,
+                                         fit_setting: Optional[FitSetting] = None) -> LearnModel:
+        batch_size = self.decide_batch_size(batch_size,
+                                            result_dir_path,
+                                            result_name,
+                                            train_dir,
+                                            input_data_preprocess_for_building_multi_data)
         train_generator, train_steps_per_epoch, test_generator, test_steps_per_epoch = \
-            self.build_validation_generator_and_get_steps_per_epoch(train_dir, validation_dir, batch_size)
+            self.build_validation_generator_and_get_steps_per_epoch(train_dir,
+                                                                    validation_dir,
+                                                                    batch_size,
+                                                                    None if fit_setting is None
+                                                                    else fit_setting.eval_batch_size)
 
         # テスト開始
         model.test(train_generator,
@@ -276,7 +385,8 @@ class AbsModelLearner(ABC):
                    model_name=result_name+"val",
                    save_weights_only=save_weights_only,
                    will_use_multi_inputs_per_one_image=will_use_multi_inputs_per_one_image,
-                   input_data_preprocess_for_building_multi_data=input_data_preprocess_for_building_multi_data
+                   input_data_preprocess_for_building_multi_data=input_data_preprocess_for_building_multi_data,
+                   fit_setting=fit_setting
                    )
         return model
 
@@ -291,7 +401,8 @@ class AbsModelLearner(ABC):
                               monitor: str = "",
                               save_weights_only: bool = False,
                               will_use_multi_inputs_per_one_image: bool = False,
-                              data_preprocess=None) -> LearnModel:
+                              data_preprocess=None,
+                              fit_setting: Optional[FitSetting] = None) -> LearnModel:
         """
         検証用データがある場合の学習
         :param dataset_root_dir: データが格納されたディレクトリ
@@ -305,6 +416,7 @@ class AbsModelLearner(ABC):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param data_preprocess:
+        :param fit_setting: データ読み込みのワーカー数などの設定
         :return: 学習済みモデル
         """
         model_val = self.build_model(tmp_model_path, monitor)
@@ -319,7 +431,8 @@ class AbsModelLearner(ABC):
                                                      model_name,
                                                      save_weights_only,
                                                      will_use_multi_inputs_per_one_image,
-                                                     data_preprocess)
+                                                     data_preprocess,
+                                                     fit_setting)
 
     def train_without_validation(self,
                                  original_dir: str,
@@ -332,8 +445,10 @@ class AbsModelLearner(ABC):
                                  monitor: str = "",
                                  save_weights_only: bool = False,
                                  will_use_multi_inputs_per_one_image: bool = False,
-                                 data_preprocess=None) -> LearnModel:
+                                 data_preprocess=None,
+                                 fit_setting: Optional[FitSetting] = None) -> LearnModel:
         model = self.build_model(result_dir_path, result_name, tmp_model_path, monitor)
+        batch_size = self.decide_batch_size(batch_size, result_dir_path, result_name, original_dir, data_preprocess)
         train_generator = self.build_train_generator(batch_size, original_dir)
         data_num = count_data_num_in_dir(original_dir)
         model.fit_generator(train_generator,
@@ -341,7 +456,8 @@ class AbsModelLearner(ABC):
                             steps_per_epoch=(data_num//batch_size),
                             save_weights_only=save_weights_only,
                             will_use_multi_inputs_per_one_image=will_use_multi_inputs_per_one_image,
-                            data_preprocess=data_preprocess)
+                            data_preprocess=data_preprocess,
+                            fit_setting=fit_setting)
         model.record(result_name,
                      result_dir_path,
                      model_name,
@@ -360,7 +476,8 @@ class AbsModelLearner(ABC):
                                            monitor: str = None,
                                            save_weights_only: bool = False,
                                            will_use_multi_inputs_per_one_image: bool = False,
-                                           data_preprocess=None) -> List[LearnModel]:
+                                           data_preprocess=None,
+                                           fit_setting: Optional[FitSetting] = None) -> List[LearnModel]:
         """
         あらかじめ交差検証のためにデータ分割したディレクトリから検証を行い学習する
         :param base_dir: 検証データが格納されたディレクトリ
@@ -375,25 +492,34 @@ class AbsModelLearner(ABC):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param data_preprocess:
+        :param fit_setting: データ読み込みのワーカー数などの設定 will_resumeがTrueなら学習済みの分割は飛ばし、途中の分割は続きから学習する
         :return:
         """
         val_dir_names_base = os.listdir(base_dir)
         val_dir_names = val_dir_names_base if start_index is None else val_dir_names_base[start_index:]
-        result_names = [result_name + dir_name for dir_name in val_dir_names]
-        model_names = [model_name + dir_name for dir_name in val_dir_names]
-        data_dir_paths = [os.path.join(base_dir, val_dir_name) for val_dir_name in val_dir_names]
-        models = [self.train_with_validation(data_dir_path,
-                                             result_dir_path,
-                                             batch_size,
-                                             epoch_num,
-                                             result_name,
-                                             model_name,
-                                             tmp_model_path,
-                                             monitor,
-                                             save_weights_only,
-                                             will_use_multi_inputs_per_one_image,
-                                             data_preprocess)
-                  for result_name, model_name, data_dir_path in zip(result_names, model_names, data_dir_paths)]
+        fold_progress = None
+        if fit_setting is not None and fit_setting.will_checkpoint:
+            fold_progress = FoldProgress(os.path.join(result_dir_path, result_name + "_cv_progress.json"))
+        models = []
+        for val_dir_name in val_dir_names:
+            if fit_setting is not None and fit_setting.will_resume and fold_progress.is_finished(val_dir_name):
+                print("skip finished fold", val_dir_name)
+                continue
+            models.append(self.train_with_validation(os.path.join(base_dir, val_dir_name),
+                                                     result_dir_path,
+                                                     batch_size,
+                                                     epoch_num,
+                                                     result_name + val_dir_name,
+                                                     model_name + val_dir_name,
+                                                     tmp_model_path,
+                                                     monitor,
+                                                     save_weights_only,
+                                                     will_use_multi_inputs_per_one_image,
+                                                     data_preprocess,
+                                                     None if fit_setting is None
+                                                     else fit_setting.with_checkpoint_sub_dir(val_dir_name)))
+            if fold_progress is not None:
+                fold_progress.finish(val_dir_name)
         return models
 
     def train_by_bagging(self,
@@ -409,7 +535,8 @@ class AbsModelLearner(ABC):
                          monitor: str = "",
                          save_weights_only: bool = False,
                          will_use_multi_inputs_per_one_image: bool = False,
-                         data_preprocess=None) -> List[LearnModel]:
+                         data_preprocess=None,
+                         fit_setting: Optional[FitSetting] = None) -> List[LearnModel]:
         """
         バギングで学習する
         :param dataset_root_dir: データが格納されたディレクトリ
@@ -425,6 +552,7 @@ class AbsModelLearner(ABC):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param data_preprocess:
+        :param fit_setting: データ読み込みのワーカー数などの設定
         :return: 学習済みモデル
         """
         data_picker = BaggingDataPicker(pick_data_num, build_dataset_num)
@@ -445,14 +573,17 @@ class AbsModelLearner(ABC):
                                                       model_name,
                                                       save_weights_only,
                                                       will_use_multi_inputs_per_one_image,
-                                                      data_preprocess)
+                                                      data_preprocess,
+                                                      fit_setting)
                 for model, bagging_train_dir, result_model_name in zip(model_base, bagging_train_dirs, result_names)]
 
     def build_validation_generator_and_get_steps_per_epoch(self,
                                                            train_dir: str,
                                                            validation_dir: str,
-                                                           batch_size=32):
+                                                           batch_size=32,
+                                                           eval_batch_size: Optional[int] = None):
         train_generator = self.build_train_generator(batch_size, train_dir)
-        test_generator = self.build_test_generator(batch_size, validation_dir)
+        test_generator = self.build_test_generator(batch_size if eval_batch_size is None else eval_batch_size,
+                                                   validation_dir)
         return train_generator, len(train_generator), test_generator, len(test_generator) - 1
 
@@ -0,0 +1,219 @@
+import os
+import threading
+from time import perf_counter
+from typing import Callable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+import numpy as np
+
+MB = 1024 * 1024
+
+
+def read_rss_mb() -> float:
+    """
+    このプロセスの現在の常駐メモリ量(MB)
+    """
+    try:
+        with open("/proc/self/statm", "r") as fr:
+            return int(fr.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+    except (OSError, ValueError):
+        import resource
+        # /procがない環境では現在値が取れないので、ピーク値で代用する
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def read_available_mb() -> Optional[float]:
+    try:
+        with open("/proc/meminfo", "r") as fr:
+            for line in fr:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if hasattr(os, "sysconf") and "SC_AVPHYS_PAGES" in os.sysconf_names:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / MB
+    return None
+
+
+class RssMonitor(object):
+    """
+    計測中のピークの常駐メモリ量を記録する
+    Linuxではカーネルが記録するピーク値(VmHWM)をリセットして使い、それ以外では一定間隔で現在値を読んで最大値を取る
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """
+
+        :param interval: 現在値を読む間隔の秒数
+        """
+        self.__interval = interval
+        self.__peak_mb = 0.
+        self.__can_read_hwm = False
+        self.__stop_event = threading.Event()
+        self.__thread = None
+
+    @staticmethod
+    def reset_hwm() -> bool:
+        try:
+            with open("/proc/self/clear_refs", "w") as fw:
+                fw.write("5")
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def read_hwm_mb() -> float:
+        with open("/proc/self/status", "r") as fr:
+            for line in fr:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+        return 0.
+
+    def __sample(self):
+        while self.__stop_event.wait(self.__interval) is False:
+            self.__peak_mb = max(self.__peak_mb, read_rss_mb())
+
+    def start(self):
+        self.__peak_mb = read_rss_mb()
+        self.__can_read_hwm = self.reset_hwm()
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self) -> float:
+        """
+        :return: startからのピークの常駐メモリ量(MB)
+        """
+        self.__stop_event.set()
+        self.__thread.join()
+        peak_mb = max(self.__peak_mb, read_rss_mb())
+        if self.__can_read_hwm:
+            peak_mb = max(peak_mb, self.read_hwm_mb())
+        return peak_mb
+
+
+class ProbeResult(NamedTuple):
+    batch_size: int
+    peak_rss_mb: float
+    images_per_sec: float
+
+
+class BatchSizeFinder(object):
+    """
+    バッチサイズを倍々に増やしながら数ステップずつ学習し、ピークの常駐メモリ量と1秒あたりの画像数を計測して
+    メモリの上限に収まるバッチサイズの中から処理速度が最も高いものを選ぶ
+    速度の差がthroughput_tolerance以内なら大きい方のバッチサイズを選ぶ
+    """
+
+    def __init__(self,
+                 memory_budget_mb: Optional[float] = None,
+                 min_batch_size: int = 2,
+                 max_batch_size: int = 256,
+                 probe_steps: int = 3,
+                 warmup_steps: int = 1,
+                 throughput_tolerance: float = 0.05,
+                 process_num: int = 1):
+        """
+
+        :param memory_budget_mb: 1プロセスあたりのメモリの上限(MB) 指定しなければ空きメモリの8割をプロセス数で割った分
+        :param min_batch_size: 試す最小のバッチサイズ
+        :param max_batch_size: 試す最大のバッチサイズ
+        :param probe_steps: 1つのバッチサイズで計測するステップ数
+        :param warmup_steps: 計測前に実行するステップ数 メモリの確保や初回のみの処理を計測から外す
+        :param throughput_tolerance: 最も速いものとの速度の差がこの割合以内なら同じ速さとみなす
+        :param process_num: 同時に計測するプロセス数
+        """
+        self.__memory_budget_mb = memory_budget_mb
+        self.__min_batch_size = max(min_batch_size, 1)
+        self.__max_batch_size = max(max_batch_size, self.__min_batch_size)
+        self.__probe_steps = max(probe_steps, 1)
+        self.__warmup_steps = warmup_steps
+        self.__throughput_tolerance = throughput_tolerance
+        self.__process_num = max(process_num, 1)
+
+    @property
+    def min_batch_size(self) -> int:
+        return self.__min_batch_size
+
+    def build_memory_budget_mb(self) -> Optional[float]:
+        if self.__memory_budget_mb is not None:
+            return self.__memory_budget_mb
+        available_mb = read_available_mb()
+        if available_mb is None:
+            return None
+        return read_rss_mb() + available_mb * 0.8 / self.__process_num
+
+    def build_candidates(self) -> List[int]:
+        candidates = []
+        batch_size = self.__min_batch_size
+        while batch_size < self.__max_batch_size:
+            candidates.append(batch_size)
+            batch_size *= 2
+        return candidates + [self.__max_batch_size]
+
+    def probe(self,
+              batch_size: int,
+              build_batch: Callable[[int], tuple],
+              run_step: Callable[[tuple], None]) -> ProbeResult:
+        batch = build_batch(batch_size)
+        monitor = RssMonitor().start()
+        try:
+            for _ in range(self.__warmup_steps):
+                run_step(batch)
+            start = perf_counter()
+            for _ in range(self.__probe_steps):
+                run_step(batch)
+            elapsed = perf_counter() - start
+        finally:
+            peak_rss_mb = monitor.stop()
+        return ProbeResult(batch_size, peak_rss_mb, batch_size * self.__probe_steps / max(elapsed, 1e-9))
+
+    def choose(self, results: List[ProbeResult]) -> int:
+        if len(results) == 0:
+            return self.__min_batch_size
+        best_images_per_sec = max(result.images_per_sec for result in results)
+        return max(result.batch_size for result in results
+                   if result.images_per_sec >= best_images_per_sec * (1 - self.__throughput_tolerance))
+
+    def find(self,
+             build_batch: Callable[[int], tuple],
+             run_step: Callable[[tuple], None]) -> int:
+        """
+        バッチサイズを決める
+        :param build_batch: バッチサイズを受け取って計測用の1バッチを返す関数
+        :param run_step: 1バッチを受け取って1ステップ学習する関数
+        :return: 選んだバッチサイズ
+        """
+        memory_budget_mb = self.build_memory_budget_mb()
+        print("find batch size under memory budget", memory_budget_mb, "MB")
+        results = []
+        for batch_size in self.build_candidates():
+            try:
+                result = self.probe(batch_size, build_batch, run_step)
+            except (MemoryError, RuntimeError) as e:
+                print("batch size", batch_size, "failed:", e)
+                break
+            print("batch size", batch_size,
+                  "peak rss %.1f MB" % result.peak_rss_mb,
+                  "%.1f images/sec" % result.images_per_sec)
+            if memory_budget_mb is not None and result.peak_rss_mb > memory_budget_mb:
+                break
+            results.append(result)
+        if len(results) == 0:
+            print("no batch size fits in the memory budget, use", self.__min_batch_size)
+        batch_size = self.choose(results)
+        print("chosen batch size", batch_size)
+        return batch_size
+
+
+def tile_batch(data, batch_size: int):
+    """
+    見本のバッチを繰り返してbatch_size件のバッチを作る
+    """
+    if isinstance(data, list):
+        return [tile_batch(item, batch_size) for item in data]
+    if isinstance(data, dict):
+        return {key: tile_batch(item, batch_size) for key, item in data.items()}
+    return np.take(data, np.arange(batch_size) % len(data), axis=0)
@@ -9,6 +9,9 @@ from network_model.model_builder import ModelBuilder
 from DataIO.data_loader import NormalizeType
 from network_model.learner.abs_split_learner import AbsModelLearner
 from network_model.builder.pytorch_builder import PytorchModelBuilder
+from network_model.wrapper.fit_setting import FitSetting
+from network_model.learner.batch_size_finder import BatchSizeFinder
+from network_model.wrapper.feature_cache import FeatureCache
 
 
 class ModelLearner(AbsModelLearner):
@@ -27,7 +30,9 @@ class ModelLearner(AbsModelLearner):
                  preprocess_for_model=None,
                  after_learned_process: Optional[Callable[[None], None]] = None,
                  class_mode: Optional[str] = None,
-                 class_num: Optional[int] = None):
+                 class_num: Optional[int] = None,
+                 batch_size_finder: Optional[BatchSizeFinder] = None,
+                 feature_cache: Optional[FeatureCache] = None):
         """
 
         :param model_builder: モデル生成器
@@ -44,6 +49,8 @@ class ModelLearner(AbsModelLearner):
         :param after_learned_process: モデル学習後の後始末
         :param class_mode: flow_from_directoryのクラスモード
         :param class_num: 出力するクラス数　デフォルトではクラスのリスト長と同じになる
+        :param batch_size_finder: 指定すると学習前にバッチサイズを計測して決め、指定したバッチサイズの代わりに使う
+        :param feature_cache: 指定すると水増ししないデータでは入力側の固定したレイヤーの出力を保存して、残りのレイヤーだけを学習する
         """
 
         super().__init__(model_builder,
@@ -59,7 +66,9 @@ class ModelLearner(AbsModelLearner):
                          preprocess_for_model,
                          after_learned_process,
                          class_mode,
-                         class_num)
+                         class_num,
+                         batch_size_finder,
+                         feature_cache)
 
     def build_model_from_result(self,
                                 build_result,
@@ -114,7 +123,7 @@ class ModelLearner(AbsModelLearner):
         return self.build_model_from_result(build_result,
                                             model_dir_path,
                                             result_name,
-                                            monitor)
+                                            monitor).set_feature_cache(self.feature_cache)
 
     def train_with_validation_from_model(self,
                                          model: md.ModelForManyData,
@@ -127,7 +136,8 @@ class ModelLearner(AbsModelLearner):
                                          model_name: str = "model",
                                          save_weights_only: bool = False,
                                          will_use_multi_inputs_per_one_image: bool = False,
-                                         data_preprocess=None) -> md.ModelForManyData:
+                                         data_preprocess=None,
+                                         fit_setting: Optional[FitSetting] = None) -> md.ModelForManyData:
         return super().train_with_validation_from_model(model,
                                                         result_dir_path,
                                                         train_dir,
@@ -138,7 +148,8 @@ class ModelLearner(AbsModelLearner):
                                                         model_name,
                                                         save_weights_only,
                                                         will_use_multi_inputs_per_one_image,
-                                                        data_preprocess)
+                                                        data_preprocess,
+                                                        fit_setting)
 
     def train_with_validation(self,
                               dataset_root_dir: str,
@@ -151,7 +162,8 @@ class ModelLearner(AbsModelLearner):
                               monitor: str = "",
                               save_weights_only: bool = False,
                               will_use_multi_inputs_per_one_image: bool = False,
-                              data_preprocess=None) -> md.ModelForManyData:
+                              data_preprocess=None,
+                              fit_setting: Optional[FitSetting] = None) -> md.ModelForManyData:
         """
         検証用データがある場合の学習
         :param dataset_root_dir: データが格納されたディレクトリ
@@ -165,6 +177,7 @@ class ModelLearner(AbsModelLearner):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param data_preprocess:
+        :param fit_setting: データ読み込みのワーカー数などの設定
         :return: 学習済みモデル
         """
         model_val = self.build_model(result_dir_path, result_name, tmp_model_path, monitor)
@@ -179,6 +192,7 @@ class ModelLearner(AbsModelLearner):
                                                      model_name,
                                                      save_weights_only,
                                                      will_use_multi_inputs_per_one_image,
-                                                     data_preprocess)
+                                                     data_preprocess,
+                                                     fit_setting)
 
 
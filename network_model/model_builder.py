@@ -4,6 +4,7 @@ from typing import Callable
 from typing import Tuple
 from typing import List
 from typing import Union
+from typing import Optional
 from util_types import types_of_loco
 from network_model.distillation.distillation_model_builder import DistllationModelIncubator
 from keras.optimizers import Optimizer, SGD
@@ -41,7 +42,12 @@ def init_input_image(size: types_of_loco.input_img_size):
 def build_wrapper(img_size: types_of_loco.input_img_size = 28,
                   channels: int = 3,
                   model_name: str = "model1",
-                  optimizer: Optimizer = SGD()) -> Union[ModelBuilder, pytorch_builder.PytorchModelBuilder]:
+                  optimizer: Optimizer = SGD(),
+                  mixed_precision: Optional[str] = None,
+                  will_use_channels_last: bool = False,
+                  compile_mode: Optional[str] = None,
+                  activation_checkpoint=None,
+                  frozen_layer_depth: int = 0) -> Union[ModelBuilder, pytorch_builder.PytorchModelBuilder]:
     """
     モデル生成をする関数を返す
     交差検証をかける際のラッパーとして使う
@@ -49,13 +55,26 @@ def build_wrapper(img_size: types_of_loco.input_img_size = 28,
     :param channels:
     :param model_name:
     :param optimizer:
+    :param mixed_precision: Pytorchのモデルで混合精度を使う場合はbf16を指定する
+    :param will_use_channels_last: TrueならPytorchのモデルと入力をchannels_lastのメモリ配置にする
+    :param compile_mode: Pytorchのモデルをtorch.compileでコンパイルする場合のmode defaultなど
+                         torch.compileのあるtorch 2.0以降が必要で、それより前のtorchではeagerで実行する
+    :param activation_checkpoint: Pytorchのバックボーンのステージの活性を逆伝播時に再計算する場合のステージ名と区間数の辞書
+    :param frozen_layer_depth: Pytorchのモデルで入力側から固定するレイヤー数
     :return:
     """
     if callable(optimizer):
         return pytorch_builder.PytorchModelBuilder(img_size=img_size,
                                                    channels=channels,
                                                    model_name=model_name,
-                                                   opt_builder=optimizer)
+                                                   opt_builder=optimizer,
+                                                   mixed_precision=mixed_precision,
+                                                   will_use_channels_last=will_use_channels_last,
+                                                   compile_mode=compile_mode,
+                                                   activation_checkpoint=activation_checkpoint,
+                                                   frozen_layer_depth=frozen_layer_depth)
+    if mixed_precision is not None:
+        print("mixed_precision is only supported for pytorch models")
     return keras_builder.build_wrapper(img_size, channels, model_name, optimizer)
 
 
@@ -88,7 +107,9 @@ def build_siamese(q: float,
                   is_inceptionv3: bool = False,
                   decide_dataset_generator=None,
                   nearest_data_ave_num=1,
-                  will_calc_real_data_train=False):
+                  will_calc_real_data_train=False,
+                  activation_checkpoint=None,
+                  frozen_layer_depth: int = 0):
     use_distance = calc_distance
     if use_distance is None:
         use_distance = L1Norm() if callable(optimizer) else calc_l1_norm
@@ -115,4 +136,7 @@ def build_siamese(q: float,
                                                       is_inceptionv3,
                                                       decide_dataset_generator,
                                                       nearest_data_ave_num,
-                                                      will_calc_real_data_train) if callable(optimizer) else build
+                                                      will_calc_real_data_train,
+                                                      activation_checkpoint=activation_checkpoint,
+                                                      frozen_layer_depth=frozen_layer_depth) \
+        if callable(optimizer) else build
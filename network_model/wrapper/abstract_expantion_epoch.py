@@ -1,26 +1,84 @@
-from keras.callbacks import CallbackList, ProgbarLogger, BaseLogger, History
-from keras.utils.data_utils import OrderedEnqueuer
-from keras.utils.generic_utils import to_list
 from abc import ABC, abstractmethod
+from time import perf_counter
+import random
 from typing import Tuple
 from typing import Optional
 from typing import Union
 import numpy as np
+from network_model.wrapper.fit_setting import FitSetting
+from network_model.wrapper.callbacks import to_list
+from network_model.wrapper.sequence import is_sequence
+from network_model.wrapper.enqueuer import AutotuneEnqueuer
+from network_model.wrapper.enqueuer import PrefetchFeeder
+from network_model.wrapper.enqueuer import PreprocessPipeline
+from network_model.wrapper.step_timer import StepTimer
+from network_model.wrapper.callback_bus import CallbackBus
+from network_model.wrapper.resume import ResumeCheckpointer
+from network_model.wrapper.resume import RemainingSequence
+from network_model.wrapper.resume import build_callback_states
+from network_model.wrapper.resume import restore_callback_states
+from network_model.wrapper.resume import build_history_state
+from network_model.wrapper.resume import restore_history_state
+from network_model.wrapper.resume import write_pickle
+from network_model.wrapper.resume import read_pickle
+from network_model.wrapper.validation_subset import StratifiedSubsetSequence
 
 
 class AbsExpantionEpoch(ABC):
+    __step_timer = None
+    __resume_checkpointer = None
+    __train_sequence = None
+    __train_pipeline = None
+    __epoch_index_array = None
+
+    @property
+    def step_timer(self) -> StepTimer:
+        if self.__step_timer is None:
+            self.__step_timer = StepTimer()
+        return self.__step_timer
+
+    def build_step_timer(self, fit_setting: FitSetting) -> StepTimer:
+        return StepTimer(fit_setting.will_record_timing, log_path=fit_setting.timing_log_path)
+
+    def set_step_timer(self, step_timer: StepTimer):
+        self.__step_timer = step_timer
+
+    @property
+    def accumulation_steps(self) -> int:
+        return 1
+
+    def set_accumulation_steps(self, accumulation_steps: int):
+        """
+        勾配を溜めてまとめて更新するステップ数を設定する 対応していないモデルでは1ステップごとに更新する
+        :param accumulation_steps: 何ステップ分の勾配を溜めてから更新するか
+        """
+        if accumulation_steps > 1:
+            print("gradient accumulation is not supported by", type(self).__name__)
+
+    def finish_epoch_train(self):
+        """
+        エポックの学習ステップがすべて終わった後、検証の前に呼び出される
+        """
+        pass
 
     @property
     def stateful_metric_names(self):
         return ["loss", "accuracy", "val_loss", "val_accuracy"]
 
     @property
-    def base_logger(self):
-        return BaseLogger(stateful_metrics=self.stateful_metric_names)
+    def is_main_process(self) -> bool:
+        """
+        分散学習でファイルの書き出しやログの表示を行うプロセスかどうか
+        """
+        return True
 
     @property
-    def progbar_logger(self):
-        return ProgbarLogger(count_mode='steps', stateful_metrics=self.stateful_metric_names)
+    def metric_materializer(self):
+        """
+        train_on_batchがデバイス上のテンソルを返す場合に、log_flush_stepsごとにまとめてfloatに変換する関数
+        Noneなら毎ステップの値をそのまま使う
+        """
+        return None
 
     @abstractmethod
     def train_on_batch(self, x, y, sample_weight=None, data_preprocess=None):
@@ -64,6 +122,87 @@ class AbsExpantionEpoch(ABC):
     def callbacks_metric(self):
         pass
 
+    @abstractmethod
+    def get_resume_model_state(self) -> dict:
+        pass
+
+    @abstractmethod
+    def set_resume_model_state(self, state: dict):
+        pass
+
+    def write_resume_state(self, file_path: str, state: dict):
+        write_pickle(file_path, state)
+
+    def read_resume_state(self, file_path: str) -> dict:
+        return read_pickle(file_path)
+
+    def build_resume_checkpointer(self, fit_setting: FitSetting) -> Optional[ResumeCheckpointer]:
+        if fit_setting.will_checkpoint is False or fit_setting.checkpoint_dir is None:
+            return None
+        if self.is_main_process is False and fit_setting.will_resume is False:
+            return None
+        return ResumeCheckpointer(fit_setting.checkpoint_dir,
+                                  fit_setting.checkpoint_every_steps,
+                                  fit_setting.checkpoint_every_minutes,
+                                  self.write_resume_state,
+                                  self.read_resume_state)
+
+    def build_resume_state(self, epoch: int, steps_done: int, epoch_logs, callbacks: CallbackBus) -> dict:
+        """
+        学習を再開するための状態を作る
+        :param epoch: 再開するエポック数
+        :param steps_done: そのエポックで学習済みのステップ数
+        :param epoch_logs: 最後のエポックの記録
+        :param callbacks: コールバック
+        :return: 再開用の状態
+        """
+        python_random, numpy_random = random.getstate(), np.random.get_state()
+        if steps_done > 0 and self.__train_pipeline is not None and self.__train_pipeline.random_state is not None:
+            # 前処理のパイプラインが先のバッチのために引いた乱数は含めず、学習済みのバッチまでの状態を保存する
+            python_random, numpy_random = self.__train_pipeline.random_state
+        return {"epoch": epoch,
+                "steps_done": steps_done,
+                "epoch_logs": dict(epoch_logs),
+                "index_array": self.__epoch_index_array if steps_done > 0 else None,
+                "callbacks": build_callback_states(callbacks.callbacks),
+                "history": build_history_state(self.get_model_history()),
+                "python_random": python_random,
+                "numpy_random": numpy_random,
+                "model": self.get_resume_model_state()}
+
+    def restore_resume_state(self, state: dict, callbacks: CallbackBus, sequence) -> Tuple[int, int, dict]:
+        """
+        保存した状態を復元する コールバックの初期化で消えないようにon_train_beginの後に呼ぶ
+        :param state: 再開用の状態
+        :param callbacks: コールバック
+        :param sequence: 学習データのSequence
+        :return: 再開するエポック数、そのエポックで学習済みのステップ数、最後のエポックの記録
+        """
+        self.set_resume_model_state(state["model"])
+        restore_callback_states(callbacks.callbacks, state["callbacks"])
+        restore_history_state(self.get_model_history(), state["history"])
+        random.setstate(state["python_random"])
+        np.random.set_state(state["numpy_random"])
+        steps_done = state["steps_done"]
+        if steps_done > 0 and state["index_array"] is not None and hasattr(sequence, "index_array"):
+            sequence.index_array = state["index_array"]
+        elif steps_done > 0 and hasattr(sequence, "index_array"):
+            print("data order of the interrupted epoch is unknown, restart the epoch from the beginning")
+            steps_done = 0
+        self.__epoch_index_array = state["index_array"]
+        print("resume from epoch", state["epoch"], "step", steps_done)
+        return state["epoch"], steps_done, state["epoch_logs"]
+
+    def record_epoch_index_array(self):
+        index_array = getattr(self.__train_sequence, "index_array", None)
+        self.__epoch_index_array = None if index_array is None else np.array(index_array)
+
+    def save_resume_state(self, epoch: int, steps_done: int, epoch_logs, callbacks: CallbackBus, will_force=False):
+        if self.__resume_checkpointer is None or self.is_main_process is False:
+            return
+        if will_force or self.__resume_checkpointer.count_step():
+            self.__resume_checkpointer.save(self.build_resume_state(epoch, steps_done, epoch_logs, callbacks))
+
     def build_raw_one_batch_dataset(self, output_generator):
         generator_output = next(output_generator)
 
@@ -97,7 +236,41 @@ class AbsExpantionEpoch(ABC):
             return x, y, sample_weight, original_x, original_y
         return x, y, sample_weight
 
+    def build_one_batch_dataset_with_timing(self,
+                                            output_generator,
+                                            data_preprocess=None):
+        """
+        build_one_batch_datasetを実行し、読み込みとdata_preprocessそれぞれにかかった時間も返す
+        別スレッドで実行する場合があるのでStepTimerには直接記録しない
+        """
+        timings = {}
+
+        def timed_preprocess(x, y):
+            preprocess_start = perf_counter()
+            result = data_preprocess(x, y)
+            timings["preprocess"] = perf_counter() - preprocess_start
+            return result
+        start = perf_counter()
+        got_params = self.build_one_batch_dataset(output_generator,
+                                                  None if data_preprocess is None else timed_preprocess,
+                                                  True)
+        timings["data_load"] = perf_counter() - start - timings.get("preprocess", 0.)
+        return got_params, timings
+
+    @staticmethod
+    def get_batch_size(x) -> int:
+        if x is None or len(x) == 0:
+            return 1
+        if isinstance(x, list):
+            return x[0].shape[0]
+        if isinstance(x, dict):
+            return list(x.values())[0].shape[0]
+        return x.shape[0]
+
     def get_callbacks_for_expantion(self, temp_best_path, save_weights_only=False):
+        if self.is_main_process is False:
+            # チェックポイントやログの書き出しは代表のプロセスだけが行う
+            return [self.get_model_history()]
         base_callbacks = self.get_callbacks(temp_best_path, save_weights_only)
         if base_callbacks is None or base_callbacks == []:
             return [self.get_model_history()]
@@ -108,7 +281,8 @@ class AbsExpantionEpoch(ABC):
                                       temp_best_path,
                                       steps_per_epoch: Optional[int] = None,
                                       validation_data=None,
-                                      save_weights_only=False):
+                                      save_weights_only=False,
+                                      log_flush_steps: int = 1):
         """
         一つのデータから複数の入力を使用する場合のコールバックを生成する
         :param epochs: エポック数
@@ -116,14 +290,18 @@ class AbsExpantionEpoch(ABC):
         :param steps_per_epoch:
         :param validation_data
         :param save_weights_only:
+        :param log_flush_steps: 学習中の値を集計して進捗を表示する間隔のステップ数
         :return:
         """
         self.set_model_history()
         will_validate = bool(validation_data)
         # self.build_model_functions(will_validate)
-        build_callbacks = [self.base_logger, self.progbar_logger]
-        raw_callbacks = build_callbacks + self.get_callbacks_for_expantion(temp_best_path, save_weights_only)
-        callbacks = CallbackList(raw_callbacks)
+        callbacks = CallbackBus(self.get_callbacks_for_expantion(temp_best_path, save_weights_only),
+                                self.callbacks_metric,
+                                self.stateful_metric_names,
+                                log_flush_steps,
+                                verbose=1 if self.is_main_process else 0,
+                                materialize=self.metric_materializer)
         callbacks.set_model(self.model)
         callbacks.set_params({
             'epochs': epochs,
@@ -137,34 +315,39 @@ class AbsExpantionEpoch(ABC):
     def init_for_one_batch(self,
                            output_generator,
                            batch_index: int,
-                           callbacks: CallbackList,
+                           callbacks: CallbackBus,
                            data_preprocess=None):
-        got_params = self.build_one_batch_dataset(output_generator,
-                                                  data_preprocess,
-                                                  True)
+        if isinstance(output_generator, PreprocessPipeline):
+            # 別スレッドで計測した読み込みと前処理の時間は、待ち時間とは別に加算する
+            got_params, timings = next(output_generator)
+            self.step_timer.lap("data_wait")
+            for name, seconds in timings.items():
+                self.step_timer.add(name, seconds)
+        else:
+            got_params, timings = self.build_one_batch_dataset_with_timing(output_generator, data_preprocess)
+            self.step_timer.lap("data_wait", included_times=timings)
         # build batch logs
         batch_logs = {}
         callbacks.on_batch_begin(batch_index, batch_logs)
         x, y, sample_weight, original_x, original_y = got_params
+        self.step_timer.set_batch_size(self.get_batch_size(original_x))
+        self.step_timer.lap("callbacks")
         return x, y, sample_weight, original_x, original_y, batch_logs
 
     def run_one_batch_base(self,
                            output_generator,
                            batch_index: int,
-                           callbacks: CallbackList,
+                           callbacks: CallbackBus,
                            data_preprocess=None):
         x, y, sample_weight, original_x, original_y, batch_logs = self.init_for_one_batch(output_generator,
                                                                                           batch_index,
                                                                                           callbacks,
                                                                                           data_preprocess)
-        # build batch logs
-        batch_logs = {}
-        callbacks.on_batch_begin(batch_index, batch_logs)
-
         outs = self.train_on_batch(x,
                                    y,
                                    sample_weight=None,
                                    data_preprocess=data_preprocess)
+        self.step_timer.lap("compute")
         return x, y,  original_x, original_y, outs, batch_logs
 
     def run_after_finished_batch(self,
@@ -175,15 +358,17 @@ class AbsExpantionEpoch(ABC):
                                  steps_done: int,
                                  ):
         batch_logs = self.add_output_param_to_batch_log_param(outs, batch_logs)
+        batch_logs = self.step_timer.end_batch(batch_logs)
 
         callbacks.on_batch_end(batch_index, batch_logs)
+        self.step_timer.lap("callbacks")
         return batch_index+1, steps_done+1
 
     def one_batch(self,
                   output_generator,
                   batch_index: int,
                   steps_done: int,
-                  callbacks: CallbackList,
+                  callbacks: CallbackBus,
                   data_preprocess=None):
         x, y, original_x, original_y, outs, batch_logs = self.run_one_batch_base(output_generator,
                                                                                  batch_index,
@@ -191,16 +376,113 @@ class AbsExpantionEpoch(ABC):
                                                                                  data_preprocess)
         return self.run_after_finished_batch(outs, batch_logs, callbacks, batch_index, steps_done)
 
-    def build_val_enqueuer(self, validation_data):
+    def build_val_enqueuer(self, validation_data, fit_setting: Optional[FitSetting] = None):
+        """
+        検証データを先読みするエンキューを起動する
+        Sequence以外の検証データはそのまま返して従来通り同期的に読み込む
+        :param validation_data: 検証データ
+        :param fit_setting: 先読みのワーカー数などの設定
+        :return: 検証時に読み込む対象、停止が必要なエンキュー、検証のステップ数
+        """
         will_validate = bool(validation_data)
         if will_validate is False:
             return None, None, None
-        val_data = validation_data
-        val_enqueuer = OrderedEnqueuer(
-            val_data,
-            use_multiprocessing=False)
-        validation_steps = len(val_data)
-        return val_data, val_enqueuer, validation_steps if validation_steps is not None else len(validation_data)
+        validation_steps = len(validation_data)
+        if is_sequence(validation_data) is False:
+            return validation_data, None, validation_steps
+        use_fit_setting = FitSetting() if fit_setting is None else fit_setting
+        val_enqueuer = PrefetchFeeder(validation_data,
+                                      use_fit_setting.val_workers,
+                                      use_fit_setting.val_max_queue_size,
+                                      use_fit_setting.use_multiprocessing).start()
+        return val_enqueuer, val_enqueuer, validation_steps
+
+    def build_val_subset(self, validation_data, fit_setting: FitSetting):
+        """
+        途中のエポックの検証に使う、クラスの比率を保った検証データの一部を作る
+        :param validation_data: 検証データ
+        :param fit_setting: 取り出すデータ数などの設定
+        :return: 一部を取り出したSequence 全件で検証する場合はNone
+        """
+        if fit_setting.validation_subset_size <= 0 or not validation_data:
+            return None
+        if StratifiedSubsetSequence.can_build(validation_data) is False:
+            print("validation subset needs flow_from_directory data, use full validation data")
+            return None
+        return StratifiedSubsetSequence(validation_data, fit_setting.validation_subset_size)
+
+    def is_validation_epoch(self,
+                            epoch: int,
+                            epochs: int,
+                            fit_setting: FitSetting,
+                            callbacks: CallbackBus) -> bool:
+        """
+        このエポックの終わりに検証するかどうか
+        最後のエポックとvalidation_freqごとのエポックのほか、
+        コールバックが監視する検証の値がまだ一度も記録されていない場合も検証する
+        検証しないエポックのepoch_logsには検証の値を入れないので、チェックポイントなどはそのエポックを判定に使わない
+        """
+        if epoch + 1 >= epochs or (epoch + 1) % max(fit_setting.validation_freq, 1) == 0:
+            return True
+        recorded_logs = getattr(self.get_model_history(), "history", None) or {}
+        monitors = [getattr(callback, "monitor", None) for callback in callbacks.callbacks]
+        return any(isinstance(monitor, str) and monitor.startswith("val_") and monitor not in recorded_logs
+                   for monitor in monitors)
+
+    def prepare_epoch_validation(self,
+                                 epoch: int,
+                                 epochs: int,
+                                 validation_data,
+                                 val_subset,
+                                 val_enqueuer: Optional[PrefetchFeeder],
+                                 fit_setting: FitSetting):
+        """
+        最後のエポックの前に、一部だけの検証データから全件の検証データへ先読みを切り替える
+        :return: 先読みのエンキュー、一部だけの検証データ 全件に切り替えた後はNone
+        """
+        if val_subset is None or epoch + 1 < epochs:
+            return val_enqueuer, val_subset
+        if val_enqueuer is not None:
+            val_enqueuer.stop()
+        _, val_enqueuer, _ = self.build_val_enqueuer(validation_data, fit_setting)
+        return val_enqueuer, None
+
+    def build_preprocess_pipeline(self,
+                                  output_generator,
+                                  fit_setting: FitSetting,
+                                  data_preprocess=None) -> Optional[PreprocessPipeline]:
+        """
+        data_preprocessを学習と並行して実行するパイプラインを起動する
+        :param output_generator: 学習データのジェネレータ
+        :param fit_setting: 先に前処理しておくバッチ数などの設定
+        :param data_preprocess: 1バッチ分のデータを学習用に変換する関数
+        :return: 起動したパイプライン 前処理がないか無効にしている場合はNone
+        """
+        if data_preprocess is None or fit_setting.preprocess_buffer_size <= 0:
+            return None
+        return PreprocessPipeline(lambda: self.build_one_batch_dataset_with_timing(output_generator, data_preprocess),
+                                  fit_setting.preprocess_buffer_size).start()
+
+    def start_train_feed(self, sequence, fit_setting: FitSetting, data_preprocess=None):
+        """
+        学習データのエンキューと前処理のパイプラインを起動する
+        :return: エンキュー、パイプライン、バッチを取り出すジェネレータ
+        """
+        enqueuer = AutotuneEnqueuer(sequence, fit_setting)
+        enqueuer.start()
+        output_generator = enqueuer.get()
+        preprocess_pipeline = self.build_preprocess_pipeline(output_generator, fit_setting, data_preprocess)
+        if preprocess_pipeline is not None:
+            output_generator = preprocess_pipeline
+        self.__train_pipeline = preprocess_pipeline
+        return enqueuer, preprocess_pipeline, output_generator
+
+    def stop_train_feed(self, enqueuer: Optional[AutotuneEnqueuer], preprocess_pipeline: Optional[PreprocessPipeline]):
+        self.__train_pipeline = None
+        if preprocess_pipeline is not None:
+            preprocess_pipeline.stop()
+        if enqueuer is not None:
+            enqueuer.stop()
 
     def run_one_epoch(self,
                       epoch: int,
@@ -209,28 +491,52 @@ class AbsExpantionEpoch(ABC):
                       output_generator,
                       val_data,
                       validation_steps,
-                      callbacks: CallbackList,
-                      data_preprocess=None):
+                      callbacks: CallbackBus,
+                      data_preprocess=None,
+                      initial_steps: int = 0,
+                      will_validate: bool = True):
         # for m in self.model.stateful_metric_functions:
         #   m.reset_states()
         callbacks.on_epoch_begin(epoch)
-        steps_done = 0
-        batch_index = 0
+        self.step_timer.start_epoch()
+        if isinstance(output_generator, PreprocessPipeline):
+            # 検証でdata_preprocessを呼ぶ間に次のエポックのバッチを前処理しないよう、このエポックの分だけ許可する
+            output_generator.allow(steps_per_epoch - initial_steps)
+        steps_done = initial_steps
+        batch_index = initial_steps
+        has_validated = False
         while steps_done < steps_per_epoch:
             batch_index, steps_done = self.one_batch(output_generator,
                                                      batch_index,
                                                      steps_done,
                                                      callbacks,
                                                      data_preprocess)
+            if steps_done == 1:
+                # エンキューが次のエポック用に並び替える前に並び順を控えておく
+                self.record_epoch_index_array()
+            if steps_done < steps_per_epoch and steps_done % self.accumulation_steps == 0:
+                # 溜めている途中の勾配は保存できないので、パラメータを更新した直後だけ保存する
+                self.save_resume_state(epoch, steps_done, epoch_logs, callbacks)
 
             # Epoch finished.
-            if steps_done >= steps_per_epoch and val_data is not None:
+            if steps_done >= steps_per_epoch:
+                self.finish_epoch_train()
+            if steps_done >= steps_per_epoch and will_validate and val_data is not None:
+                val_start = perf_counter()
                 epoch_logs = self.one_batch_val(val_data,
                                                 validation_steps,
                                                 epoch_logs,
                                                 data_preprocess)
+                self.step_timer.add_epoch_time("validation", perf_counter() - val_start)
+                has_validated = True
 
+        if has_validated is False:
+            # 前回の検証の値が残っていると新しい結果として記録され、EarlyStoppingなどが改善しなかったエポックと数える
+            epoch_logs = {name: value for name, value in epoch_logs.items() if name.startswith("val_") is False}
+
+        epoch_logs = self.step_timer.end_epoch(epoch, epoch_logs)
         callbacks.on_epoch_end(epoch, epoch_logs)
+        self.save_resume_state(epoch + 1, 0, epoch_logs, callbacks, True)
         return epoch+1, epoch_logs
 
     def one_batch_val(self,
@@ -279,29 +585,80 @@ class AbsExpantionEpoch(ABC):
                                     validation_steps: Optional[int] = None,
                                     temp_best_path: str = "",
                                     save_weights_only: bool = False,
-                                    data_preprocess=None):
+                                    data_preprocess=None,
+                                    fit_setting: Optional[FitSetting] = None):
+        use_fit_setting = FitSetting() if fit_setting is None else fit_setting
+        self.set_step_timer(self.build_step_timer(use_fit_setting))
+        self.set_accumulation_steps(use_fit_setting.accumulation_steps)
         steps_per_epoch = steps_per_epoch if steps_per_epoch is None else len(image_generator)
         callbacks, will_validate = self.build_callbacks_for_expantion(epochs,
                                                                       temp_best_path,
                                                                       steps_per_epoch,
                                                                       validation_data,
-                                                                      save_weights_only)
+                                                                      save_weights_only,
+                                                                      use_fit_setting.log_flush_steps)
         callbacks.on_train_begin()
+        self.__train_sequence = image_generator
+        self.__resume_checkpointer = self.build_resume_checkpointer(use_fit_setting)
+        # Construct epoch logs.
+        epoch_logs = {}
+        epoch = 0
+        initial_steps = 0
+        if use_fit_setting.will_resume and self.__resume_checkpointer is not None \
+                and self.__resume_checkpointer.exists():
+            epoch, initial_steps, epoch_logs = self.restore_resume_state(self.__resume_checkpointer.load(),
+                                                                         callbacks,
+                                                                         image_generator)
         enqueuer = None
         val_enqueuer = None
+        preprocess_pipeline = None
         try:
-            val_data, val_enqueuer, validation_steps = self.build_val_enqueuer(validation_data)
-            enqueuer = OrderedEnqueuer(
-                image_generator,
-                use_multiprocessing=False)
-            enqueuer.start(workers=1, max_queue_size=10)
-            output_generator = enqueuer.get()
-
+            val_subset = self.build_val_subset(validation_data, use_fit_setting)
+            val_data, val_enqueuer, validation_steps = self.build_val_enqueuer(
+                validation_data if val_subset is None else val_subset,
+                use_fit_setting)
             self.set_model_stop_training(False)
-            # Construct epoch logs.
-            epoch_logs = {}
-            epoch = 0
+            if initial_steps > 0 and epoch < epochs:
+                val_enqueuer, val_subset = self.prepare_epoch_validation(epoch,
+                                                                         epochs,
+                                                                         validation_data,
+                                                                         val_subset,
+                                                                         val_enqueuer,
+                                                                         use_fit_setting)
+                val_data = val_data if val_enqueuer is None else val_enqueuer
+                # 中断したエポックの残りのバッチだけを読み込む
+                enqueuer, preprocess_pipeline, output_generator = self.start_train_feed(
+                    RemainingSequence(image_generator, initial_steps),
+                    use_fit_setting,
+                    data_preprocess)
+                epoch, epoch_logs = self.run_one_epoch(epoch,
+                                                       epoch_logs,
+                                                       steps_per_epoch,
+                                                       output_generator,
+                                                       val_data,
+                                                       validation_steps,
+                                                       callbacks,
+                                                       data_preprocess,
+                                                       initial_steps,
+                                                       self.is_validation_epoch(epoch,
+                                                                                epochs,
+                                                                                use_fit_setting,
+                                                                                callbacks))
+                self.stop_train_feed(enqueuer, preprocess_pipeline)
+                enqueuer, preprocess_pipeline = None, None
+                image_generator.on_epoch_end()
+            if epoch < epochs:
+                enqueuer, preprocess_pipeline, output_generator = self.start_train_feed(image_generator,
+                                                                                        use_fit_setting,
+                                                                                        data_preprocess)
             while epoch < epochs:
+                val_enqueuer, val_subset = self.prepare_epoch_validation(epoch,
+                                                                         epochs,
+                                                                         validation_data,
+                                                                         val_subset,
+                                                                         val_enqueuer,
+                                                                         use_fit_setting)
+                val_data = val_data if val_enqueuer is None else val_enqueuer
                 epoch, epoch_logs = self.run_one_epoch(epoch,
                                                        epoch_logs,
                                                        steps_per_epoch,
@@ -309,16 +666,21 @@ class AbsExpantionEpoch(ABC):
                                                        val_data,
                                                        validation_steps,
                                                        callbacks,
-                                                       data_preprocess)
+                                                       data_preprocess,
+                                                       will_validate=self.is_validation_epoch(epoch,
+                                                                                              epochs,
+                                                                                              use_fit_setting,
+                                                                                              callbacks))
 
         finally:
 
-            if enqueuer is not None:
-                enqueuer.stop()
-            #finally:
-            #    if val_enqueuer is not None:
-            #        print(type(val_enqueuer))
-            #        val_enqueuer.stop()
+            try:
+                self.stop_train_feed(enqueuer, preprocess_pipeline)
+            finally:
+                if val_enqueuer is not None:
+                    val_enqueuer.stop()
+                self.__resume_checkpointer = None
+                self.__train_sequence = None
 
         callbacks.on_train_end()
         return self.get_model_history()
@@ -1,5 +1,3 @@
-import keras.engine.training
-import keras.callbacks
 import numpy as np
 from typing import List
 from typing import Tuple
@@ -10,13 +8,12 @@ from datetime import datetime
 import json
 from DataIO import data_loader as dl
 from abc import ABC, abstractmethod
-from util.keras_version import is_new_keras
 
 
 class AbstractModel(ABC):
     def __init__(self,
                  class_set: List[str],
-                 callbacks: Optional[List[keras.callbacks.Callback]] = None,
+                 callbacks: Optional[List["keras.callbacks.Callback"]] = None,
                  monitor: str = "",
                  preprocess_for_model=None,
                  after_learned_process: Optional[Callable[[None], None]] = None):
@@ -31,15 +28,24 @@ class AbstractModel(ABC):
         self.__class_set = class_set
         self.__history = None
         self.__callbacks = callbacks
-        self.__monitor = monitor
+        self.__monitor = self.build_monitor(monitor)
         self.__preprocess_for_model = preprocess_for_model
         self.__after_learned_process = after_learned_process
-        if is_new_keras() is False and self.__monitor == "val_accuracy":
-            self.__monitor = "val_acc"
+        self.__feature_cache = None
+
+    def build_monitor(self, monitor: str) -> str:
+        """
+        古いkerasでは正答率の名前がval_accなので、監視する値の名前を合わせる
+        kerasを使わないモデルではkerasをimportしないよう上書きする
+        """
+        from util.keras_version import is_new_keras
+        if is_new_keras() is False and monitor == "val_accuracy":
+            return "val_acc"
+        return monitor
 
     @property
     @abstractmethod
-    def model(self) -> keras.engine.training.Model:
+    def model(self) -> "keras.engine.training.Model":
         pass
 
     @abstractmethod
@@ -62,6 +68,19 @@ class AbstractModel(ABC):
     def monitor(self):
         return self.__monitor
 
+    @property
+    def feature_cache(self):
+        return self.__feature_cache
+
+    def set_feature_cache(self, feature_cache):
+        """
+        入力側の固定したレイヤーの出力を保存し、残りのレイヤーだけを学習させる
+        :param feature_cache: 出力の保存先などの設定 Noneなら毎回全てのレイヤーで計算する
+        :return: 自身
+        """
+        self.__feature_cache = feature_cache
+        return self
+
     def after_learned_process(self):
         if self.__after_learned_process is None:
             return
@@ -167,7 +186,7 @@ class AbstractModel(ABC):
         self.record_model(result_dir_name, dir_path, model_name)
         self.record_conf_json(result_dir_name, dir_path, normalize_type, model_name)
 
-    def run_preprocess_model(self, model: keras.engine.training.Model) -> keras.engine.training.Model:
+    def run_preprocess_model(self, model: "keras.engine.training.Model") -> "keras.engine.training.Model":
         if self.preprocess_for_model is None:
             return model
         return self.preprocess_for_model(model)
@@ -0,0 +1,175 @@
+from typing import Callable
+from typing import List
+from typing import Optional
+import numpy as np
+from network_model.wrapper.callbacks import Progbar
+from network_model.wrapper.callbacks import adapt_callback
+from network_model.wrapper.callbacks import overrides
+
+
+class CallbackBus(object):
+    """
+    独自のエポックループ用のCallbackListの代わり
+    on_batch_begin, on_batch_endは実装しているコールバックにだけ呼び出す
+    kerasのコールバックはアダプタで包んで呼び出す
+    BaseLogger, ProgbarLoggerの代わりにバッチごとの値を確保済みの配列に溜め、flush_stepsごとにまとめて集計、表示する
+    materializeを渡した場合は、GPU上のテンソルなどの値をそのまま溜めておき、flush_stepsごとにまとめてfloatに変換する
+    その場合、変換するステップ以外のbatch_logsには集計対象の値を入れずにコールバックを呼び出す
+    """
+
+    def __init__(self,
+                 callbacks: list,
+                 metric_names: List[str],
+                 stateful_metric_names: Optional[List[str]] = None,
+                 flush_steps: int = 1,
+                 verbose: int = 1,
+                 materialize: Optional[Callable[[List[list]], List[list]]] = None):
+        """
+
+        :param callbacks: ユーザー指定のコールバック
+        :param metric_names: 集計、表示する値の名前
+        :param stateful_metric_names: エポック内の平均ではなく最後の値を使う値の名前
+        :param flush_steps: 集計と進捗表示を行う間隔のステップ数
+        :param verbose: 0なら進捗を表示しない
+        :param materialize: 溜めた値の行のリストを受け取り、floatかNoneの行のリストに変換する関数
+        """
+        self.callbacks = [adapt_callback(callback) for callback in callbacks]
+        self.__metric_names = list(metric_names)
+        self.__stateful = np.array([name in (stateful_metric_names or []) for name in self.__metric_names])
+        self.__flush_steps = max(flush_steps, 1)
+        self.__verbose = verbose
+        self.__batch_begin_callbacks = [callback for callback in self.callbacks
+                                        if overrides(callback, "on_batch_begin")]
+        self.__batch_end_callbacks = [callback for callback in self.callbacks if overrides(callback, "on_batch_end")]
+        self.__window = np.full((self.__flush_steps, len(self.__metric_names)), np.nan)
+        self.__window_sizes = np.zeros(self.__flush_steps)
+        self.__window_index = 0
+        self.__materialize = materialize
+        self.__pending_rows = [[None] * len(self.__metric_names) for _ in range(self.__flush_steps)]
+        self.__params = {}
+        self.__progbar = None
+        self.__reset_epoch()
+
+    def __reset_epoch(self):
+        self.__epoch_totals = np.zeros(len(self.__metric_names))
+        self.__epoch_seen = np.zeros(len(self.__metric_names))
+        self.__epoch_last = np.full(len(self.__metric_names), np.nan)
+        self.__steps_done = 0
+        self.__window_index = 0
+
+    def set_model(self, model):
+        for callback in self.callbacks:
+            callback.set_model(model)
+
+    def set_params(self, params):
+        self.__params = params
+        for callback in self.callbacks:
+            callback.set_params(params)
+
+    def on_train_begin(self, logs=None):
+        logs = logs or {}
+        for callback in self.callbacks:
+            callback.on_train_begin(logs)
+
+    def on_train_end(self, logs=None):
+        logs = logs or {}
+        for callback in self.callbacks:
+            callback.on_train_end(logs)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        logs = logs or {}
+        self.__reset_epoch()
+        if self.__verbose:
+            print('Epoch %d/%d' % (epoch + 1, self.__params.get('epochs', 0)))
+            self.__progbar = Progbar(target=self.__params.get('steps'),
+                                     verbose=self.__verbose,
+                                     stateful_metrics=[name for name, is_stateful
+                                                       in zip(self.__metric_names, self.__stateful) if is_stateful])
+        for callback in self.callbacks:
+            callback.on_epoch_begin(epoch, logs)
+
+    def on_batch_begin(self, batch, logs=None):
+        logs = logs or {}
+        for callback in self.__batch_begin_callbacks:
+            callback.on_batch_begin(batch, logs)
+
+    def on_batch_end(self, batch, logs=None):
+        logs = logs or {}
+        if self.__materialize is None:
+            row = self.__window[self.__window_index]
+            row.fill(np.nan)
+            for index, name in enumerate(self.__metric_names):
+                if name in logs:
+                    row[index] = logs[name]
+        else:
+            pending_row = self.__pending_rows[self.__window_index]
+            for index, name in enumerate(self.__metric_names):
+                pending_row[index] = logs.pop(name, None)
+        self.__window_sizes[self.__window_index] = logs.get('size', 1)
+        self.__window_index += 1
+        self.__steps_done += 1
+        if self.__window_index >= self.__flush_steps:
+            last_row = self.flush()
+            if self.__materialize is not None:
+                logs.update({name: last_row[index] for index, name in enumerate(self.__metric_names)
+                             if not np.isnan(last_row[index])})
+        for callback in self.__batch_end_callbacks:
+            callback.on_batch_end(batch, logs)
+
+    def materialize_pending_rows(self):
+        """
+        溜めておいた値をまとめてfloatに変換して集計用の配列に書き込む
+        """
+        rows = self.__materialize(self.__pending_rows[:self.__window_index])
+        for row_index, row in enumerate(rows):
+            self.__window[row_index] = [np.nan if value is None else value for value in row]
+            self.__pending_rows[row_index] = [None] * len(self.__metric_names)
+
+    def flush(self):
+        """
+        溜めた値をエポックの集計に加え、進捗表示を更新する
+        :return: 最後のステップの値
+        """
+        if self.__window_index == 0:
+            return None
+        if self.__materialize is not None:
+            self.materialize_pending_rows()
+        window = self.__window[:self.__window_index]
+        sizes = self.__window_sizes[:self.__window_index]
+        has_values = ~np.isnan(window)
+        weighted = np.where(has_values, window, 0) * sizes[:, None]
+        seen = (has_values * sizes[:, None]).sum(axis=0)
+        self.__epoch_totals += weighted.sum(axis=0)
+        self.__epoch_seen += seen
+        last_indices = np.where(has_values.any(axis=0),
+                                has_values.shape[0] - 1 - np.argmax(has_values[::-1], axis=0),
+                                -1)
+        for index, last_index in enumerate(last_indices):
+            if last_index >= 0:
+                self.__epoch_last[index] = window[last_index, index]
+        if self.__progbar is not None:
+            values = []
+            for index, name in enumerate(self.__metric_names):
+                if seen[index] == 0:
+                    continue
+                values.append((name, self.__epoch_last[index] if self.__stateful[index]
+                               else weighted[:, index].sum() / seen[index]))
+            self.__progbar.update(self.__steps_done, values)
+        last_row = window[-1].copy()
+        self.__window_index = 0
+        return last_row
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.flush()
+        logs = logs if logs is not None else {}
+        for index, name in enumerate(self.__metric_names):
+            if self.__epoch_seen[index] == 0:
+                continue
+            logs[name] = self.__epoch_last[index] if self.__stateful[index] \
+                else self.__epoch_totals[index] / self.__epoch_seen[index]
+        if self.__progbar is not None:
+            self.__progbar.update(self.__steps_done,
+                                  [(name, logs[name]) for index, name in enumerate(self.__metric_names)
+                                   if name in logs and self.__epoch_seen[index] == 0])
+        for callback in self.callbacks:
+            callback.on_epoch_end(epoch, logs)
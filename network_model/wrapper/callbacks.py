@@ -0,0 +1,253 @@
+import sys
+import time
+from typing import List
+from typing import Optional
+
+
+def to_list(x) -> list:
+    if isinstance(x, list):
+        return x
+    return [x]
+
+
+class Callback(object):
+    """
+    kerasに依存しないコールバックの基底クラス kerasのCallbackと同じメソッドを持つので、kerasのfitにも渡せる
+    """
+    validation_data = None
+    model = None
+    params = None
+
+    def set_params(self, params):
+        self.params = params
+
+    def set_model(self, model):
+        self.model = model
+
+    def on_epoch_begin(self, epoch, logs=None):
+        pass
+
+    def on_epoch_end(self, epoch, logs=None):
+        pass
+
+    def on_batch_begin(self, batch, logs=None):
+        pass
+
+    def on_batch_end(self, batch, logs=None):
+        pass
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.on_batch_begin(batch, logs=logs)
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.on_batch_end(batch, logs=logs)
+
+    def on_test_batch_begin(self, batch, logs=None):
+        pass
+
+    def on_test_batch_end(self, batch, logs=None):
+        pass
+
+    def on_predict_batch_begin(self, batch, logs=None):
+        pass
+
+    def on_predict_batch_end(self, batch, logs=None):
+        pass
+
+    def on_train_begin(self, logs=None):
+        pass
+
+    def on_train_end(self, logs=None):
+        pass
+
+    def on_test_begin(self, logs=None):
+        pass
+
+    def on_test_end(self, logs=None):
+        pass
+
+    def on_predict_begin(self, logs=None):
+        pass
+
+    def on_predict_end(self, logs=None):
+        pass
+
+
+# tf.kerasのコールバックでバッチごとのイベントを受け取るメソッドの名前
+TRAIN_BATCH_METHODS = {"on_batch_begin": "on_train_batch_begin", "on_batch_end": "on_train_batch_end"}
+
+
+class CallbackAdapter(object):
+    """
+    kerasなど外部のコールバックを独自のエポックループから呼び出すためのアダプタ
+    コールバックのモジュールをimportせずに扱えるよう、メソッドの呼び出しと属性の読み書きをそのまま転送する
+    バッチごとのイベントは、tf.kerasのon_train_batch_begin, on_train_batch_endだけを上書きしている場合はそちらに転送する
+    """
+
+    def __init__(self, callback):
+        self.__dict__["callback"] = callback
+        self.__dict__["batch_method_names"] = {name: train_name if self.is_overridden(train_name) else name
+                                               for name, train_name in TRAIN_BATCH_METHODS.items()}
+
+    def is_overridden(self, method_name: str) -> bool:
+        """
+        元のコールバックが基底クラスのメソッドを上書きしているかどうか
+        基底クラスが見つからない場合は上書きしているものとして扱う
+        """
+        callback_type = type(self.callback)
+        if getattr(callback_type, method_name, None) is None:
+            return False
+        base = next((base for base in callback_type.__mro__[1:] if base.__name__ == "Callback"), None)
+        if base is None:
+            return True
+        return getattr(callback_type, method_name, None) is not getattr(base, method_name, None)
+
+    def overrides(self, method_name: str) -> bool:
+        """
+        元のコールバックがイベントを受け取るかどうか バッチごとのイベントはtf.kerasの名前のメソッドの上書きも含める
+        """
+        if self.is_overridden(method_name):
+            return True
+        return method_name in TRAIN_BATCH_METHODS and self.is_overridden(TRAIN_BATCH_METHODS[method_name])
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["callback"], name)
+
+    def __setattr__(self, name, value):
+        setattr(self.callback, name, value)
+
+    def set_params(self, params):
+        self.callback.set_params(params)
+
+    def set_model(self, model):
+        self.callback.set_model(model)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.callback.on_epoch_begin(epoch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.callback.on_epoch_end(epoch, logs)
+
+    def on_batch_begin(self, batch, logs=None):
+        getattr(self.callback, self.batch_method_names["on_batch_begin"])(batch, logs)
+
+    def on_batch_end(self, batch, logs=None):
+        getattr(self.callback, self.batch_method_names["on_batch_end"])(batch, logs)
+
+    def on_train_begin(self, logs=None):
+        self.callback.on_train_begin(logs)
+
+    def on_train_end(self, logs=None):
+        self.callback.on_train_end(logs)
+
+
+def adapt_callback(callback):
+    """
+    独自のコールバックはそのまま、それ以外はアダプタで包んで返す
+    """
+    if isinstance(callback, (Callback, CallbackAdapter)):
+        return callback
+    return CallbackAdapter(callback)
+
+
+def overrides(callback, method_name: str) -> bool:
+    if isinstance(callback, CallbackAdapter):
+        return callback.overrides(method_name)
+    return getattr(type(callback), method_name, None) is not getattr(Callback, method_name, None)
+
+
+class History(Callback):
+    """
+    エポックごとの記録を残すコールバック
+    """
+
+    def __init__(self):
+        self.epoch = []
+        self.history = {}
+
+    def on_train_begin(self, logs=None):
+        self.epoch = []
+        self.history = {}
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        self.epoch.append(epoch)
+        for name, value in logs.items():
+            self.history.setdefault(name, []).append(value)
+
+
+class Progbar(object):
+    """
+    ステップ数と値の平均を1行で表示する進捗バー
+    stateful_metricsの値は平均せずに最後の値を表示する
+    """
+
+    def __init__(self,
+                 target: Optional[int],
+                 width: int = 30,
+                 verbose: int = 1,
+                 stateful_metrics: Optional[List[str]] = None):
+        """
+
+        :param target: 全ステップ数 不明ならNone
+        :param width: バーの幅
+        :param verbose: 0なら表示しない 1なら同じ行を更新し、2なら最後にだけ表示する
+        :param stateful_metrics: 平均しない値の名前
+        """
+        self.__target = target
+        self.__width = width
+        self.__verbose = verbose
+        self.__stateful_metrics = set(stateful_metrics or [])
+        self.__values = {}
+        self.__value_names = []
+        self.__seen = 0
+        self.__start = time.time()
+        self.__previous_width = 0
+
+    def update(self, current: int, values=None):
+        """
+
+        :param current: 現在のステップ数
+        :param values: 名前と値のタプルのリスト 平均する値は前回の更新からのステップ数で重み付けする
+        """
+        step_num = max(current - self.__seen, 1)
+        for name, value in values or []:
+            if name not in self.__values:
+                self.__value_names.append(name)
+            if name in self.__stateful_metrics:
+                self.__values[name] = [value, 1]
+                continue
+            total, count = self.__values.get(name, [0., 0])
+            self.__values[name] = [total + value * step_num, count + step_num]
+        self.__seen = current
+        is_finished = self.__target is not None and current >= self.__target
+        if self.__verbose == 0 or (self.__verbose == 2 and is_finished is False):
+            return
+        elapsed = time.time() - self.__start
+        line = self.build_bar(current)
+        if is_finished:
+            line += " - %ds" % elapsed
+        elif self.__target is not None and current > 0:
+            line += " - ETA: %ds" % (elapsed / current * (self.__target - current))
+        for name in self.__value_names:
+            total, count = self.__values[name]
+            line += " - %s: %.4f" % (name, total / max(count, 1))
+        if self.__verbose == 1:
+            padding = " " * max(self.__previous_width - len(line), 0)
+            sys.stdout.write("\r" + line + padding)
+            self.__previous_width = len(line)
+            if is_finished:
+                sys.stdout.write("\n")
+        else:
+            sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+    def build_bar(self, current: int) -> str:
+        if self.__target is None:
+            return "%7d/Unknown" % current
+        digits = len(str(self.__target))
+        done_width = int(self.__width * min(current / max(self.__target, 1), 1.))
+        bar = "=" * done_width
+        if current < self.__target and done_width < self.__width:
+            bar = bar[:-1] + ">" if done_width > 0 else ">"
+        return "%*d/%d [%s]" % (digits, current, self.__target, bar.ljust(self.__width, "."))
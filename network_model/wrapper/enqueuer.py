@@ -0,0 +1,419 @@
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import numpy as np
+from network_model.wrapper.fit_setting import FitSetting
+from network_model.wrapper.sequence import Sequence
+from util.runtime_config import RuntimeConfig
+from util.runtime_config import get_runtime_config
+
+_worker_sequence = None
+
+
+def init_worker_sequence(sequence):
+    global _worker_sequence
+    _worker_sequence = sequence
+
+
+def get_worker_batch(index: int):
+    return _worker_sequence[index]
+
+
+class OrderedEnqueuer(object):
+    """
+    Sequenceのバッチを複数のワーカーで並行して読み込み、順番通りに返す
+    kerasのOrderedEnqueuerと同じく、1エポック分を読み込んで取り出され終わるとon_epoch_endを呼び、次のエポックを読み込み続ける
+    ワーカーはuse_multiprocessingならプロセス、そうでなければスレッドで、並び替えを反映するためエポックごとに作り直す
+    set_workersでワーカー数を変えると、次に読み込むバッチから作り直したワーカーで読み込む
+    """
+
+    def __init__(self, sequence, use_multiprocessing: bool = False):
+        """
+
+        :param sequence: 読み込み対象のSequence
+        :param use_multiprocessing: Trueならプロセス、Falseならスレッドで読み込む
+        """
+        self.sequence = sequence
+        self.use_multiprocessing = use_multiprocessing
+        self.queue = None
+        self.last_wait_time = 0.
+        self.__workers = 1
+        self.__stop_event = None
+        self.__thread = None
+
+    def is_running(self) -> bool:
+        return self.__stop_event is not None and self.__stop_event.is_set() is False
+
+    def start(self, workers: int = 1, max_queue_size: int = 10):
+        self.__workers = max(workers, 1)
+        self.queue = queue.Queue(max_queue_size)
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, args=(self.__stop_event, self.queue), daemon=True)
+        self.__thread.start()
+
+    def set_workers(self, workers: int):
+        self.__workers = max(workers, 1)
+
+    def build_executor(self, workers: int):
+        if self.use_multiprocessing:
+            return ProcessPoolExecutor(workers, initializer=init_worker_sequence, initargs=(self.sequence,))
+        return ThreadPoolExecutor(workers)
+
+    def submit(self, executor, index: int) -> Future:
+        if self.use_multiprocessing:
+            return executor.submit(get_worker_batch, index)
+        return executor.submit(self.sequence.__getitem__, index)
+
+    @staticmethod
+    def put(stop_event: threading.Event, output_queue: queue.Queue, future: Future) -> bool:
+        while stop_event.is_set() is False:
+            try:
+                output_queue.put(future, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __run(self, stop_event: threading.Event, output_queue: queue.Queue):
+        while stop_event.is_set() is False:
+            executor_workers = self.__workers
+            executor = self.build_executor(executor_workers)
+            try:
+                for index in range(len(self.sequence)):
+                    if executor_workers != self.__workers:
+                        # 読み込み中のバッチは元のワーカーで読み終えるので、順番とエポック内の位置は変わらない
+                        executor.shutdown(wait=False)
+                        executor_workers = self.__workers
+                        executor = self.build_executor(executor_workers)
+                    if self.put(stop_event, output_queue, self.submit(executor, index)) is False:
+                        return
+                # 並び替える前に、このエポックのバッチが全て取り出されるのを待つ
+                while output_queue.unfinished_tasks > 0:
+                    if stop_event.wait(0.01):
+                        return
+            finally:
+                executor.shutdown(wait=stop_event.is_set() is False)
+            self.sequence.on_epoch_end()
+
+    def count_ready(self) -> int:
+        """
+        キューに入っているバッチのうち読み込みが終わっている数
+        """
+        with self.queue.mutex:
+            return sum([future.done() for future in self.queue.queue])
+
+    def get(self):
+        """
+        読み込んだバッチを順番に返すジェネレータ
+        バッチの読み込みを待った時間をlast_wait_timeに記録する
+        """
+        wait_start = time.perf_counter()
+        while self.is_running():
+            try:
+                future = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                batch = future.result()
+            except Exception:
+                self.stop()
+                raise
+            self.last_wait_time = time.perf_counter() - wait_start
+            self.queue.task_done()
+            if batch is not None:
+                yield batch
+            wait_start = time.perf_counter()
+
+    def stop(self, timeout: float = None):
+        if self.__stop_event is None:
+            return
+        self.__stop_event.set()
+        with self.queue.mutex:
+            self.queue.queue.clear()
+            self.queue.unfinished_tasks = 0
+            self.queue.not_full.notify()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+        self.__thread = None
+
+
+class PinnedSequence(Sequence):
+    """
+    バッチを読み込んだワーカーのスレッドを、実行時設定で役割に割り当てたコアに固定するSequence
+    ワーカーがプロセスの場合も同じ設定で固定できるよう、設定を持たせておく
+    """
+
+    def __init__(self, sequence, runtime_config: RuntimeConfig, role: str = "decode"):
+        self.__sequence = sequence
+        self.__runtime_config = runtime_config
+        self.__role = role
+
+    def __len__(self):
+        return len(self.__sequence)
+
+    def __getitem__(self, idx):
+        self.__runtime_config.pin_current_thread(self.__role)
+        return self.__sequence[idx]
+
+    def on_epoch_end(self):
+        self.__sequence.on_epoch_end()
+
+
+def pin_loader_sequence(sequence, role: str = "decode"):
+    """
+    実行時設定でコアを固定する場合は、読み込むワーカーを固定するSequenceで包む
+    """
+    runtime_config = get_runtime_config()
+    if runtime_config is None or runtime_config.will_pin_cores is False:
+        return sequence
+    return PinnedSequence(sequence, runtime_config, role)
+
+
+def get_max_loader_workers() -> int:
+    """
+    エンキューのワーカー数の上限 実行時設定があれば読み込みに割り当てたワーカー数、なければコア数
+    """
+    runtime_config = get_runtime_config()
+    return os.cpu_count() if runtime_config is None else runtime_config.decode_workers
+
+
+class AutotuneEnqueuer(object):
+    """
+    OrderedEnqueuerのワーカー数をFitSettingに従って設定し、必要なら自動で調整する
+    調整する場合は最初のautotune_stepsの間、バッチの読み込みを待った時間の割合を計測し、
+    待ちが多ければワーカーを増やし、取り出す時点でキューが読み込み済みのバッチで常に満杯なら減らす
+    キューには読み込み中のバッチも入るので、キューの長さではなく読み込みが終わっているかで判断する
+    ワーカー数を変えてもエンキューは再起動せず、エポックの続きのバッチから新しいワーカー数で読み込む
+    """
+
+    def __init__(self,
+                 sequence,
+                 fit_setting: FitSetting,
+                 wait_rate_threshold: float = 0.05):
+        """
+
+        :param sequence: 読み込み対象のSequence
+        :param fit_setting: ワーカー数などの設定
+        :param wait_rate_threshold: ステップの時間のうち読み込みを待った割合がこれを超えるとワーカーを増やす
+        """
+        self.__enqueuer = OrderedEnqueuer(pin_loader_sequence(sequence),
+                                          use_multiprocessing=fit_setting.use_multiprocessing)
+        self.__fit_setting = fit_setting
+        self.__workers = fit_setting.workers
+        self.__max_workers = get_max_loader_workers() if fit_setting.max_workers is None else fit_setting.max_workers
+        self.__wait_rate_threshold = wait_rate_threshold
+        self.__steps_done = 0
+        self.__wait_time = 0.
+        self.__window_start = None
+        self.__full_count = 0
+
+    @property
+    def workers(self) -> int:
+        return self.__workers
+
+    @property
+    def is_tuning(self) -> bool:
+        return self.__steps_done < self.__fit_setting.autotune_steps
+
+    def is_running(self) -> bool:
+        return self.__enqueuer.is_running()
+
+    def start(self):
+        self.__enqueuer.start(workers=self.__workers, max_queue_size=self.__fit_setting.max_queue_size)
+        return self
+
+    def stop(self):
+        self.__enqueuer.stop()
+
+    def record_queue_state(self):
+        if self.__window_start is None:
+            self.__window_start = time.perf_counter()
+        max_queue_size = self.__enqueuer.queue.maxsize
+        if max_queue_size > 0 and self.__enqueuer.count_ready() >= max_queue_size:
+            self.__full_count += 1
+
+    def record_wait_time(self):
+        self.__wait_time += self.__enqueuer.last_wait_time
+
+    def decide_workers(self) -> int:
+        window = self.__fit_setting.autotune_window
+        elapsed = time.perf_counter() - self.__window_start
+        wait_rate = self.__wait_time / elapsed if elapsed > 0 else 0.
+        full_rate = self.__full_count / window
+        self.__wait_time = 0.
+        self.__window_start = None
+        self.__full_count = 0
+        print("enqueuer workers", self.__workers, "data wait rate", wait_rate, "ready queue full rate", full_rate)
+        if wait_rate > self.__wait_rate_threshold and self.__workers < self.__max_workers:
+            return min(self.__max_workers, self.__workers + max(1, self.__workers // 2))
+        if full_rate >= 1.0 and self.__workers > 1:
+            return self.__workers - 1
+        return self.__workers
+
+    def change_workers(self, workers: int):
+        print("change enqueuer workers to", workers)
+        self.__workers = workers
+        self.__enqueuer.set_workers(workers)
+
+    def get(self):
+        output_generator = self.__enqueuer.get()
+        while True:
+            will_tune = self.is_tuning
+            if will_tune:
+                self.record_queue_state()
+            try:
+                batch = next(output_generator)
+            except StopIteration:
+                return
+            if will_tune:
+                self.record_wait_time()
+            yield batch
+            self.__steps_done += 1
+            if will_tune and self.__steps_done % self.__fit_setting.autotune_window == 0:
+                workers = self.decide_workers()
+                if workers != self.__workers:
+                    self.change_workers(workers)
+
+
+class PrefetchFeeder(object):
+    """
+    検証データを学習中から先読みし続けるための常駐エンキュー
+    OrderedEnqueuerは一度起動すればSequenceを繰り返し読み込むので、学習開始時に起動しておけば
+    キューに溜まった分の検証データはエポックの最後の学習ステップを実行している間に読み込み済みになる
+    next()で1バッチずつ取り出せ、len()で1回の検証のステップ数を返す
+    """
+
+    def __init__(self,
+                 sequence,
+                 workers: int = 1,
+                 max_queue_size: int = 10,
+                 use_multiprocessing: bool = False):
+        """
+
+        :param sequence: 検証データのSequence
+        :param workers: 先読みするワーカー数
+        :param max_queue_size: 先読みしたバッチを溜めておくキューの長さ
+        :param use_multiprocessing: Trueならプロセス、Falseならスレッドで読み込む
+        """
+        self.__sequence = sequence
+        self.__enqueuer = OrderedEnqueuer(pin_loader_sequence(sequence), use_multiprocessing=use_multiprocessing)
+        self.__workers = workers
+        self.__max_queue_size = max_queue_size
+        self.__output_generator = None
+
+    def is_running(self) -> bool:
+        return self.__enqueuer.is_running()
+
+    def start(self):
+        self.__enqueuer.start(workers=self.__workers, max_queue_size=self.__max_queue_size)
+        self.__output_generator = self.__enqueuer.get()
+        return self
+
+    def stop(self):
+        self.__enqueuer.stop()
+        self.__output_generator = None
+
+    def __len__(self):
+        return len(self.__sequence)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.__output_generator)
+
+
+class PreprocessPipeline(object):
+    """
+    1バッチ分の読み込みとdata_preprocessを別スレッドで1つ先に実行しておくパイプライン
+    バッチiを学習している間にバッチi+1の前処理を行う
+    前処理は1つのスレッドで順番に実行するので、各バッチの結果と順序は同じスレッドで実行した場合と変わらない
+    allowで許可した数のバッチだけを前処理するので、エポックごとに許可すればエポックの後の検証と前処理は並行せず、
+    乱数を使う前処理でも同じスレッドで実行した場合と同じ順に乱数を引く
+    random_stateは取り出したバッチを前処理し終えた時点の乱数の状態で、学習を再開するための状態の保存に使う
+    """
+
+    def __init__(self,
+                 build_batch: Callable[[], tuple],
+                 buffer_size: int = 1):
+        """
+
+        :param build_batch: 前処理済みの1バッチを返す関数
+        :param buffer_size: 前処理を済ませて待機させておくバッチ数 1なら作成中のものと合わせてダブルバッファになる
+        """
+        self.__build_batch = build_batch
+        self.__queue = queue.Queue(maxsize=buffer_size)
+        self.__stop_event = threading.Event()
+        self.__thread = None
+        self.__allowed = threading.Condition()
+        self.__allowed_num = 0
+        self.random_state = None
+
+    def is_running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def allow(self, batch_num: int):
+        """
+        batch_num個のバッチの前処理を許可する
+        """
+        with self.__allowed:
+            self.__allowed_num += batch_num
+            self.__allowed.notify()
+
+    def __wait_allowed(self) -> bool:
+        with self.__allowed:
+            while self.__allowed_num <= 0:
+                if self.__stop_event.is_set():
+                    return False
+                self.__allowed.wait(0.1)
+            self.__allowed_num -= 1
+            return True
+
+    def start(self):
+        self.__stop_event.clear()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self, timeout: float = 1.0):
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+        self.__thread = None
+
+    def __put(self, item) -> bool:
+        while self.__stop_event.is_set() is False:
+            try:
+                self.__queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __run(self):
+        runtime_config = get_runtime_config()
+        if runtime_config is not None:
+            runtime_config.pin_current_thread("augment")
+        while self.__wait_allowed():
+            try:
+                item = (True, self.__build_batch(), (random.getstate(), np.random.get_state()))
+            except Exception as e:
+                item = (False, e, None)
+            if self.__put(item) is False or item[0] is False:
+                return
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        succeeded, item, random_state = self.__queue.get()
+        if succeeded:
+            self.random_state = random_state
+            return item
+        raise item
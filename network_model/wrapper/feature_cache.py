@@ -0,0 +1,293 @@
+import os
+import json
+import hashlib
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+import numpy as np
+from network_model.wrapper.sequence import Sequence
+from network_model.wrapper.sequence import is_sequence
+from network_model.wrapper.resume import atomic_write
+
+AUGMENTATION_ATTRIBUTES = ("rotation_range",
+                           "width_shift_range",
+                           "height_shift_range",
+                           "shear_range",
+                           "channel_shift_range",
+                           "horizontal_flip",
+                           "vertical_flip")
+
+DATASET_SETTING_ATTRIBUTES = ("image_shape", "class_mode", "class_indices", "interpolation", "color", "img_resize_val")
+
+
+def has_augmentation(data) -> bool:
+    """
+    データがランダムな水増しをしているかどうか
+    ImageDataGeneratorの設定が読めないデータは、パスの一覧を持つ水増ししないローダー以外は水増ししているものとして扱う
+    """
+    image_generator = getattr(data, "image_data_generator", None)
+    if image_generator is None:
+        return getattr(data, "data_paths", None) is None
+    if any([getattr(image_generator, name, 0) for name in AUGMENTATION_ATTRIBUTES]):
+        return True
+    zoom_range = getattr(image_generator, "zoom_range", [1., 1.])
+    if zoom_range[0] != 1 or zoom_range[1] != 1:
+        return True
+    return getattr(image_generator, "brightness_range", None) is not None or \
+        getattr(image_generator, "preprocessing_function", None) is not None
+
+
+def can_iterate_in_order(data) -> bool:
+    if hasattr(data, "_get_batches_of_transformed_samples") and hasattr(data, "n"):
+        return True
+    return is_sequence(data) and getattr(data, "data_paths", None) is not None
+
+
+def iter_ordered_batches(data) -> Iterator[tuple]:
+    """
+    シャッフルせずにデータの並び順にバッチを返す
+    """
+    if hasattr(data, "_get_batches_of_transformed_samples"):
+        for start in range(0, data.n, data.batch_size):
+            yield data._get_batches_of_transformed_samples(np.arange(start, min(start + data.batch_size, data.n)))
+        return
+    for index in range(len(data)):
+        yield data[index]
+
+
+def count_data(data) -> int:
+    return data.n if hasattr(data, "n") else len(data.data_paths)
+
+
+def update_digest(digest, value):
+    if isinstance(value, np.ndarray):
+        digest.update(value.tobytes())
+        return
+    digest.update(repr(value).encode("utf8"))
+
+
+def build_dataset_fingerprint(data) -> Optional[str]:
+    """
+    データのファイルの一覧と更新日時、読み込みの設定からデータセットを識別する値を作る
+    ファイルの一覧を持たないデータではNone
+    """
+    paths = getattr(data, "filepaths", None)
+    if paths is None:
+        paths = getattr(data, "data_paths", None)
+    if paths is None:
+        return None
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(("%s:%d:%d\n" % (path, stat.st_size, stat.st_mtime_ns)).encode("utf8"))
+    update_digest(digest, getattr(data, "data_classes", None))
+    for name in DATASET_SETTING_ATTRIBUTES:
+        update_digest(digest, getattr(data, name, None))
+    image_generator = getattr(data, "image_data_generator", None)
+    if image_generator is not None:
+        for name, value in sorted(vars(image_generator).items()):
+            if isinstance(value, (bool, int, float, str, tuple, list, np.ndarray)) or value is None:
+                update_digest(digest, name)
+                update_digest(digest, value)
+    return digest.hexdigest()
+
+
+class CachedFeatureSequence(Sequence):
+    """
+    保存した特徴量とラベルをメモリマップで読み込み、バッチにして返すSequence
+    バッチ内のインデックスは並べ替えてから読むので、シャッフルしてもファイルを先頭から順に読む形になる
+    classesと_get_batches_of_transformed_samplesを持つので、検証データの一部だけを使う場合にも渡せる
+    """
+
+    def __init__(self,
+                 features_path: str,
+                 labels_path: str,
+                 batch_size: int,
+                 shuffle: bool = True,
+                 seed: Optional[int] = None):
+        """
+
+        :param features_path: 特徴量を保存したnpyファイルのパス
+        :param labels_path: ラベルを保存したnpyファイルのパス
+        :param batch_size: バッチサイズ
+        :param shuffle: Trueならエポックごとに順番をシャッフルする
+        :param seed: シャッフルの乱数のシード
+        """
+        self.__features_path = features_path
+        self.__labels_path = labels_path
+        self.__batch_size = batch_size
+        self.__shuffle = shuffle
+        self.__random_state = np.random.RandomState(seed)
+        self.__features = None
+        self.__labels = None
+        self.__index_array = np.arange(len(self.features))
+        if shuffle:
+            self.__random_state.shuffle(self.__index_array)
+
+    @property
+    def features(self) -> np.ndarray:
+        if self.__features is None:
+            self.__features = np.load(self.__features_path, mmap_mode="r")
+        return self.__features
+
+    @property
+    def labels(self) -> np.ndarray:
+        if self.__labels is None:
+            self.__labels = np.load(self.__labels_path, mmap_mode="r")
+        return self.__labels
+
+    @property
+    def batch_size(self) -> int:
+        return self.__batch_size
+
+    @property
+    def n(self) -> int:
+        return len(self.__index_array)
+
+    @property
+    def classes(self) -> np.ndarray:
+        labels = np.asarray(self.labels)
+        return np.argmax(labels, axis=1) if labels.ndim > 1 else labels.astype(int)
+
+    def __getstate__(self):
+        # プロセスで読み込む場合にメモリマップの中身をコピーして渡さないよう、各プロセスで開き直す
+        state = self.__dict__.copy()
+        state["_CachedFeatureSequence__features"] = None
+        state["_CachedFeatureSequence__labels"] = None
+        return state
+
+    def __len__(self):
+        return (self.n + self.__batch_size - 1) // self.__batch_size
+
+    def _get_batches_of_transformed_samples(self, index_array):
+        sorted_index = np.sort(index_array)
+        return np.asarray(self.features[sorted_index]), np.asarray(self.labels[sorted_index])
+
+    def __getitem__(self, idx):
+        return self._get_batches_of_transformed_samples(
+            self.__index_array[self.__batch_size * idx:self.__batch_size * (idx + 1)])
+
+    def on_epoch_end(self):
+        if self.__shuffle:
+            self.__random_state.shuffle(self.__index_array)
+
+
+class FeatureCache(object):
+    """
+    入力側の固定したレイヤーの出力をデータセット全体について1度だけ計算してnpyファイルに保存し、
+    以降のエポックでは保存した出力を入力にして、固定していない残りのレイヤーだけを学習させる
+    保存先のファイルは固定したレイヤーの重みとデータセットから決めるので、同じ条件で学習し直す場合は計算し直さない
+    ランダムな水増しをしているデータでは毎回出力が変わるので保存せず、通常通り毎回計算する
+    固定したレイヤーの扱いはフレームワークごとのFrozenPrefixに任せ、
+    build_hash()で重みを識別する値を、predict(x)で固定したレイヤーの出力を返すものを渡す
+    """
+
+    def __init__(self, cache_dir: str, seed: Optional[int] = None):
+        """
+
+        :param cache_dir: 特徴量を保存するディレクトリ
+        :param seed: 学習データをシャッフルする乱数のシード
+        """
+        self.__cache_dir = cache_dir
+        self.__seed = seed
+
+    @property
+    def cache_dir(self) -> str:
+        return self.__cache_dir
+
+    @staticmethod
+    def can_cache(data) -> bool:
+        if data is None or isinstance(data, tuple):
+            print("feature cache is disabled because the data is not a generator")
+            return False
+        if has_augmentation(data):
+            print("feature cache is disabled because the data is augmented")
+            return False
+        if can_iterate_in_order(data) is False or build_dataset_fingerprint(data) is None:
+            print("feature cache is disabled because the data can not be read in order")
+            return False
+        return True
+
+    def build_key(self, frozen_prefix, data, data_preprocess=None) -> str:
+        digest = hashlib.sha1()
+        digest.update(frozen_prefix.build_hash().encode("utf8"))
+        digest.update(build_dataset_fingerprint(data).encode("utf8"))
+        if data_preprocess is not None:
+            digest.update(getattr(data_preprocess, "__qualname__", type(data_preprocess).__name__).encode("utf8"))
+        return digest.hexdigest()[:16]
+
+    def build_paths(self, key: str) -> Tuple[str, str, str]:
+        return os.path.join(self.__cache_dir, key + "_features.npy"), \
+               os.path.join(self.__cache_dir, key + "_labels.npy"), \
+               os.path.join(self.__cache_dir, key + ".json")
+
+    def store(self, frozen_prefix, data, key: str, data_preprocess=None) -> bool:
+        """
+        固定したレイヤーの出力とラベルを並び順に計算して保存する 保存済みなら何もしない
+        書き込みが終わってから目印のjsonを書くので、途中で中断したファイルは使わない
+        :return: 保存できたかどうか
+        """
+        features_path, labels_path, meta_path = self.build_paths(key)
+        if os.path.exists(meta_path):
+            print("use cached features", features_path)
+            return True
+        os.makedirs(self.__cache_dir, exist_ok=True)
+        temp_features_path = features_path + ".%d.tmp.npy" % os.getpid()
+        temp_labels_path = labels_path + ".%d.tmp.npy" % os.getpid()
+        data_num = count_data(data)
+        features = None
+        labels = None
+        offset = 0
+        print("build feature cache", features_path)
+        for batch in iter_ordered_batches(data):
+            x, y = batch[:2] if data_preprocess is None else data_preprocess(*batch[:2])
+            outputs = frozen_prefix.predict(x)
+            y = np.asarray(y)
+            if features is None:
+                features = np.lib.format.open_memmap(temp_features_path,
+                                                     mode="w+",
+                                                     dtype=outputs.dtype,
+                                                     shape=(data_num,) + outputs.shape[1:])
+                labels = np.lib.format.open_memmap(temp_labels_path,
+                                                   mode="w+",
+                                                   dtype=y.dtype,
+                                                   shape=(data_num,) + y.shape[1:])
+            features[offset:offset + len(outputs)] = outputs
+            labels[offset:offset + len(outputs)] = y
+            offset += len(outputs)
+        if features is None:
+            return False
+        features.flush()
+        labels.flush()
+        del features, labels
+        os.replace(temp_features_path, features_path)
+        os.replace(temp_labels_path, labels_path)
+
+        def write_meta(file_path: str):
+            with open(file_path, "w") as fw:
+                json.dump({"data_num": offset}, fw)
+        atomic_write(meta_path, write_meta)
+        return True
+
+    def build_sequence(self,
+                       frozen_prefix,
+                       data,
+                       shuffle: bool,
+                       data_preprocess=None,
+                       sequence_type=CachedFeatureSequence) -> Optional[CachedFeatureSequence]:
+        """
+        データを保存した特徴量から読み込むSequenceに置き換える
+        :param frozen_prefix: 固定したレイヤー
+        :param data: flow_from_directoryで作ったデータなど
+        :param shuffle: Trueならエポックごとにシャッフルする
+        :param data_preprocess: 固定したレイヤーに入力する前にバッチに行う処理
+        :param sequence_type: 返すSequenceのクラス kerasのfitに渡す場合はkerasのSequenceを継承したものを渡す
+        :return: 置き換えたSequence 保存できないデータならNone
+        """
+        if self.can_cache(data) is False:
+            return None
+        key = self.build_key(frozen_prefix, data, data_preprocess)
+        if self.store(frozen_prefix, data, key, data_preprocess) is False:
+            return None
+        features_path, labels_path, _ = self.build_paths(key)
+        return sequence_type(features_path, labels_path, data.batch_size, shuffle, self.__seed)
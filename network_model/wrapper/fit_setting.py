@@ -0,0 +1,189 @@
+import copy
+import os
+from typing import Optional
+
+
+class FitSetting(object):
+    """
+    fit_generator及び独自のエポックループ(fit_generator_for_expantion)の動作設定
+    """
+
+    def __init__(self,
+                 workers: int = 1,
+                 use_multiprocessing: bool = False,
+                 max_queue_size: int = 10,
+                 autotune_steps: int = 0,
+                 autotune_window: int = 20,
+                 max_workers: Optional[int] = None,
+                 val_workers: int = 1,
+                 val_max_queue_size: int = 10,
+                 preprocess_buffer_size: int = 1,
+                 will_record_timing: bool = False,
+                 timing_log_path: Optional[str] = None,
+                 log_flush_steps: int = 10,
+                 checkpoint_dir: Optional[str] = None,
+                 checkpoint_every_steps: int = 0,
+                 checkpoint_every_minutes: float = 0.,
+                 will_resume: bool = False,
+                 accumulation_steps: int = 1,
+                 validation_freq: int = 1,
+                 validation_subset_size: int = 0,
+                 eval_batch_size: Optional[int] = None):
+        """
+
+        :param workers: データを読み込むワーカー数
+        :param use_multiprocessing: Trueならプロセス、Falseならスレッドでデータを読み込む
+        :param max_queue_size: 読み込んだバッチを溜めておくキューの長さ
+        :param autotune_steps: 最初にこのステップ数の間バッチの読み込みを待った時間を計測してワーカー数を調整する 0なら調整しない
+        :param autotune_window: ワーカー数を見直す間隔のステップ数
+        :param max_workers: 調整で増やすワーカー数の上限 デフォルトではCPUのコア数
+        :param val_workers: 検証データを先読みするワーカー数
+        :param val_max_queue_size: 先読みした検証データのバッチを溜めておくキューの長さ
+        :param preprocess_buffer_size: data_preprocessを別スレッドで先に実行しておくバッチ数 0なら学習と同じスレッドで実行する
+        :param will_record_timing: Trueならステップごとの処理時間の内訳をbatch_logs、epoch_logsに記録する
+        :param timing_log_path: エポックごとの処理時間の集計結果を書き出すjsonファイルのパス
+        :param log_flush_steps: 学習中の値を集計して進捗を表示する間隔のステップ数
+        :param checkpoint_dir: 再開用の状態を保存するディレクトリ 指定しなければ結果の出力先の下にresumeディレクトリを作る
+        :param checkpoint_every_steps: このステップ数ごとに再開用の状態を保存する
+        :param checkpoint_every_minutes: この分数ごとに再開用の状態を保存する
+        :param will_resume: Trueなら保存された状態から学習を再開する
+        :param accumulation_steps: このステップ数分の勾配を溜めてからパラメータを更新する 1なら毎ステップ更新する
+        :param validation_freq: このエポック数ごとに検証する 最後のエポックは常に検証する
+        :param validation_subset_size: 最後以外のエポックではクラスの比率を保ってこのデータ数だけで検証する 0なら全件で検証する
+        :param eval_batch_size: 検証データのバッチサイズ 勾配を保持しない分大きくできる 指定しなければ学習と同じ
+        """
+        self.__workers = workers
+        self.__use_multiprocessing = use_multiprocessing
+        self.__max_queue_size = max_queue_size
+        self.__autotune_steps = autotune_steps
+        self.__autotune_window = autotune_window
+        self.__max_workers = max_workers
+        self.__val_workers = val_workers
+        self.__val_max_queue_size = val_max_queue_size
+        self.__preprocess_buffer_size = preprocess_buffer_size
+        self.__will_record_timing = will_record_timing
+        self.__timing_log_path = timing_log_path
+        self.__log_flush_steps = log_flush_steps
+        self.__checkpoint_dir = checkpoint_dir
+        self.__checkpoint_every_steps = checkpoint_every_steps
+        self.__checkpoint_every_minutes = checkpoint_every_minutes
+        self.__will_resume = will_resume
+        self.__accumulation_steps = accumulation_steps
+        self.__validation_freq = validation_freq
+        self.__validation_subset_size = validation_subset_size
+        self.__eval_batch_size = eval_batch_size
+
+    @property
+    def workers(self) -> int:
+        return self.__workers
+
+    @property
+    def use_multiprocessing(self) -> bool:
+        return self.__use_multiprocessing
+
+    @property
+    def max_queue_size(self) -> int:
+        return self.__max_queue_size
+
+    @property
+    def autotune_steps(self) -> int:
+        return self.__autotune_steps
+
+    @property
+    def autotune_window(self) -> int:
+        return self.__autotune_window
+
+    @property
+    def max_workers(self) -> Optional[int]:
+        return self.__max_workers
+
+    @property
+    def val_workers(self) -> int:
+        return self.__val_workers
+
+    @property
+    def val_max_queue_size(self) -> int:
+        return self.__val_max_queue_size
+
+    @property
+    def preprocess_buffer_size(self) -> int:
+        return self.__preprocess_buffer_size
+
+    @property
+    def will_record_timing(self) -> bool:
+        return self.__will_record_timing
+
+    @property
+    def timing_log_path(self) -> Optional[str]:
+        return self.__timing_log_path
+
+    @property
+    def log_flush_steps(self) -> int:
+        return self.__log_flush_steps
+
+    @property
+    def checkpoint_dir(self) -> Optional[str]:
+        return self.__checkpoint_dir
+
+    @property
+    def checkpoint_every_steps(self) -> int:
+        return self.__checkpoint_every_steps
+
+    @property
+    def checkpoint_every_minutes(self) -> float:
+        return self.__checkpoint_every_minutes
+
+    @property
+    def will_resume(self) -> bool:
+        return self.__will_resume
+
+    @property
+    def accumulation_steps(self) -> int:
+        return self.__accumulation_steps
+
+    @property
+    def validation_freq(self) -> int:
+        return self.__validation_freq
+
+    @property
+    def validation_subset_size(self) -> int:
+        return self.__validation_subset_size
+
+    @property
+    def eval_batch_size(self) -> Optional[int]:
+        return self.__eval_batch_size
+
+    @property
+    def will_checkpoint(self) -> bool:
+        """
+        再開用の状態を保存するかどうか 再開する場合は続きを保存するため常に保存する
+        """
+        return self.__will_resume or self.__checkpoint_every_steps > 0 or self.__checkpoint_every_minutes > 0
+
+    def with_default_checkpoint_dir(self, checkpoint_dir: str):
+        """
+        checkpoint_dirが指定されていなければ指定したディレクトリを使う設定を返す
+        :param checkpoint_dir: 再開用の状態を保存するディレクトリ
+        :return: 設定のコピー
+        """
+        if self.__checkpoint_dir is not None:
+            return self
+        copied = copy.copy(self)
+        copied.__checkpoint_dir = checkpoint_dir
+        return copied
+
+    def with_checkpoint_sub_dir(self, sub_dir_name: str):
+        """
+        checkpoint_dirが指定されていればその下のディレクトリを使う設定を返す 交差検証の分割ごとに保存先を分ける場合に使う
+        :param sub_dir_name: ディレクトリ名
+        :return: 設定のコピー
+        """
+        if self.__checkpoint_dir is None:
+            return self
+        copied = copy.copy(self)
+        copied.__checkpoint_dir = os.path.join(self.__checkpoint_dir, sub_dir_name)
+        return copied
+
+    @property
+    def will_autotune(self) -> bool:
+        return self.__autotune_steps > 0
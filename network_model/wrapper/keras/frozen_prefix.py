@@ -0,0 +1,163 @@
+import hashlib
+import keras.callbacks
+import keras.engine.training
+from keras import backend as K
+from keras.layers import Input
+from keras.models import Model
+from keras.utils import Sequence as KerasSequence
+from keras.utils.generic_utils import to_list
+import numpy as np
+from network_model.wrapper.feature_cache import CachedFeatureSequence
+
+
+class KerasCachedFeatureSequence(CachedFeatureSequence, KerasSequence):
+    """
+    kerasのfitにSequenceとして渡すためにkerasのSequenceも継承したCachedFeatureSequence
+    """
+    pass
+
+
+def get_inbound_nodes(layer) -> list:
+    return getattr(layer, "_inbound_nodes", None) or getattr(layer, "inbound_nodes", [])
+
+
+def get_node_index(model: keras.engine.training.Model, layer) -> int:
+    """
+    モデルの中でレイヤーを呼び出しているノードの番号 モデルの中に別のモデルをレイヤーとして入れた場合は0以外になる
+    """
+    network_nodes = getattr(model, "_network_nodes", None) or getattr(model, "container_nodes", None) or set()
+    for node_index in range(len(get_inbound_nodes(layer))):
+        if layer.name + "_ib-" + str(node_index) in network_nodes:
+            return node_index
+    return 0
+
+
+def get_layer_input(model: keras.engine.training.Model, layer):
+    return layer.get_input_at(get_node_index(model, layer))
+
+
+def get_layer_output(model: keras.engine.training.Model, layer):
+    return layer.get_output_at(get_node_index(model, layer))
+
+
+def count_frozen_layers(model: keras.engine.training.Model) -> int:
+    """
+    入力側から続いているtrainableがFalseのレイヤーの数 重みを持たないレイヤーは、後ろに固定したレイヤーが続く場合だけ数える
+    """
+    depth = 0
+    for index, layer in enumerate(model.layers):
+        if layer.trainable:
+            break
+        if len(layer.weights) > 0:
+            depth = index + 1
+    return depth
+
+
+def is_single_cut(model: keras.engine.training.Model, cut_depth: int) -> bool:
+    """
+    cut_depth番目以降のレイヤーが、その1つ前のレイヤーの出力と自身より後ろのレイヤーの出力だけを入力にしているかどうか
+    """
+    cut_tensor = get_layer_output(model, model.layers[cut_depth - 1])
+    if isinstance(cut_tensor, list):
+        return False
+    known_tensor_ids = {id(cut_tensor)}
+    for layer in model.layers[cut_depth:]:
+        if any([id(tensor) not in known_tensor_ids for tensor in to_list(get_layer_input(model, layer))]):
+            return False
+        known_tensor_ids.update([id(tensor) for tensor in to_list(get_layer_output(model, layer))])
+    return True
+
+
+def find_cut_depth(model: keras.engine.training.Model, depth: int) -> int:
+    for cut_depth in range(depth, 0, -1):
+        if is_single_cut(model, cut_depth):
+            return cut_depth
+    return 0
+
+
+class KerasFrozenPrefix(object):
+    """
+    kerasのモデルの入力側の固定したレイヤー
+    モデルを1つのテンソルだけでつながる位置で固定したレイヤーとそれ以降に分け、それ以降の部分はレイヤーを共有したモデルとして作る
+    """
+
+    def __init__(self, model: keras.engine.training.Model):
+        self.__model = model
+        self.__depth = 0 if isinstance(model.input, list) else find_cut_depth(model, count_frozen_layers(model))
+        self.__prefix_model = None
+
+    @property
+    def depth(self) -> int:
+        return self.__depth
+
+    @property
+    def cut_tensor(self):
+        return get_layer_output(self.__model, self.__model.layers[self.__depth - 1])
+
+    def build_hash(self) -> str:
+        digest = hashlib.sha1()
+        for layer in self.__model.layers[:self.__depth]:
+            digest.update(layer.name.encode("utf8"))
+            for weight in layer.get_weights():
+                digest.update(np.ascontiguousarray(weight).tobytes())
+        return digest.hexdigest()
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        if self.__prefix_model is None:
+            self.__prefix_model = Model(self.__model.input, self.cut_tensor)
+        return self.__prefix_model.predict_on_batch(x)
+
+    def build_suffix_model(self) -> keras.engine.training.Model:
+        """
+        固定したレイヤーの出力を入力にして残りのレイヤーを呼び出し直したモデルを作る
+        レイヤーは元のモデルと共有しているので、このモデルを学習すると元のモデルの重みが更新される
+        """
+        cut_tensor = self.cut_tensor
+        suffix_input = Input(shape=K.int_shape(cut_tensor)[1:])
+        tensor_map = {id(cut_tensor): suffix_input}
+        for layer in self.__model.layers[self.__depth:]:
+            inputs = get_layer_input(self.__model, layer)
+            outputs = get_layer_output(self.__model, layer)
+            mapped_inputs = [tensor_map[id(tensor)] for tensor in to_list(inputs)]
+            suffix_outputs = layer(mapped_inputs if isinstance(inputs, list) else mapped_inputs[0])
+            for tensor, suffix_output in zip(to_list(outputs), to_list(suffix_outputs)):
+                tensor_map[id(tensor)] = suffix_output
+        suffix_model = Model(suffix_input, tensor_map[id(self.__model.output)])
+        suffix_model.compile(optimizer=self.__model.optimizer, loss=self.__model.loss, metrics=["accuracy"])
+        return suffix_model
+
+
+class FixedModelCallback(keras.callbacks.Callback):
+    """
+    学習しているモデルの代わりに指定したモデルをコールバックに渡す
+    残りのレイヤーだけを学習している場合も、チェックポイントでは元のモデル全体を保存する
+    """
+
+    def __init__(self, callback: keras.callbacks.Callback, model: keras.engine.training.Model):
+        super(FixedModelCallback, self).__init__()
+        self.callback = callback
+        self.fixed_model = model
+
+    def set_params(self, params):
+        self.callback.set_params(params)
+
+    def set_model(self, model):
+        self.callback.set_model(self.fixed_model)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.callback.on_epoch_begin(epoch, logs)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.callback.on_epoch_end(epoch, logs)
+
+    def on_batch_begin(self, batch, logs=None):
+        self.callback.on_batch_begin(batch, logs)
+
+    def on_batch_end(self, batch, logs=None):
+        self.callback.on_batch_end(batch, logs)
+
+    def on_train_begin(self, logs=None):
+        self.callback.on_train_begin(logs)
+
+    def on_train_end(self, logs=None):
+        self.callback.on_train_end(logs)
@@ -10,9 +10,17 @@ from typing import Optional
 from typing import Union
 from typing import Callable
 import os
+import random
 from DataIO import data_loader as dl
 from network_model.wrapper.abstract_model import build_record_path
 from util.keras_version import is_new_keras
+from network_model.wrapper.fit_setting import FitSetting
+from network_model.wrapper.resume import ResumeCallback
+from network_model.wrapper.resume import build_callback_states
+from network_model.wrapper.resume import restore_callback_states
+from network_model.wrapper.keras.frozen_prefix import KerasFrozenPrefix
+from network_model.wrapper.keras.frozen_prefix import KerasCachedFeatureSequence
+from network_model.wrapper.keras.frozen_prefix import FixedModelCallback
 ModelPreProcessor = Optional[Callable[[keras.engine.training.Model],  keras.engine.training.Model]]
 
 
@@ -88,7 +96,8 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
                       temp_best_path: str = "",
                       save_weights_only: bool = False,
                       will_use_multi_inputs_per_one_image: bool = False,
-                      data_preprocess=None):
+                      data_preprocess=None,
+                      fit_setting: Optional[FitSetting] = None):
         """
         モデルの適合度を算出する
         :param image_generator: ファイルパスから学習データを生成する生成器
@@ -100,9 +109,11 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param data_preprocess:
+        :param fit_setting: データ読み込みのワーカー数などの設定
         :return:
         """
         print("fit builder")
+        use_fit_setting = FitSetting() if fit_setting is None else fit_setting
         self.__model = self.run_preprocess_model(self.__model)
         if validation_data is None:
             if will_use_multi_inputs_per_one_image:
@@ -111,19 +122,31 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
                                                                   steps_per_epoch=steps_per_epoch,
                                                                   temp_best_path=temp_best_path,
                                                                   save_weights_only=save_weights_only,
-                                                                  data_preprocess=data_preprocess)
+                                                                  data_preprocess=data_preprocess,
+                                                                  fit_setting=use_fit_setting)
                 return self
             callbacks = self.get_callbacks(temp_best_path, save_weights_only)
+            initial_epoch, callbacks = self.prepare_resume_for_keras_fit(use_fit_setting, callbacks)
+            train_model, image_generator, _ = self.use_feature_cache(image_generator, None)
+            callbacks = self.fix_callbacks_model(callbacks, train_model)
             if is_new_keras():
-                self.__history = self.__model.fit(image_generator,
-                                                  steps_per_epoch=steps_per_epoch,
-                                                  epochs=epochs,
-                                                  callbacks=callbacks)
+                self.__history = train_model.fit(image_generator,
+                                                 steps_per_epoch=steps_per_epoch,
+                                                 epochs=epochs,
+                                                 initial_epoch=initial_epoch,
+                                                 callbacks=callbacks,
+                                                 workers=use_fit_setting.workers,
+                                                 use_multiprocessing=use_fit_setting.use_multiprocessing,
+                                                 max_queue_size=use_fit_setting.max_queue_size)
             else:
-                self.__history = self.__model.fit_generator(image_generator,
-                                                            steps_per_epoch=steps_per_epoch,
-                                                            epochs=epochs,
-                                                            callbacks=callbacks)
+                self.__history = train_model.fit_generator(image_generator,
+                                                           steps_per_epoch=steps_per_epoch,
+                                                           epochs=epochs,
+                                                           initial_epoch=initial_epoch,
+                                                           callbacks=callbacks,
+                                                           workers=use_fit_setting.workers,
+                                                           use_multiprocessing=use_fit_setting.use_multiprocessing,
+                                                           max_queue_size=use_fit_setting.max_queue_size)
 
         else:
             if will_use_multi_inputs_per_one_image:
@@ -134,24 +157,36 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
                                                                   validation_data=validation_data,
                                                                   temp_best_path=temp_best_path,
                                                                   save_weights_only=save_weights_only,
-                                                                  data_preprocess=data_preprocess)
+                                                                  data_preprocess=data_preprocess,
+                                                                  fit_setting=use_fit_setting)
                 return self
             print('epochs', epochs)
             callbacks = self.get_callbacks(temp_best_path, save_weights_only)
+            initial_epoch, callbacks = self.prepare_resume_for_keras_fit(use_fit_setting, callbacks)
+            train_model, image_generator, validation_data = self.use_feature_cache(image_generator, validation_data)
+            callbacks = self.fix_callbacks_model(callbacks, train_model)
             if is_new_keras():
-                self.__history = self.__model.fit(image_generator,
-                                                  steps_per_epoch=steps_per_epoch,
-                                                  validation_steps=validation_steps,
-                                                  epochs=epochs,
-                                                  validation_data=validation_data,
-                                                  callbacks=callbacks)
+                self.__history = train_model.fit(image_generator,
+                                                 steps_per_epoch=steps_per_epoch,
+                                                 validation_steps=validation_steps,
+                                                 epochs=epochs,
+                                                 initial_epoch=initial_epoch,
+                                                 validation_data=validation_data,
+                                                 callbacks=callbacks,
+                                                 workers=use_fit_setting.workers,
+                                                 use_multiprocessing=use_fit_setting.use_multiprocessing,
+                                                 max_queue_size=use_fit_setting.max_queue_size)
             else:
-                self.__history = self.__model.fit_generator(image_generator,
-                                                            steps_per_epoch=steps_per_epoch,
-                                                            validation_steps=validation_steps,
-                                                            epochs=epochs,
-                                                            validation_data=validation_data,
-                                                            callbacks=callbacks)
+                self.__history = train_model.fit_generator(image_generator,
+                                                           steps_per_epoch=steps_per_epoch,
+                                                           validation_steps=validation_steps,
+                                                           epochs=epochs,
+                                                           initial_epoch=initial_epoch,
+                                                           validation_data=validation_data,
+                                                           callbacks=callbacks,
+                                                           workers=use_fit_setting.workers,
+                                                           use_multiprocessing=use_fit_setting.use_multiprocessing,
+                                                           max_queue_size=use_fit_setting.max_queue_size)
 
         self.after_learned_process()
         return self
@@ -168,7 +203,8 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
              validation_steps: Optional[int] = None,
              save_weights_only: bool = False,
              will_use_multi_inputs_per_one_image: bool = False,
-             input_data_preprocess_for_building_multi_data=None
+             input_data_preprocess_for_building_multi_data=None,
+             fit_setting: Optional[FitSetting] = None
              ):
         """
         指定したデータセットに対しての正答率を算出する
@@ -185,10 +221,13 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param input_data_preprocess_for_building_multi_data:
+        :param fit_setting: データ読み込みのワーカー数などの設定
         :return:
         """
         write_dir_path = build_record_path(result_dir_name, dir_path)
         save_tmp_name = self.build_best_model_file_name(model_name)
+        if fit_setting is not None:
+            fit_setting = fit_setting.with_default_checkpoint_dir(os.path.join(write_dir_path, "resume"))
         self.fit_generator(image_generator,
                            epochs,
                            validation_data,
@@ -197,10 +236,104 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
                            temp_best_path=os.path.join(write_dir_path, save_tmp_name),
                            save_weights_only=save_weights_only,
                            will_use_multi_inputs_per_one_image=will_use_multi_inputs_per_one_image,
-                           data_preprocess=input_data_preprocess_for_building_multi_data)
+                           data_preprocess=input_data_preprocess_for_building_multi_data,
+                           fit_setting=fit_setting)
         self.record_model(result_dir_name, dir_path, model_name)
         self.record_conf_json(result_dir_name, dir_path, normalize_type, model_name)
 
+    def get_resume_model_state(self) -> dict:
+        optimizer = getattr(self.__model, "optimizer", None)
+        return {"weights": self.__model.get_weights(),
+                "optimizer_weights": None if optimizer is None else optimizer.get_weights()}
+
+    def set_resume_model_state(self, state: dict):
+        self.__model.set_weights(state["weights"])
+        optimizer_weights = state["optimizer_weights"]
+        if not optimizer_weights:
+            return
+        if is_new_keras() is False:
+            self.__model._make_train_function()
+        if len(self.__model.optimizer.weights) == len(optimizer_weights):
+            self.__model.optimizer.set_weights(optimizer_weights)
+        else:
+            print("optimizer weights have not been built, skip restoring them")
+
+    def prepare_resume_for_keras_fit(self,
+                                     fit_setting: FitSetting,
+                                     callbacks: Optional[List[keras.callbacks.Callback]]):
+        """
+        kerasのfitで学習する場合の再開の準備をする
+        こちらはエポック単位でのみ保存、再開する
+        :param fit_setting: 再開用の状態の保存先などの設定
+        :param callbacks: fitに渡すコールバック
+        :return: 再開するエポック数と、状態を保存するコールバックを加えたコールバック
+        """
+        checkpointer = self.build_resume_checkpointer(fit_setting)
+        if checkpointer is None:
+            return 0, callbacks
+        use_callbacks = [] if callbacks is None else list(callbacks)
+        initial_epoch = 0
+        if fit_setting.will_resume and checkpointer.exists():
+            state = checkpointer.load()
+            self.set_resume_model_state(state["model"])
+            restore_callback_states(use_callbacks, state["callbacks"])
+            random.setstate(state["python_random"])
+            np.random.set_state(state["numpy_random"])
+            initial_epoch = state["epoch"]
+            print("resume from epoch", initial_epoch)
+
+        def save_state(epoch: int):
+            checkpointer.save({"epoch": epoch,
+                               "steps_done": 0,
+                               "callbacks": build_callback_states(use_callbacks),
+                               "python_random": random.getstate(),
+                               "numpy_random": np.random.get_state(),
+                               "model": self.get_resume_model_state()})
+        return initial_epoch, use_callbacks + [ResumeCallback(save_state)]
+
+    def use_feature_cache(self, image_generator, validation_data):
+        """
+        固定したレイヤーの出力を保存できる場合は、学習データと検証データを保存した出力を読み込むものに置き換え、
+        残りのレイヤーを元のモデルと共有したモデルで学習する
+        学習データと検証データのどちらかを保存できない場合は置き換えない
+        :return: 学習するモデル、学習データ、検証データ
+        """
+        not_cached = self.__model, image_generator, validation_data
+        if self.feature_cache is None:
+            return not_cached
+        frozen_prefix = KerasFrozenPrefix(self.__model)
+        if frozen_prefix.depth == 0:
+            print("feature cache is disabled because no layer is frozen")
+            return not_cached
+        if self.feature_cache.can_cache(image_generator) is False or \
+                (validation_data is not None and self.feature_cache.can_cache(validation_data) is False):
+            return not_cached
+        train_sequence = self.feature_cache.build_sequence(frozen_prefix,
+                                                           image_generator,
+                                                           True,
+                                                           sequence_type=KerasCachedFeatureSequence)
+        validation_sequence = None if validation_data is None else \
+            self.feature_cache.build_sequence(frozen_prefix,
+                                              validation_data,
+                                              False,
+                                              sequence_type=KerasCachedFeatureSequence)
+        if train_sequence is None or (validation_data is not None and validation_sequence is None):
+            return not_cached
+        print("train layers after the", frozen_prefix.depth, "frozen layers on cached features")
+        return frozen_prefix.build_suffix_model(), train_sequence, validation_sequence
+
+    def fix_callbacks_model(self,
+                            callbacks: Optional[List[keras.callbacks.Callback]],
+                            train_model: keras.engine.training.Model):
+        """
+        元のモデルとは別のモデルを学習する場合、チェックポイントには元のモデルを渡す
+        """
+        if callbacks is None or train_model is self.__model:
+            return callbacks
+        return [FixedModelCallback(callback, self.__model)
+                if isinstance(callback, keras.callbacks.ModelCheckpoint) else callback
+                for callback in callbacks]
+
     def build_model_functions(self, will_validate):
         self.__model._make_train_function()
         if will_validate:
@@ -244,7 +377,8 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
                                                      validation_steps: Optional[int] = None,
                                                      temp_best_path: str = "",
                                                      save_weights_only: bool = False,
-                                                     data_preprocess=None):
+                                                     data_preprocess=None,
+                                                     fit_setting: Optional[FitSetting] = None):
 
         return self.fit_generator_for_expantion(image_generator,
                                                 epochs,
@@ -253,6 +387,7 @@ class ModelForManyData(AbstractKerasWrapper, AbsExpantionEpoch):
                                                 validation_steps,
                                                 temp_best_path,
                                                 save_weights_only,
-                                                data_preprocess)
+                                                data_preprocess,
+                                                fit_setting)
 
 
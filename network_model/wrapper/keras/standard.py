@@ -9,6 +9,7 @@ from typing import Callable
 from datetime import datetime
 from DataIO import data_loader as dl
 from util.keras_version import is_new_keras
+from generator.statistics import FeaturewiseStatistics
 ModelPreProcessor = Optional[Callable[[keras.engine.training.Model],  keras.engine.training.Model]]
 
 
@@ -80,7 +81,8 @@ class Model(AbstractKerasWrapper):
                       generator_batch_size: int = 32,
                       validation_data: Optional[Tuple[np.ndarray, np.ndarray]] = None,
                       temp_best_path: str = "",
-                      save_weights_only: bool = False):
+                      save_weights_only: bool = False,
+                      featurewise_statistics: Optional[FeaturewiseStatistics] = None):
         """
         モデルの適合度を算出する
         generatorを使ってデータを水増しして学習する場合に使用する
@@ -92,11 +94,15 @@ class Model(AbstractKerasWrapper):
         :param validation_data: テストに使用するデータ　実データとラベルのセットのタプル
         :param temp_best_path:
         :param save_weights_only:
+        :param featurewise_statistics: 事前に算出した統計量 渡した場合はimage_generator.fitを呼ばずにこれを設定する
         :return:
         """
         callbacks = self.get_callbacks(temp_best_path, save_weights_only)
         print("fit builder")
-        image_generator.fit(data)
+        if featurewise_statistics is None:
+            image_generator.fit(data)
+        else:
+            featurewise_statistics.apply(image_generator)
         print("start learning")
         self.__model = self.run_preprocess_model(self.__model)
         if validation_data is None:
@@ -158,7 +164,8 @@ class Model(AbstractKerasWrapper):
              result_dir_name: str = None,
              dir_path: str = None,
              model_name: str = None,
-             save_weights_only: bool = False):
+             save_weights_only: bool = False,
+             featurewise_statistics: Optional[FeaturewiseStatistics] = None):
         """
         指定したデータセットに対しての正答率を算出する
         :param train_data_set: 学習に使用したデータ
@@ -173,6 +180,7 @@ class Model(AbstractKerasWrapper):
         :param dir_path: 記録するディレクトリ デフォルトではカレントディレクトリ直下にresultディレクトリを作成する
         :param model_name: モデル名　デフォルトではmodel
         :param save_weights_only:
+        :param featurewise_statistics: 事前に算出した統計量 渡した場合はimage_generator.fitを呼ばずにこれを設定する
         :return:学習用データの正答率とテスト用データの正答率のタプル
         """
         save_tmp_name = model_name + "_best.h5" if self.will_save_h5 else model_name + "_best"
@@ -191,7 +199,8 @@ class Model(AbstractKerasWrapper):
                                generator_batch_size,
                                (test_data_set, test_label_set),
                                temp_best_path=save_tmp_name,
-                               save_weights_only=save_weights_only)
+                               save_weights_only=save_weights_only,
+                               featurewise_statistics=featurewise_statistics)
         now_result_dir_name = result_dir_name + datetime.now().strftime("%Y%m%d%H%M%S")
         self.record_model(now_result_dir_name, dir_path, model_name)
         self.record_conf_json(now_result_dir_name, dir_path, normalize_type, model_name)
@@ -1,14 +1,12 @@
 from network_model.wrapper.abstract_model import AbstractModel
 from network_model.wrapper.abstract_expantion_epoch import AbsExpantionEpoch
-from keras.callbacks import History
-import keras.callbacks
+import contextlib
 from typing import List
 from typing import Optional
 import numpy as np
 from typing import Callable
 from torch.optim.optimizer import Optimizer
 from torch.nn.modules.loss import _Loss
-from torch import max as torch_max
 import torch
 import torch.nn
 from network_model.wrapper.abstract_model import build_record_path
@@ -17,7 +15,6 @@ import os
 from torch.nn import BCELoss, CrossEntropyLoss
 from network_model.wrapper.pytorch.util.checkpoint import PytorchCheckpoint, PytorchSiameseCheckpoint
 from model_merger.pytorch.siamese import SiameseNetworkPT
-from keras.utils.generic_utils import to_list
 from generator.transpose import transpose
 from generator.siamese_learner import SiameseLearnerDataBuilder
 from generator.siamese_learner_for_inceptionv3_age import SiameseLearnerDataBuilderForInceptionV3
@@ -25,6 +22,28 @@ from model_merger.pytorch.proc.shiamese_loss import SiameseLossForInceptionV3
 from torchvision.models.inception import Inception3
 from network_model.wrapper.pytorch.util.neighbor_recorder import NeighborRecorder
 from numba import jit
+from network_model.wrapper.fit_setting import FitSetting
+from network_model.wrapper.callbacks import Callback
+from network_model.wrapper.callbacks import History
+from network_model.wrapper.callbacks import to_list
+from network_model.wrapper.step_timer import StepTimer
+from network_model.wrapper.pytorch.util.tensor_stager import TensorStager
+from network_model.wrapper.pytorch.util import metrics
+from network_model.wrapper.pytorch.util.model_compiler import ModelCompiler
+from network_model.wrapper.pytorch.util import distributed
+from network_model.wrapper.pytorch.util.frozen_prefix import PytorchFrozenPrefix
+from util_types.input_pair import SiameseIndexedInput
+from torch.nn.parallel import DistributedDataParallel
+from util.runtime_config import get_runtime_config
+
+
+def check_autocast_available():
+    """
+    混合精度に使うtorch.autocastがあるかを確かめる torch.autocastは1.10で追加された
+    """
+    if hasattr(torch, "autocast") is False:
+        raise ValueError("mixed_precision needs torch>=1.10 for torch.autocast, but torch " + torch.__version__
+                         + " is installed")
 
 
 class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
@@ -39,7 +58,7 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
               optimizer: Optimizer,
               loss: _Loss,
               class_set: List[str],
-              callbacks: Optional[List[keras.callbacks.Callback]] = None,
+              callbacks: Optional[List[Callback]] = None,
               monitor: str = "",
               preprocess_for_model=None,
               after_learned_process: Optional[Callable[[None], None]] = None,
@@ -117,7 +136,7 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
                       optimizer: Optimizer,
                       loss: _Loss,
                       class_set: List[str],
-                      callbacks: Optional[List[keras.callbacks.Callback]] = None,
+                      callbacks: Optional[List[Callback]] = None,
                       monitor: str = "",
                       preprocess_for_model=None,
                       after_learned_process: Optional[Callable[[None], None]] = None,
@@ -151,48 +170,41 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
                       sample_data=None,
                       decide_dataset_generator=None,
                       nearest_data_ave_num=1,
-                      will_calc_rate_real_data_train=False):
+                      will_calc_rate_real_data_train=False,
+                      autocast_dtype: Optional[torch.dtype] = None,
+                      will_use_channels_last: bool = False,
+                      model_compiler: Optional[ModelCompiler] = None):
         use_sample_data = sample_data
         if use_sample_data is None:
             use_sample_data = ModelForPytorch.build_sampledata(isinstance(model_base, SiameseNetworkPT))
 
         def build_model(class_set: List[str],
-                        callbacks: Optional[List[keras.callbacks.Callback]] = None,
+                        callbacks: Optional[List[Callback]] = None,
                         monitor: str = "",
                         preprocess_for_model=None,
                         after_learned_process: Optional[Callable[[None], None]] = None,
                         x_type=torch.float,
                         y_type=None):
-            if loss is not None:
-                return ModelForPytorch.build(model_base,
-                                             optimizer,
-                                             loss,
-                                             class_set,
-                                             callbacks,
-                                             monitor,
-                                             preprocess_for_model,
-                                             after_learned_process,
-                                             use_sample_data,
-                                             x_type,
-                                             y_type,
-                                             decide_dataset_generator=decide_dataset_generator,
-                                             nearest_data_ave_num=nearest_data_ave_num,
-                                             will_calc_rate_real_data_train=will_calc_rate_real_data_train)
-            use_loss = CrossEntropyLoss() if len(class_set) > 2 else BCELoss()
-            return ModelForPytorch.build(model_base,
-                                         optimizer,
-                                         use_loss,
-                                         class_set,
-                                         callbacks,
-                                         monitor,
-                                         preprocess_for_model,
-                                         after_learned_process,
-                                         use_sample_data,
-                                         x_type,
-                                         y_type,
-                                         decide_dataset_generator=decide_dataset_generator,
-                                         nearest_data_ave_num=nearest_data_ave_num,
-                                         will_calc_rate_real_data_train=will_calc_rate_real_data_train)
+            use_loss = loss
+            if use_loss is None:
+                use_loss = CrossEntropyLoss() if len(class_set) > 2 else BCELoss()
+            model = ModelForPytorch.build(model_base,
+                                          optimizer,
+                                          use_loss,
+                                          class_set,
+                                          callbacks,
+                                          monitor,
+                                          preprocess_for_model,
+                                          after_learned_process,
+                                          use_sample_data,
+                                          x_type,
+                                          y_type,
+                                          decide_dataset_generator=decide_dataset_generator,
+                                          nearest_data_ave_num=nearest_data_ave_num,
+                                          will_calc_rate_real_data_train=will_calc_rate_real_data_train)
+            model.set_autocast_dtype(autocast_dtype)
+            model.set_channels_last(will_use_channels_last)
+            return model.set_model_compiler(model_compiler)
         return build_model
 
     def __init__(self,
@@ -201,7 +213,7 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
                  loss: _Loss,
                  torch_device,
                  class_set: List[str],
-                 callbacks: Optional[List[keras.callbacks.Callback]] = None,
+                 callbacks: Optional[List[Callback]] = None,
                  monitor: str = "",
                  preprocess_for_model=None,
                  after_learned_process: Optional[Callable[[None], None]] = None,
@@ -222,9 +234,17 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
         self.__loss = loss
         self.__torch_device = torch_device
         self.__model.to(self.__torch_device)
+        self.__tensor_stager = TensorStager(torch_device)
         self.__x_type = x_type
         self.__y_type = y_type
         self.__sample_data = sample_data
+        self.set_accumulation_steps(1)
+        self.__autocast_dtype = None
+        self.__model_compiler = None
+        self.__forward_source = None
+        self.__forward_model = None
+        self.__distributed_model = None
+        self.__suffix_model = None
         if self.__y_type is None:
             self.__y_type = torch.long if len(class_set) > 2 else torch.float
         super(ModelForPytorch, self).__init__(class_set,
@@ -233,6 +253,9 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
                                               preprocess_for_model,
                                               after_learned_process)
 
+    def build_monitor(self, monitor: str) -> str:
+        return monitor
+
     @property
     def is_binary_classifier(self):
         return self.__y_type==torch.float
@@ -295,114 +318,319 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
             return ["loss", "accuracy", "val_loss", "val_accuracy", "val_original_accuracy"]
         return ["loss", "accuracy", "val_loss", "val_accuracy"]
 
+    @property
+    def is_channels_last(self) -> bool:
+        return self.__tensor_stager.memory_format == torch.channels_last
+
+    def set_channels_last(self, will_use_channels_last: bool):
+        """
+        モデルと4次元の入力をchannels_lastのメモリ配置にする oneDNNやcuDNNの畳み込みが速くなる
+        :param will_use_channels_last: Trueならchannels_lastにする
+        :return: 自身
+        """
+        memory_format = torch.channels_last if will_use_channels_last else torch.contiguous_format
+        self.__tensor_stager.set_memory_format(memory_format)
+        self.__model.to(memory_format=memory_format)
+        return self
+
     def set_model_to_device(self):
-        return self.__model.to(self.__torch_device)
+        """
+        モデルがデバイスに載っていなければ移す チェックポイントの保存などでCPUに移された場合だけ移し直す
+        """
+        first_param = next(self.__model.parameters(), None)
+        if first_param is None or first_param.device != torch.device(self.__torch_device):
+            self.__model.to(self.__torch_device, memory_format=self.__tensor_stager.memory_format)
+        return self.__model
 
     def become_train_mode(self):
-        return self.__model.train()
+        if self.__model.training is False:
+            self.__model.train()
+            if self.__suffix_model is not None:
+                self.__suffix_model.train()
+        return self.__model
 
     def become_eval_mode(self):
-        return self.__model.eval()
+        if self.__model.training:
+            self.__model.eval()
+            if self.__suffix_model is not None:
+                self.__suffix_model.eval()
+        return self.__model
 
     def numpy2tensor(self, param: np.ndarray, dtype) -> torch.tensor:
         converted = torch.from_numpy(param)
         return converted.to(self.__torch_device, dtype=dtype)
 
     def convert_data_for_model(self, x: np.ndarray, y):
-        return self.numpy2tensor(x, self.__x_type), self.numpy2tensor(y, self.__y_type)
+        """
+        学習、評価用のバッチをデバイスに送る 送り先のテンソルは次のバッチで使い回される
+        """
+        if isinstance(x, SiameseIndexedInput):
+            return SiameseIndexedInput(self.__tensor_stager.to_device("x", x.data, self.__x_type),
+                                       self.__tensor_stager.to_device("pair_index", x.pair_index, torch.long)), \
+                self.__tensor_stager.to_device("y", y, self.__y_type)
+        return self.__tensor_stager.to_device("x", x, self.__x_type), \
+            self.__tensor_stager.to_device("y", y, self.__y_type)
+
+    @property
+    def autocast_dtype(self) -> Optional[torch.dtype]:
+        return self.__autocast_dtype
+
+    def set_autocast_dtype(self, autocast_dtype: Optional[torch.dtype]):
+        """
+        順伝播と損失の計算を指定した精度で行う混合精度モードにする 重みはfloat32のまま保持する
+        :param autocast_dtype: torch.bfloat16など Noneならfloat32で計算する
+        :return: 自身
+        """
+        if autocast_dtype is not None:
+            check_autocast_available()
+        self.__autocast_dtype = autocast_dtype
+        return self
+
+    def set_model_compiler(self, model_compiler: Optional[ModelCompiler]):
+        """
+        学習と評価の順伝播をtorch.compileでコンパイルしたモデルで行う
+        :param model_compiler: コンパイルの設定 Noneならeagerで実行する
+        :return: 自身
+        """
+        self.__model_compiler = model_compiler
+        self.__forward_source = None
+        return self
+
+    @property
+    def is_main_process(self) -> bool:
+        return distributed.is_main_process()
+
+    def build_forward_model(self, model: torch.nn.Module):
+        """
+        分散学習している場合はDistributedDataParallelで包み、逆伝播の際に勾配をバケットごとにall-reduceで平均する
+        コンパイルする場合は包んだ後のモデルをコンパイルする
+        """
+        forward_model = model
+        self.__distributed_model = None
+        if distributed.is_distributed():
+            forward_model = DistributedDataParallel(model, bucket_cap_mb=distributed.DEFAULT_BUCKET_CAP_MB)
+            self.__distributed_model = forward_model
+        if self.__model_compiler is None:
+            return forward_model
+        return self.__model_compiler.compile(forward_model)
+
+    @property
+    def forward_model(self):
+        """
+        学習と評価の順伝播に使うモデル モデルが差し替えられていれば最初に呼ばれた時に包み直す
+        固定したレイヤーの出力を保存して学習している間は、残りのレイヤーだけを計算するモデルを使う
+        """
+        source_model = self.__model if self.__suffix_model is None else self.__suffix_model
+        if self.__model_compiler is None and distributed.is_distributed() is False:
+            return source_model
+        if self.__forward_source is not source_model:
+            self.__forward_model = self.build_forward_model(source_model)
+            self.__forward_source = source_model
+        return self.__forward_model
+
+    def autocast(self):
+        """
+        混合精度モードなら順伝播と損失の計算をこのwithブロックの中で行う
+        """
+        if self.__autocast_dtype is None:
+            # torch.autocastがない1.10より前のtorchでも動くよう、混合精度でなければ何もしないwithブロックにする
+            return contextlib.suppress()
+        return torch.autocast(torch.device(self.__torch_device).type, dtype=self.__autocast_dtype)
+
+    def build_step_timer(self, fit_setting: FitSetting) -> StepTimer:
+        synchronize = torch.cuda.synchronize if str(self.__torch_device).startswith("cuda") else None
+        log_path = fit_setting.timing_log_path if self.is_main_process else None
+        return StepTimer(fit_setting.will_record_timing, synchronize, log_path)
+
+    @property
+    def accumulation_steps(self) -> int:
+        return self.__accumulation_steps
+
+    def set_accumulation_steps(self, accumulation_steps: int):
+        self.__accumulation_steps = max(accumulation_steps, 1)
+        self.__accumulated_num = 0
+        self.__accumulated_outs = None
+        self.__accumulated_size = 0
+
+    def begin_accumulation(self):
+        if self.__accumulated_num == 0:
+            self.__optimizer.zero_grad()
+
+    def sync_context(self):
+        """
+        分散学習で勾配を溜めている途中のマイクロバッチなら、順伝播と逆伝播をこのwithブロックの中で行い、
+        勾配のall-reduceをマクロバッチの最後のマイクロバッチの逆伝播だけにする
+        """
+        # 包み直す必要があればここで包み直し、今のモデルを包んだDistributedDataParallelを使う
+        _ = self.forward_model
+        if self.__distributed_model is None or self.__accumulated_num + 1 >= self.__accumulation_steps:
+            return contextlib.suppress()
+        return self.__distributed_model.no_sync()
+
+    def backward_for_accumulation(self, loss, retain_graph: bool = False):
+        """
+        マイクロバッチの損失を勾配に加算する
+        マクロバッチ全体の平均になるようにaccumulation_stepsで割ってから逆伝播する
+        """
+        if self.__accumulation_steps == 1:
+            loss.backward(retain_graph=retain_graph)
+            return
+        (loss / self.__accumulation_steps).backward(retain_graph=retain_graph)
+
+    def end_accumulation(self) -> bool:
+        """
+        マクロバッチ分の勾配が溜まっていればパラメータを更新する
+        :return: 更新したかどうか
+        """
+        self.__accumulated_num += 1
+        if self.__accumulated_num < self.__accumulation_steps:
+            return False
+        self.__optimizer.step()
+        self.__accumulated_num = 0
+        return True
+
+    def flush_accumulation(self):
+        """
+        エポックの最後などでマクロバッチに満たない勾配が残っていれば、溜まった分の平均になるよう補正して更新する
+        """
+        if self.__accumulated_num == 0:
+            return
+        scale = self.__accumulation_steps / self.__accumulated_num
+        for param_group in self.__optimizer.param_groups:
+            for param in param_group["params"]:
+                if param.grad is not None:
+                    param.grad.mul_(scale)
+        self.__optimizer.step()
+        self.__accumulated_num = 0
+        self.__accumulated_outs = None
+        self.__accumulated_size = 0
+
+    def average_accumulated_outs(self, outs, batch_size: int):
+        """
+        マクロバッチの中でのこれまでの損失、正答率の平均を返す
+        :param outs: このマイクロバッチの損失、正答率 デバイス上のテンソルのまま計算する
+        :param batch_size: このマイクロバッチのデータ数
+        :return: マクロバッチの平均
+        """
+        if self.__accumulation_steps == 1:
+            return outs
+        weighted = [value * batch_size for value in outs]
+        if self.__accumulated_outs is None:
+            self.__accumulated_outs = weighted
+        else:
+            self.__accumulated_outs = [total + value for total, value in zip(self.__accumulated_outs, weighted)]
+        self.__accumulated_size += batch_size
+        averaged = tuple(total / self.__accumulated_size for total in self.__accumulated_outs)
+        if self.__accumulated_num == 0:
+            self.__accumulated_outs = None
+            self.__accumulated_size = 0
+        return averaged
+
+    def finish_epoch_train(self):
+        self.flush_accumulation()
+
+    def train_siamese_inceptionV3_on_batch(self, x, y):
+        with self.sync_context():
+            with self.autocast():
+                outputs = self.forward_model(x)
+                loss, aux_loss = self.__loss(outputs, y)
+            self.step_timer.lap("forward", True)
+            # DistributedDataParallelは1回の順伝播に対して逆伝播を1回しか許さないので、補助出力の損失と合わせて逆伝播する
+            self.backward_for_accumulation(loss + aux_loss)
+            self.step_timer.lap("backward", True)
+        running_loss = loss.detach()
+        aux_running_loss = aux_loss.detach()
+        self.end_accumulation()
+        self.step_timer.lap("optimizer", True)
+        predicted, aux_predicted = self.get_predicted(outputs)
+        collect_rate = self.calc_collect_rate_on_device(predicted, y[0])
+        aux_collect_rate = self.calc_collect_rate_on_device(aux_predicted, y[1])
+        self.step_timer.lap("metrics")
+        return self.average_accumulated_outs((running_loss, collect_rate, aux_running_loss, aux_collect_rate),
+                                             y[0].size(0))
 
     def train_on_batch(self, x, y, sample_weight=None, data_preprocess=None):
-        self.__model.to(self.__torch_device)
-        self.__model.train()
-        self.__optimizer.zero_grad()
+        self.set_model_to_device()
+        self.become_train_mode()
+        self.begin_accumulation()
         x, y = self.convert_data_for_model(x, y)
-        outputs = self.__model(x)
+        self.step_timer.lap("to_device", True)
         if self.is_siamese_inceptionV3:
-            loss, aux_loss = self.__loss(outputs, y)
-            loss.backward(retain_graph=True)
-            running_loss = loss.item()
-            aux_loss.backward(retain_graph=True)
-            aux_running_loss = aux_loss.item()
-            self.__optimizer.step()
-            predicted, aux_predicted = self.get_predicted(outputs)
-            collect_rate = self.calc_collect_rate(predicted, y[0])
-            aux_collect_rate = self.calc_collect_rate(aux_predicted, y[1])
-            return running_loss, collect_rate, aux_running_loss, aux_collect_rate
-        if self.is_inceptionV3:
-            loss = self.__loss(outputs.logits, y)
-            self.__optimizer.step()
-            running_loss = loss.item()
-            predicted = self.get_predicted(outputs.logits)
-            if outputs.aux_logits is not None:
-                aux_loss = self.__loss(outputs.aux_logits, y)
-                self.__optimizer.step()
-            return running_loss, self.calc_collect_rate(predicted, y)
-        loss = self.__loss(outputs, y)
-        loss.backward()
-        self.__optimizer.step()
-        running_loss = loss.item()
+            return self.train_siamese_inceptionV3_on_batch(x, y)
+        with self.sync_context():
+            with self.autocast():
+                outputs = self.forward_model(x)
+                if self.is_inceptionV3:
+                    outputs = outputs.logits
+                loss = self.__loss(outputs, y)
+            self.step_timer.lap("forward", True)
+            self.backward_for_accumulation(loss)
+            self.step_timer.lap("backward", True)
+        self.end_accumulation()
+        self.step_timer.lap("optimizer", True)
+        running_loss = loss.detach()
         predicted = self.get_predicted(outputs)
-        self.__sample_data = x[:1].to("cpu")
-        return running_loss, self.calc_collect_rate(predicted, y)
-
-    def get_siamese_predicted(self, x0, x1):
-        distance = self.__loss.calc_distance(x0, x1)
-        return 0 if distance < 0.5 else 1
+        if self.__suffix_model is None and isinstance(x, torch.Tensor):
+            self.__sample_data = x[:1].to("cpu", copy=True)
+        collect_rate = self.calc_collect_rate_on_device(predicted, y)
+        self.step_timer.lap("metrics")
+        return self.average_accumulated_outs((running_loss, collect_rate), y.size(0))
 
     def get_siamese_predicted_batch(self, outputs):
         x0, x1 = outputs
-        return [self.get_siamese_predicted(param0, param1) for param0, param1 in zip(x0, x1)]
+        return metrics.predict_siamese(self.__loss.calc_distance(x0, x1))
+
+    def get_siamese_inceptionV3_predicted(self, outputs, is_training: bool = True):
+        if is_training is False:
+            return self.get_siamese_predicted_batch(outputs)
+        x0, x1 = outputs
+        predicted = self.get_siamese_predicted_batch((x0.logits, x1.logits))
+        aux_predicted = self.get_siamese_predicted_batch((x0.aux_logits, x1.aux_logits))
+        return predicted, aux_predicted
 
     def get_predicted(self, outputs, is_training: bool = True):
         if self.is_siamese_inceptionV3:
-            if is_training is False:
-                return self.get_siamese_predicted_batch(outputs)
-            x0, x1 = outputs
-            predicted = [self.get_siamese_predicted(param0, param1) for param0, param1 in zip(x0.logits, x1.logits)]
-            aux_predicted = [self.get_siamese_predicted(param0, param1) for param0, param1
-                             in zip(x0.aux_logits, x1.aux_logits)]
-            return predicted, aux_predicted
-
+            return self.get_siamese_inceptionV3_predicted(outputs, is_training)
         if self.is_siamese:
             return self.get_siamese_predicted_batch(outputs)
         if self.is_binary_classifier:
-            return [0 if param < 0.5 else 1 for param in outputs.data]
-        _, predicted = torch_max(outputs.data, 1)
-        return predicted
+            return metrics.predict_binary(outputs)
+        return metrics.predict_classes(outputs)
+
+    def count_collect(self, predicted, y) -> torch.Tensor:
+        """
+        バッチの正答数をデバイス上のテンソルで返す
+        """
+        if self.is_siamese or self.is_binary_classifier:
+            return metrics.count_threshold_correct(predicted, y)
+        return metrics.count_class_correct(predicted, y)
+
+    def calc_collect_rate_on_device(self, predicted, y) -> torch.Tensor:
+        return metrics.calc_rate(self.count_collect(predicted, y), y.size(0))
 
     def calc_collect_rate(self, predicted, y):
-        n_total = y.size(0)
-        if self.is_siamese:
-            correct_num = 0
-            for predicted_param, teacher in zip(predicted, y):
-                if teacher < 0.5 and predicted_param < 0.5:
-                    correct_num = correct_num + 1
-                if teacher > 0.5 and predicted_param > 0.5:
-                    correct_num = correct_num + 1
-            return correct_num/n_total
-        if self.is_binary_classifier:
-            correct_num = 0
-            for predicted_param, teacher in zip(predicted, y):
-                if teacher[0] < 0.5 and predicted_param < 0.5:
-                    correct_num = correct_num + 1
-                if teacher[0] > 0.5 and predicted_param > 0.5:
-                    correct_num = correct_num + 1
-            return correct_num/n_total
-        correct_num = (predicted == y).sum().item()
-        return correct_num/n_total
+        return self.calc_collect_rate_on_device(predicted, y).item()
+
+    @property
+    def metric_materializer(self):
+        return metrics.materialize_rows
 
     def build_evaluate_output(self, x, y):
-        self.__model.eval()
+        self.set_model_to_device()
+        self.become_eval_mode()
+        # 使い回す入力のテンソルを推論モードの外で書き込むため、送ってから推論モードに入る
         x, y = self.convert_data_for_model(x, y)
-        outputs = self.__model(x)
+        with torch.inference_mode(), self.autocast():
+            outputs = self.forward_model(x)
         return outputs, x, y
 
     def evaluate(self, x, y, sample_weight=None):
         outputs, x, y = self.build_evaluate_output(x, y)
-        loss = self.__loss(outputs, y, True)
-        running_loss = loss.item()
-        predicted = self.get_predicted(outputs, False)
-        return running_loss, self.calc_collect_rate(predicted, y)
+        with torch.inference_mode(), self.autocast():
+            loss = self.__loss(outputs, y, True)
+            running_loss = loss.item()
+            predicted = self.get_predicted(outputs, False)
+            return running_loss, self.calc_collect_rate(predicted, y)
 
     def add_output_param_to_batch_log_param(self, outs, batch_logs):
         batch_logs["loss"] = outs[0]
@@ -452,6 +680,26 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
         return ["loss", "accuracy", "val_loss", "val_accuracy"]
 
 
+    def get_resume_model_state(self) -> dict:
+        return {"model": self.__model.state_dict(),
+                "optimizer": self.__optimizer.state_dict(),
+                "torch_random": torch.get_rng_state(),
+                "cuda_random": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+    def set_resume_model_state(self, state: dict):
+        self.__model.load_state_dict(state["model"])
+        self.__model.to(self.__torch_device)
+        self.__optimizer.load_state_dict(state["optimizer"])
+        torch.set_rng_state(state["torch_random"])
+        if state["cuda_random"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda_random"])
+
+    def write_resume_state(self, file_path: str, state: dict):
+        torch.save(state, file_path)
+
+    def read_resume_state(self, file_path: str) -> dict:
+        return torch.load(file_path, map_location="cpu")
+
     def build_model_file_name(self, model_name):
         return model_name + ".pt"
 
@@ -473,7 +721,8 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
              validation_steps: Optional[int] = None,
              save_weights_only: bool = False,
              will_use_multi_inputs_per_one_image: bool = False,
-             input_data_preprocess_for_building_multi_data=None
+             input_data_preprocess_for_building_multi_data=None,
+             fit_setting: Optional[FitSetting] = None
              ):
         """
         指定したデータセットに対しての正答率を算出する
@@ -490,10 +739,13 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param input_data_preprocess_for_building_multi_data:
+        :param fit_setting: データ読み込みのワーカー数などの設定
         :return:
         """
         write_dir_path = build_record_path(result_dir_name, dir_path)
         save_tmp_name = self.build_best_model_file_name(model_name)
+        if fit_setting is not None:
+            fit_setting = fit_setting.with_default_checkpoint_dir(os.path.join(write_dir_path, "resume"))
         self.fit_generator(image_generator,
                            epochs,
                            validation_data,
@@ -502,9 +754,11 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
                            temp_best_path=os.path.join(write_dir_path, save_tmp_name),
                            save_weights_only=save_weights_only,
                            will_use_multi_inputs_per_one_image=will_use_multi_inputs_per_one_image,
-                           data_preprocess=input_data_preprocess_for_building_multi_data)
-        self.record_model(result_dir_name, dir_path, model_name)
-        self.record_conf_json(result_dir_name, dir_path, normalize_type, model_name)
+                           data_preprocess=input_data_preprocess_for_building_multi_data,
+                           fit_setting=fit_setting)
+        if self.is_main_process:
+            self.record_model(result_dir_name, dir_path, model_name)
+            self.record_conf_json(result_dir_name, dir_path, normalize_type, model_name)
 
     def fit_generator(self,
                       image_generator,
@@ -515,7 +769,8 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
                       temp_best_path: str = "",
                       save_weights_only: bool = False,
                       will_use_multi_inputs_per_one_image: bool = False,
-                      data_preprocess=None):
+                      data_preprocess=None,
+                      fit_setting: Optional[FitSetting] = None):
         """
         モデルの適合度を算出する
         :param image_generator: ファイルパスから学習データを生成する生成器
@@ -527,29 +782,77 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
         :param save_weights_only:
         :param will_use_multi_inputs_per_one_image:
         :param data_preprocess:
+        :param fit_setting: データ読み込みのワーカー数などの設定
         :return:
         """
+        runtime_config = get_runtime_config()
+        if runtime_config is not None:
+            # 分散学習の起動時などにtorchのスレッド数が変えられていても実行時設定に揃える
+            runtime_config.apply_torch()
         self.__model = self.run_preprocess_model(self.__model)
-        self.__model.to(self.__torch_device)
-        if validation_data is None:
-            self.fit_generator_for_expantion(image_generator,
-                                             epochs=epochs,
-                                             steps_per_epoch=steps_per_epoch,
-                                             temp_best_path=temp_best_path,
-                                             save_weights_only=save_weights_only,
-                                             data_preprocess=data_preprocess)
-        else:
-            self.fit_generator_for_expantion(image_generator,
-                                             steps_per_epoch=steps_per_epoch,
-                                             validation_steps=validation_steps,
-                                             epochs=epochs,
-                                             validation_data=validation_data,
-                                             temp_best_path=temp_best_path,
-                                             save_weights_only=save_weights_only,
-                                             data_preprocess=data_preprocess)
+        self.__model.to(self.__torch_device, memory_format=self.__tensor_stager.memory_format)
+        if distributed.is_distributed():
+            image_generator = distributed.shard_sequence(image_generator)
+            if steps_per_epoch is not None:
+                steps_per_epoch = min(steps_per_epoch, len(image_generator))
+        image_generator, validation_data, data_preprocess = self.use_feature_cache(image_generator,
+                                                                                   validation_data,
+                                                                                   data_preprocess)
+        try:
+            if validation_data is None:
+                self.fit_generator_for_expantion(image_generator,
+                                                 epochs=epochs,
+                                                 steps_per_epoch=steps_per_epoch,
+                                                 temp_best_path=temp_best_path,
+                                                 save_weights_only=save_weights_only,
+                                                 data_preprocess=data_preprocess,
+                                                 fit_setting=fit_setting)
+            else:
+                self.fit_generator_for_expantion(image_generator,
+                                                 steps_per_epoch=steps_per_epoch,
+                                                 validation_steps=validation_steps,
+                                                 epochs=epochs,
+                                                 validation_data=validation_data,
+                                                 temp_best_path=temp_best_path,
+                                                 save_weights_only=save_weights_only,
+                                                 data_preprocess=data_preprocess,
+                                                 fit_setting=fit_setting)
+        finally:
+            self.__suffix_model = None
 
         return self
 
+    def use_feature_cache(self, image_generator, validation_data, data_preprocess):
+        """
+        固定したレイヤーの出力を保存できる場合は、学習データと検証データを保存した出力を読み込むものに置き換え、
+        学習中は残りのレイヤーだけで順伝播する 置き換えたデータにはdata_preprocessを適用済みなので以降は使わない
+        学習データと検証データのどちらかを保存できない場合は置き換えない
+        :return: 学習に使うデータ、検証データ、data_preprocess
+        """
+        not_cached = image_generator, validation_data, data_preprocess
+        if self.feature_cache is None:
+            return not_cached
+        if self.is_siamese or distributed.is_distributed():
+            print("feature cache is not supported for siamese networks and distributed training")
+            return not_cached
+        frozen_prefix = PytorchFrozenPrefix(self.__model,
+                                            lambda x: self.__tensor_stager.to_device("prefix_x", x, self.__x_type))
+        if frozen_prefix.depth == 0:
+            print("feature cache is disabled because no layer is frozen")
+            return not_cached
+        if self.feature_cache.can_cache(image_generator) is False or \
+                (validation_data is not None and self.feature_cache.can_cache(validation_data) is False):
+            return not_cached
+        train_sequence = self.feature_cache.build_sequence(frozen_prefix, image_generator, True, data_preprocess)
+        validation_sequence = None if validation_data is None else \
+            self.feature_cache.build_sequence(frozen_prefix, validation_data, False, data_preprocess)
+        if train_sequence is None or (validation_data is not None and validation_sequence is None):
+            return not_cached
+        self.__suffix_model = frozen_prefix.build_suffix_model()
+        self.__suffix_model.train(self.__model.training)
+        print("train layers after the", frozen_prefix.depth, "frozen layers on cached features")
+        return train_sequence, validation_sequence, None
+
     def save_model(self, file_path):
         self.__model.to("cpu")
         torch.save(self.__model, file_path)
@@ -577,18 +880,16 @@ class ModelForPytorch(AbstractModel, AbsExpantionEpoch):
         original_model.to(self.__torch_device)
         converted_x = self.numpy2tensor(transpose(original_x), self.__x_type)
         converted_y = self.numpy2tensor(original_y, torch.long)
-        original_output = original_model(converted_x)
+        with torch.inference_mode(), self.autocast():
+            original_output = original_model(converted_x)
         return original_output, converted_y
 
     def calc_original_rate_for_siamese(self,
                                        predicted_data,
                                        original_y,
                                        margin):
-        _, predicted = torch_max(predicted_data, 1)
-        abstract_predict = torch.abs(predicted - original_y)
-        correct_num = (abstract_predict < margin).sum().item()
-        n_total = original_y.size(0)
-        return correct_num/n_total
+        abstract_predict = torch.abs(metrics.predict_classes(predicted_data) - original_y)
+        return metrics.calc_rate((abstract_predict < margin).sum(), original_y.size(0)).item()
 
     def evaluate_siamese(self,
                          siamese_x,
@@ -696,24 +997,11 @@ class ModelForPytorchSiamese(ModelForPytorch):
         siamese_x, siamese_y = data_preprocess(x, y)
         return siamese_x, siamese_y, sample_weight, x, y
 
-    def calc_collect_rate(self, predicted, y):
-        n_total = y.size(0)
-        correct_num = 0
-        for predicted_param, teacher in zip(predicted, y):
-            if teacher < 0.5 and predicted_param < 0.5:
-                correct_num = correct_num + 1
-            if teacher > 0.5 and predicted_param > 0.5:
-                correct_num = correct_num + 1
-        return correct_num/n_total
+    def count_collect(self, predicted, y) -> torch.Tensor:
+        return metrics.count_threshold_correct(predicted, y)
 
     def get_predicted(self, outputs, is_training: bool = True):
-        if is_training is False:
-            return self.get_siamese_predicted_batch(outputs)
-        x0, x1 = outputs
-        predicted = [self.get_siamese_predicted(param0, param1) for param0, param1 in zip(x0.logits, x1.logits)]
-        aux_predicted = [self.get_siamese_predicted(param0, param1) for param0, param1
-                         in zip(x0.aux_logits, x1.aux_logits)]
-        return predicted, aux_predicted
+        return self.get_siamese_inceptionV3_predicted(outputs, is_training)
 
     def one_batch_val(self,
                       val_enqueuer_gen,
@@ -813,13 +1101,7 @@ class ModelForPytorchSiameseInceptionV3(ModelForPytorch):
         return running_loss, siamese_collect_rate, correct_rate
 
     def get_predicted(self, outputs, is_training: bool = True):
-        if is_training is False:
-            return self.get_siamese_predicted_batch(outputs)
-        x0, x1 = outputs
-        predicted = [self.get_siamese_predicted(param0, param1) for param0, param1 in zip(x0.logits, x1.logits)]
-        aux_predicted = [self.get_siamese_predicted(param0, param1) for param0, param1
-                         in zip(x0.aux_logits, x1.aux_logits)]
-        return predicted, aux_predicted
+        return self.get_siamese_inceptionV3_predicted(outputs, is_training)
 
     def train_on_batch(self,
                        x,
@@ -828,19 +1110,10 @@ class ModelForPytorchSiameseInceptionV3(ModelForPytorch):
                        data_preprocess=None):
         self.set_model_to_device()
         self.become_train_mode()
-        self.optimizer.zero_grad()
+        self.begin_accumulation()
         x, y = self.convert_data_for_model(x, y)
-        outputs = self.model(x)
-        loss, aux_loss = self.loss(outputs, y)
-        loss.backward(retain_graph=True)
-        running_loss = loss.item()
-        aux_loss.backward(retain_graph=True)
-        aux_running_loss = aux_loss.item()
-        self.__optimizer.step()
-        predicted, aux_predicted = self.get_predicted(outputs)
-        collect_rate = self.calc_collect_rate(predicted, y[0])
-        aux_collect_rate = self.calc_collect_rate(aux_predicted, y[1])
-        return running_loss, collect_rate, aux_running_loss, aux_collect_rate
+        self.step_timer.lap("to_device", True)
+        return self.train_siamese_inceptionV3_on_batch(x, y)
 
 
 class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
@@ -852,7 +1125,7 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
                  torch_device,
                  class_set: List[str],
                  decide_dataset_generator,
-                 callbacks: Optional[List[keras.callbacks.Callback]] = None,
+                 callbacks: Optional[List[Callback]] = None,
                  monitor: str = "",
                  preprocess_for_model=None,
                  after_learned_process: Optional[Callable[[None], None]] = None,
@@ -888,7 +1161,7 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
                          steps_done: int,
                          sample_weight=None,
                          data_preprocess=None):
-        self.model.eval()
+        self.become_eval_mode()
         correct_rate = self.build_calc_succeed_rate_dataset(siamese_x[0],
                                                             original_y,
                                                             data_preprocess,
@@ -904,7 +1177,8 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
                                         steps_done: int,
                                         is_training=False):
         margin = data_preprocess.margin if isinstance(data_preprocess, SiameseLearnerDataBuilder) else 1
-        base_predicted = self.model.get_original_predict(self.numpy2tensor(x, self.x_type))
+        with torch.inference_mode():
+            base_predicted = self.model.get_original_predict(self.numpy2tensor(x, self.x_type))
         sample_predicted, sample_teacher = self.get_predict_sample_data(data_preprocess, steps_done, is_training)
         if is_training:
             main_predicted = self.get_classes_from_distances(base_predicted.logits.cpu().detach().numpy().copy(),
@@ -957,7 +1231,8 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
                                                                                       decide_batch_y,
                                                                                       True)
             use_batch = self.get_pair_for_predict_input(x, decide_batch_x)
-            predicted_result = self.model(use_batch)
+            with torch.inference_mode():
+                predicted_result = self.model(use_batch)
             main_distances, aux_distances = self.calc_result_distances_for_train_mode(predicted_result)
             neigbor_recorder = self.decide_class_from_distance(main_distances,
                                                                decide_batch_y[0],
@@ -973,7 +1248,8 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
 
     def calc_class_from_distance(self, base_predict, sample_predicted, sample_teacher):
         use_base_predict_set = torch.from_numpy(np.array([base_predict for _ in sample_predicted]))
-        distances = self.loss.calc_distance(use_base_predict_set, sample_predicted).cpu().detach().numpy()
+        with torch.inference_mode():
+            distances = self.loss.calc_distance(use_base_predict_set, sample_predicted).cpu().detach().numpy()
         return self.decide_class_from_distance(distances, sample_teacher).get_predicted_index()
 
     def get_predicted_from_a_data(self, x, data_preprocess, is_training: bool = False):
@@ -986,8 +1262,9 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
             decide_batch_x, decide_batch_y = next(self.__decide_dataset_generator)
             decide_batch_x, decide_batch_y = data_preprocess.preprocess_for_calc_data(decide_batch_x, decide_batch_y)
             use_batch = self.get_pair_for_predict_input(x, decide_batch_x)
-            predicted_result = self.model(use_batch)
-            distances = self.loss.calc_distance(predicted_result[0], predicted_result[1])
+            with torch.inference_mode():
+                predicted_result = self.model(use_batch)
+                distances = self.loss.calc_distance(predicted_result[0], predicted_result[1])
             distances = distances.cpu().detach().numpy().copy()
             for distance, class_index in zip(distances, decide_batch_y):
                 neighbor_recorder.record(distance, class_index)
@@ -1004,7 +1281,8 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
             decide_batch_x, decide_batch_y = data_preprocess.preprocess_for_calc_data(decide_batch_x,
                                                                                       decide_batch_y,
                                                                                       is_training)
-            predicted = self.model.get_original_predict(self.numpy2tensor(decide_batch_x, self.x_type))
+            with torch.inference_mode():
+                predicted = self.model.get_original_predict(self.numpy2tensor(decide_batch_x, self.x_type))
             if is_training:
                 predicted = (predicted.logits.cpu().detach().numpy(), predicted.aux_logits.cpu().detach().numpy())
                 predicted_results = predicted if index == 0 else (np.append(predicted_results[0], predicted[0], axis=0), np.append(predicted_results[1], predicted[1], axis=0))
@@ -1031,36 +1309,9 @@ class ModelForPytorchSiameseDecidebyDistance(ModelForPytorchSiamese):
         if self.__will_calc_real_data_train:
             succeed_rate = (self.build_calc_succeed_rate_dataset(x[0], original_y, data_preprocess, steps_done, True),)
             outs = outs + succeed_rate
-            self.model.train()
+            self.become_train_mode()
         return self.run_after_finished_batch(outs, batch_logs, callbacks, batch_index, steps_done)
 
-    def train_on_batch(self, x, y, sample_weight=None, data_preprocess=None):
-        self.model.to(self.torch_device)
-        self.model.train()
-        self.optimizer.zero_grad()
-        x, y = self.convert_data_for_model(x, y)
-        outputs = self.model(x)
-        if self.is_siamese_inceptionV3:
-            loss, aux_loss = self.loss(outputs, y)
-            loss.backward(retain_graph=True)
-            running_loss = loss.item()
-            aux_loss.backward(retain_graph=True)
-            aux_running_loss = aux_loss.item()
-            self.optimizer.step()
-            predicted, aux_predicted = self.get_predicted(outputs)
-            collect_rate = self.calc_collect_rate(predicted, y[0])
-            aux_collect_rate = self.calc_collect_rate(aux_predicted, y[1])
-            return running_loss, collect_rate, aux_running_loss, aux_collect_rate
-        if self.is_inceptionV3:
-            loss = self.loss(outputs.logits, y)
-            self.optimizer.step()
-            running_loss = loss.item()
-            predicted = self.get_predicted(outputs.logits)
-            if outputs.aux_logits is not None:
-                aux_loss = self.__loss(outputs.aux_logits, y)
-                self.optimizer.step()
-            return running_loss, self.calc_collect_rate(predicted, y)
-
     def add_output_param_to_batch_log_param(self, outs, batch_logs):
         batch_logs["loss"] = outs[0]
         batch_logs["accuracy"] = outs[1]
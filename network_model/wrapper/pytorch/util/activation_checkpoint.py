@@ -0,0 +1,211 @@
+import functools
+import inspect
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Union
+import torch
+import torch.nn
+from torch.nn.modules.batchnorm import _BatchNorm
+from torch.utils.checkpoint import checkpoint
+from torchvision.models.inception import Inception3, InceptionA, InceptionB, InceptionC, InceptionD, InceptionE
+from torchvision.models.mobilenetv2 import MobileNetV2
+from torchvision.models.resnet import ResNet
+
+ActivationCheckpointSetting = Union[int, Dict[str, int]]
+
+INCEPTION_STAGES = {"mixed_5": ["Mixed_5b", "Mixed_5c", "Mixed_5d"],
+                    "mixed_6": ["Mixed_6a", "Mixed_6b", "Mixed_6c", "Mixed_6d", "Mixed_6e"],
+                    "mixed_7": ["Mixed_7a", "Mixed_7b", "Mixed_7c"]}
+
+RESNET_STAGES = ["layer1", "layer2", "layer3", "layer4"]
+
+MOBILENET_V2_STAGES = ["features"]
+
+# use_reentrantはtorch 1.11で追加された それより前のtorchではreentrantな再計算だけを使える
+CAN_USE_NON_REENTRANT = "use_reentrant" in inspect.signature(checkpoint).parameters
+
+
+def will_checkpoint(module: torch.nn.Module) -> bool:
+    """
+    学習中で勾配を計算する場合だけ活性を捨てて逆伝播時に再計算する
+    評価やjit.traceでの保存では通常通り順伝播する
+    """
+    return module.training and torch.is_grad_enabled() and torch.jit.is_tracing() is False
+
+
+class CheckpointedSequential(torch.nn.Sequential):
+    """
+    中のブロックをsegments個の区間に分け、区間の入力だけを残して区間内の活性を逆伝播時に再計算するSequential
+    元のSequentialのクラスを差し替えて使うので、パラメータの名前は変わらず保存済みの重みをそのまま読み込める
+    """
+    segments = 0
+
+    def build_segments(self) -> List[List[torch.nn.Module]]:
+        blocks = list(self)
+        segment_num = min(self.segments, len(blocks))
+        segment_size = (len(blocks) + segment_num - 1) // segment_num
+        return [blocks[index:index + segment_size] for index in range(0, len(blocks), segment_size)]
+
+    def forward(self, x):
+        if self.segments <= 0 or will_checkpoint(self) is False:
+            return super(CheckpointedSequential, self).forward(x)
+        for segment in self.build_segments():
+            x = checkpoint_forward(functools.partial(run_segment, blocks=segment), segment, x)
+        return x
+
+
+def run_segment(x, blocks: List[torch.nn.Module]):
+    for block in blocks:
+        x = block(x)
+    return x
+
+
+def list_batch_norms(modules: List[torch.nn.Module]) -> List[_BatchNorm]:
+    return [module for root in modules for module in root.modules()
+            if isinstance(module, _BatchNorm) and module.track_running_stats]
+
+
+class SegmentFunction(object):
+    """
+    再計算する区間の順伝播 2回目以降の呼び出しは逆伝播時の再計算なので、
+    BatchNormの移動平均を呼び出し前の値に戻し、1ステップで2回更新されないようにする
+    """
+
+    def __init__(self, function: Callable, modules: List[torch.nn.Module]):
+        self.__function = function
+        self.__batch_norms = list_batch_norms(modules)
+        self.__has_run = False
+
+    def __call__(self, x, *dummy):
+        if self.__has_run is False or len(self.__batch_norms) == 0:
+            self.__has_run = True
+            return self.__function(x)
+        saved_stats = [[buffer.clone() for buffer in (bn.running_mean, bn.running_var, bn.num_batches_tracked)]
+                       for bn in self.__batch_norms]
+        try:
+            return self.__function(x)
+        finally:
+            with torch.no_grad():
+                for bn, (running_mean, running_var, num_batches_tracked) in zip(self.__batch_norms, saved_stats):
+                    bn.running_mean.copy_(running_mean)
+                    bn.running_var.copy_(running_var)
+                    bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_forward(function: Callable, modules: List[torch.nn.Module], x):
+    """
+    区間の活性を捨てて順伝播し、逆伝播時に再計算する
+    reentrantな再計算では入力が勾配を必要としないと区間内のパラメータの勾配が計算されないので、
+    その場合は勾配を必要とするダミーの入力を一緒に渡す
+    """
+    segment_function = SegmentFunction(function, modules)
+    if CAN_USE_NON_REENTRANT:
+        return checkpoint(segment_function, x, use_reentrant=False)
+    if x.requires_grad:
+        return checkpoint(segment_function, x)
+    return checkpoint(segment_function, x, torch.ones(1, requires_grad=True))
+
+
+class CheckpointedBlock(object):
+    """
+    ブロック単位で活性を再計算するためのmixin Inceptionのブロックのように兄弟のモジュールを親のforwardで
+    順に呼び出している場合に、各ブロックのクラスを差し替えて使う
+    """
+
+    def forward(self, x):
+        if will_checkpoint(self) is False:
+            return super(CheckpointedBlock, self).forward(x)
+        return checkpoint_forward(super(CheckpointedBlock, self).forward, [self], x)
+
+
+class CheckpointedInceptionA(CheckpointedBlock, InceptionA):
+    pass
+
+
+class CheckpointedInceptionB(CheckpointedBlock, InceptionB):
+    pass
+
+
+class CheckpointedInceptionC(CheckpointedBlock, InceptionC):
+    pass
+
+
+class CheckpointedInceptionD(CheckpointedBlock, InceptionD):
+    pass
+
+
+class CheckpointedInceptionE(CheckpointedBlock, InceptionE):
+    pass
+
+
+CHECKPOINTED_BLOCKS = {InceptionA: CheckpointedInceptionA,
+                       InceptionB: CheckpointedInceptionB,
+                       InceptionC: CheckpointedInceptionC,
+                       InceptionD: CheckpointedInceptionD,
+                       InceptionE: CheckpointedInceptionE}
+
+
+def build_stage_segments(stage_names: List[str], setting: ActivationCheckpointSetting) -> Dict[str, int]:
+    if isinstance(setting, dict):
+        return {name: setting.get(name, 0) for name in stage_names}
+    return {name: setting for name in stage_names}
+
+
+def checkpoint_sequential_stage(stage: torch.nn.Module, segments: int) -> bool:
+    if segments <= 0 or type(stage) not in (torch.nn.Sequential, CheckpointedSequential):
+        return False
+    stage.__class__ = CheckpointedSequential
+    stage.segments = segments
+    return True
+
+
+def checkpoint_block(block: torch.nn.Module) -> bool:
+    checkpointed_type = CHECKPOINTED_BLOCKS.get(type(block))
+    if checkpointed_type is None:
+        return False
+    block.__class__ = checkpointed_type
+    return True
+
+
+def apply_to_backbone(model: torch.nn.Module, setting: ActivationCheckpointSetting) -> List[str]:
+    """
+    torchvisionのバックボーン1つに設定を適用する
+    :return: 適用したステージの名前
+    """
+    applied = []
+    if isinstance(model, Inception3):
+        # Inceptionのブロックは親のforwardで順に呼ばれるので、ステージ内の各ブロックを1区間として再計算する
+        for stage_name, segments in build_stage_segments(list(INCEPTION_STAGES.keys()), setting).items():
+            if segments > 0 and all([checkpoint_block(getattr(model, name)) for name in INCEPTION_STAGES[stage_name]]):
+                applied.append(stage_name)
+        return applied
+    stage_names = RESNET_STAGES if isinstance(model, ResNet) else \
+        MOBILENET_V2_STAGES if isinstance(model, MobileNetV2) else []
+    for stage_name, segments in build_stage_segments(stage_names, setting).items():
+        if checkpoint_sequential_stage(getattr(model, stage_name), segments):
+            applied.append(stage_name)
+    return applied
+
+
+def apply_activation_checkpoint(model: torch.nn.Module,
+                                setting: Optional[ActivationCheckpointSetting]) -> torch.nn.Module:
+    """
+    モデルに含まれるtorchvisionのMobileNetV2, ResNet, Inception3のステージの活性を捨て、逆伝播時に再計算する
+    Siameseネットワークのように中にバックボーンを持つモデルにも適用できる
+    再計算の分だけ学習が遅くなる代わりに、活性を保持するメモリが減り大きなバッチで学習できる
+    BatchNormの移動平均は再計算の前の値に戻すので、再計算しない場合と同じく1ステップに1回だけ更新される
+    :param model: 適用するモデル
+    :param setting: ステージ名と区間数の辞書 整数を渡すと全てのステージに同じ区間数を使う
+                    区間数が0のステージは再計算しない 区間数が少ないほど残す活性が減り、区間内の再計算で使うメモリが増える
+                    MobileNetV2はfeatures, ResNetはlayer1からlayer4, Inception3はmixed_5, mixed_6, mixed_7のステージがある
+    :return: 適用したモデル
+    """
+    if setting is None or isinstance(model, torch.jit.ScriptModule):
+        return model
+    for name, module in model.named_modules():
+        applied = apply_to_backbone(module, setting)
+        if len(applied) > 0:
+            print("activation checkpoint", type(module).__name__, name, applied)
+    return model
@@ -1,4 +1,4 @@
-from keras.callbacks import Callback
+from network_model.wrapper.callbacks import Callback
 from model_merger.pytorch.siamese import SiameseNetworkPT
 import numpy as np
 import torch
@@ -42,6 +42,9 @@ class PytorchCheckpoint(Callback):
         logs = logs or {}
         if self.save_best_only:
             current = logs.get(self.monitor)
+            if current is None:
+                print("Can save best model only with %s available, skipping." % self.monitor)
+                return
             if self.monitor_op(current, self.best):
                 self.best = current
                 self.__base_model.to("cpu")
@@ -101,6 +104,9 @@ class PytorchSiameseCheckpoint(PytorchCheckpoint):
         record_model = self.base_model.original_model
         if self.save_best_only:
             current = logs.get(self.monitor)
+            if current is None:
+                print("Can save best model only with %s available, skipping." % self.monitor)
+                return
             if self.monitor_op(current, self.best):
                 self.best = current
                 record_model.to("cpu")
@@ -0,0 +1,180 @@
+import contextlib
+import os
+import random
+from typing import Callable
+from typing import List
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing
+from network_model.wrapper.sequence import Sequence
+
+DEFAULT_MASTER_PORT = 29500
+DEFAULT_BUCKET_CAP_MB = 25
+
+_local_depth = 0
+
+
+def is_distributed() -> bool:
+    if _local_depth > 0:
+        return False
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+@contextlib.contextmanager
+def run_locally():
+    """
+    このwithブロックの中では分散学習していないものとして扱い、DistributedDataParallelで包まず集団通信も行わない
+    1つのプロセスだけで行う計測などに使う
+    """
+    global _local_depth
+    _local_depth += 1
+    try:
+        yield
+    finally:
+        _local_depth -= 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """
+    ファイルの書き出しやログの表示を行うプロセスかどうか 分散学習していなければ常にTrue
+    """
+    return get_rank() == 0
+
+
+def broadcast_int(value: int, src: int = 0) -> int:
+    """
+    分散学習している場合はsrcのプロセスの値に揃える
+    """
+    if is_distributed() is False:
+        return value
+    tensor = torch.tensor([value], dtype=torch.long)
+    dist.broadcast(tensor, src)
+    return int(tensor.item())
+
+
+def split_cores(rank: int, world_size: int) -> List[int]:
+    """
+    使用できるCPUコアをプロセス数で等分し、rank番目のプロセスが使うコアを返す
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    core_num = max(len(cores) // world_size, 1)
+    return cores[(rank * core_num) % len(cores):][:core_num]
+
+
+def pin_cores(rank: int, world_size: int):
+    cores = split_cores(rank, world_size)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    print("rank", rank, "uses cores", cores)
+
+
+def run_rank(rank: int, world_size: int, run: Callable, args: tuple, master_port: int, seed: int):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(master_port)
+    pin_cores(rank, world_size)
+    # 学習データの並び替えを全プロセスで揃えるため、乱数のシードを揃える
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        run(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(procs: int,
+           run: Callable,
+           args: tuple = (),
+           master_port: int = DEFAULT_MASTER_PORT,
+           seed: int = 0):
+    """
+    localhostでgloo backendのプロセスをprocs個起動し、それぞれでrunを実行する
+    各プロセスは使用できるCPUコアを等分して使う
+    :param procs: プロセス数 1以下なら分散せずにそのまま実行する
+    :param run: 各プロセスで実行する関数 spawnで渡すのでモジュールのトップレベルで定義したものにする
+    :param args: runに渡す引数
+    :param master_port: プロセス間の通信に使うポート
+    :param seed: 全プロセスで揃える乱数のシード
+    """
+    if procs <= 1:
+        run(*args)
+        return
+    torch.multiprocessing.spawn(run_rank,
+                                args=(procs, run, args, master_port, seed),
+                                nprocs=procs,
+                                join=True)
+
+
+class ShardedSequence(Sequence):
+    """
+    分散学習の各プロセスに学習データを重複なく割り当てるSequence
+    全プロセスで同じシードの並び替えを使い、i番目のバッチをi % プロセス数番目のプロセスに割り当てる
+    どのプロセスも同じステップ数になるよう、割り切れない分のデータは使わない
+    flow_from_directoryのデータはデータ単位で、それ以外のSequenceはバッチ単位で割り当てる
+    """
+
+    def __init__(self, sequence, rank: int, world_size: int, seed: int = 0):
+        """
+
+        :param sequence: 元の学習データ
+        :param rank: このプロセスの番号
+        :param world_size: プロセス数
+        :param seed: 並び替えの乱数のシード
+        """
+        self.__sequence = sequence
+        self.__rank = rank
+        self.__world_size = world_size
+        self.__seed = seed
+        self.__epoch = 0
+        self.__is_sample_level = hasattr(sequence, "_get_batches_of_transformed_samples") \
+            and hasattr(sequence, "n") and hasattr(sequence, "batch_size")
+        self.__index_array = self.build_index_array()
+
+    @property
+    def index_array(self) -> np.ndarray:
+        return self.__index_array
+
+    @index_array.setter
+    def index_array(self, index_array: np.ndarray):
+        self.__index_array = index_array
+
+    def build_index_array(self) -> np.ndarray:
+        item_num = self.__sequence.n if self.__is_sample_level else len(self.__sequence)
+        return np.random.RandomState(self.__seed + self.__epoch).permutation(item_num)
+
+    def __len__(self):
+        if self.__is_sample_level:
+            return self.__sequence.n // (self.__sequence.batch_size * self.__world_size)
+        return len(self.__sequence) // self.__world_size
+
+    def __getitem__(self, idx):
+        global_index = idx * self.__world_size + self.__rank
+        if self.__is_sample_level is False:
+            return self.__sequence[int(self.__index_array[global_index])]
+        batch_size = self.__sequence.batch_size
+        index_array = self.__index_array[batch_size * global_index:batch_size * (global_index + 1)]
+        return self.__sequence._get_batches_of_transformed_samples(index_array)
+
+    def on_epoch_end(self):
+        self.__epoch += 1
+        self.__index_array = self.build_index_array()
+
+
+def shard_sequence(sequence):
+    """
+    分散学習している場合は学習データをこのプロセスの分だけにする
+    """
+    if is_distributed() is False:
+        return sequence
+    return ShardedSequence(sequence, get_rank(), get_world_size())
@@ -0,0 +1,108 @@
+import copy
+import hashlib
+from collections import OrderedDict
+from typing import Callable
+from typing import Set
+import numpy as np
+import torch
+import torch.nn
+from model_preprocessor.weight.fix_pt import list_named_layers
+from model_preprocessor.weight.fix_pt import count_frozen_layers
+
+
+class PrefixOutput(Exception):
+    """
+    固定したレイヤーの最後の出力が得られた時点で順伝播を打ち切るための例外
+    """
+
+    def __init__(self, output):
+        super(PrefixOutput, self).__init__("frozen prefix output")
+        self.output = output
+
+
+def raise_prefix_output(module: torch.nn.Module, inputs, outputs):
+    raise PrefixOutput(outputs)
+
+
+def replace_layers(module: torch.nn.Module, replaced_ids: Set[int]) -> torch.nn.Module:
+    """
+    replaced_idsのレイヤーをIdentityに置き換えたモジュールを返す
+    置き換えたレイヤーの親だけを浅くコピーするので、それ以外のレイヤーとパラメータは元のモジュールと共有する
+    """
+    replaced_children = {}
+    for name, child in module.named_children():
+        if id(child) in replaced_ids:
+            replaced_children[name] = torch.nn.Identity()
+        elif type(child) is torch.nn.Sequential:
+            replaced_child = replace_layers(child, replaced_ids)
+            if replaced_child is not child:
+                replaced_children[name] = replaced_child
+    if len(replaced_children) == 0:
+        return module
+    copied = copy.copy(module)
+    copied._modules = OrderedDict(module._modules)
+    copied._modules.update(replaced_children)
+    return copied
+
+
+class PytorchFrozenPrefix(object):
+    """
+    Pytorchのモデルの入力側から続いている固定したレイヤー
+    モデルのforwardが子のレイヤーを登録した順に呼び出すtorchvisionのバックボーンのようなモデルに使う
+    """
+
+    def __init__(self, model: torch.nn.Module, to_tensor: Callable[[np.ndarray], torch.Tensor]):
+        """
+
+        :param model: 固定したレイヤーを持つモデル
+        :param to_tensor: numpyのバッチをモデルの入力のテンソルにする関数
+        """
+        self.__model = model
+        self.__to_tensor = to_tensor
+        self.__depth = count_frozen_layers(model)
+
+    @property
+    def depth(self) -> int:
+        return self.__depth
+
+    @property
+    def layers(self):
+        return list_named_layers(self.__model)[:self.__depth]
+
+    def build_hash(self) -> str:
+        digest = hashlib.sha1()
+        for _, name, layer in self.layers:
+            digest.update((name + type(layer).__name__).encode("utf8"))
+            for key, value in layer.state_dict().items():
+                digest.update(key.encode("utf8"))
+                digest.update(value.detach().cpu().reshape(-1).contiguous().view(torch.uint8).numpy().tobytes())
+        return digest.hexdigest()
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        """
+        評価モードで順伝播し、固定したレイヤーの最後の出力を返す 以降のレイヤーは計算しない
+        """
+        _, _, last_layer = self.layers[-1]
+        handle = last_layer.register_forward_hook(raise_prefix_output)
+        was_training = self.__model.training
+        self.__model.eval()
+        try:
+            with torch.no_grad():
+                self.__model(self.__to_tensor(x))
+        except PrefixOutput as e:
+            return e.output.float().cpu().numpy()
+        finally:
+            handle.remove()
+            self.__model.train(was_training)
+        raise RuntimeError("frozen layers were not called in the forward of the model")
+
+    def build_suffix_model(self) -> torch.nn.Module:
+        """
+        固定したレイヤーをIdentityに置き換え、固定したレイヤーの出力を入力にして残りのレイヤーだけを計算するモデルを作る
+        パラメータは元のモデルと共有しているので、このモデルで学習すると元のモデルが更新される
+        """
+        suffix_model = replace_layers(self.__model, {id(layer) for _, _, layer in self.layers})
+        if suffix_model is not self.__model and getattr(suffix_model, "transform_input", False):
+            # Inception3の入力の変換は固定したレイヤーの前の処理なので、保存した出力には適用しない
+            suffix_model.transform_input = False
+        return suffix_model
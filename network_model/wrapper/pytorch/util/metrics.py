@@ -0,0 +1,82 @@
+from typing import List
+import torch
+from torch import Tensor
+
+DECIDE_THRESHOLD = 0.5
+
+
+def predict_classes(outputs: Tensor) -> Tensor:
+    """
+    多クラス分類の出力から予測したクラスのインデックスを求める
+    """
+    return torch.argmax(outputs.detach(), 1)
+
+
+def predict_binary(outputs: Tensor) -> Tensor:
+    """
+    2値分類の出力から0か1の予測を求める
+    """
+    return (outputs.detach().reshape(outputs.size(0), -1)[:, 0] >= DECIDE_THRESHOLD).long()
+
+
+def predict_siamese(distances: Tensor) -> Tensor:
+    """
+    Siameseネットワークの2つの出力の距離から、同じクラスなら0、違うクラスなら1の予測を求める
+    """
+    return (distances.detach() >= DECIDE_THRESHOLD).long()
+
+
+def count_threshold_correct(predicted: Tensor, teachers: Tensor) -> Tensor:
+    """
+    教師データと予測がどちらも閾値未満、もしくはどちらも閾値を超えているデータ数を数える
+    教師データが2次元の場合は先頭の列を使う
+    """
+    use_teachers = teachers.detach().reshape(teachers.size(0), -1)[:, 0]
+    use_predicted = predicted.reshape(predicted.size(0))
+    is_negative = (use_teachers < DECIDE_THRESHOLD) & (use_predicted < DECIDE_THRESHOLD)
+    is_positive = (use_teachers > DECIDE_THRESHOLD) & (use_predicted > DECIDE_THRESHOLD)
+    return (is_negative | is_positive).sum()
+
+
+def count_class_correct(predicted: Tensor, teachers: Tensor) -> Tensor:
+    return (predicted == teachers.detach()).sum()
+
+
+def count_top_k_correct(outputs: Tensor, teachers: Tensor, k: int = 5) -> Tensor:
+    """
+    出力の上位k個のクラスに正解が含まれるデータ数を数える
+    """
+    use_k = min(k, outputs.size(1))
+    _, top_indices = torch.topk(outputs.detach(), use_k, 1)
+    return (top_indices == teachers.detach().reshape(-1, 1)).any(1).sum()
+
+
+def calc_rate(correct_num: Tensor, total_num: int) -> Tensor:
+    """
+    正答数を正答率にする 結果はデバイス上のテンソルのまま返す
+    """
+    return correct_num.float() / max(total_num, 1)
+
+
+def update_confusion_matrix(confusion_matrix: Tensor, predicted: Tensor, teachers: Tensor) -> Tensor:
+    """
+    混同行列にバッチの結果を加算する
+    :param confusion_matrix: 行が正解、列が予測のクラス数×クラス数の行列
+    :param predicted: 予測したクラスのインデックス
+    :param teachers: 正解のクラスのインデックス
+    :return: 加算した混同行列
+    """
+    class_num = confusion_matrix.size(0)
+    flat_indices = teachers.detach().reshape(-1).long() * class_num + predicted.reshape(-1).long()
+    counts = torch.bincount(flat_indices, minlength=class_num * class_num)
+    return confusion_matrix.add_(counts.reshape(class_num, class_num).to(confusion_matrix.dtype))
+
+
+def materialize_rows(rows: List[list]) -> List[list]:
+    """
+    テンソルとfloatが混ざった行のリストをfloatの行のリストにする
+    テンソルはまとめて1回でホストに転送するので、同期は1回で済む
+    """
+    tensors = [value.detach().float().reshape(()) for row in rows for value in row if isinstance(value, Tensor)]
+    host_values = iter(torch.stack(tensors).cpu().tolist() if len(tensors) > 0 else [])
+    return [[next(host_values) if isinstance(value, Tensor) else value for value in row] for row in rows]
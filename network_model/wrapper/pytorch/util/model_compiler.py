@@ -0,0 +1,99 @@
+import os
+from typing import Optional
+import torch
+
+
+def build_compile_errors() -> tuple:
+    """
+    torch.compileのコンパイル時に起きる例外の型 torch._dynamoがないtorchでは空
+    """
+    try:
+        import torch._dynamo.exc
+        return torch._dynamo.exc.TorchDynamoException,
+    except (ImportError, AttributeError):
+        return ()
+
+
+class CompiledModel(object):
+    """
+    コンパイルしたモデルで順伝播し、コンパイルに失敗した場合は以降コンパイル前のモデルで順伝播する
+    モデルの誤りやメモリ不足などコンパイル以外の例外はそのまま送出する
+    パラメータはコンパイル前のモデルと共有しているので、保存や読み込みはコンパイル前のモデルに対して行う
+    """
+
+    def __init__(self, model: torch.nn.Module, compiled_model=None):
+        self.__model = model
+        self.__compiled_model = compiled_model
+        self.__compile_errors = build_compile_errors() if compiled_model is not None else ()
+
+    @property
+    def model(self) -> torch.nn.Module:
+        return self.__model
+
+    @property
+    def is_compiled(self) -> bool:
+        return self.__compiled_model is not None
+
+    def __call__(self, *args, **kwargs):
+        if self.__compiled_model is None:
+            return self.__model(*args, **kwargs)
+        try:
+            return self.__compiled_model(*args, **kwargs)
+        except self.__compile_errors as e:
+            print("failed to compile model, fall back to eager mode:", e)
+            self.__compiled_model = None
+            return self.__model(*args, **kwargs)
+
+
+class ModelCompiler(object):
+    """
+    torch.compileでモデルをコンパイルする
+    対応していない演算はグラフを分けてeagerで実行し、コンパイル自体に失敗した場合はeagerで実行する
+    コンパイル結果はcache_dirにキャッシュするので、交差検証の2つ目以降の分割や再実行では再コンパイルが速くなる
+    torch.compileはtorch 2.0で追加されたので、それより前のtorchでは指定しても常にeagerで実行する
+    """
+
+    def __init__(self,
+                 mode: str = "default",
+                 backend: str = "inductor",
+                 cache_dir: Optional[str] = None):
+        """
+
+        :param mode: torch.compileのmode default, reduce-overhead, max-autotuneのいずれか
+        :param backend: torch.compileのbackend
+        :param cache_dir: コンパイル結果のキャッシュを保存するディレクトリ 指定しなければtorchの既定の場所に保存する
+        """
+        self.__mode = mode
+        self.__backend = backend
+        self.__cache_dir = cache_dir
+        self.__is_configured = False
+
+    @property
+    def mode(self) -> str:
+        return self.__mode
+
+    def configure(self):
+        if self.__is_configured:
+            return
+        self.__is_configured = True
+        if self.__cache_dir is not None:
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = self.__cache_dir
+        try:
+            import torch._dynamo
+            import torch._inductor.config
+            torch._dynamo.config.suppress_errors = True
+            torch._inductor.config.fx_graph_cache = True
+        except (ImportError, AttributeError) as e:
+            print("skip configuring torch.compile:", e)
+
+    def compile(self, model: torch.nn.Module) -> CompiledModel:
+        if hasattr(torch, "compile") is False:
+            print("compile_mode needs torch>=2.0 for torch.compile, but torch", torch.__version__,
+                  "is installed, run in eager mode")
+            return CompiledModel(model)
+        self.configure()
+        try:
+            return CompiledModel(model, torch.compile(model, mode=self.__mode, backend=self.__backend))
+        except Exception as e:
+            print("failed to compile model, run in eager mode:", e)
+            return CompiledModel(model)
@@ -0,0 +1,83 @@
+from typing import Dict
+from typing import Tuple
+import numpy as np
+import torch
+
+
+class TensorStager(object):
+    """
+    numpyのバッチを確保済みのテンソルに書き込んでデバイスに送る
+    GPUの場合はピン留めしたホスト側のテンソルを経由してnon_blockingでコピーし、
+    バッチの形状と型の組み合わせごとにテンソルを使い回すので、ステップごとにテンソルを確保し直さない
+    返したテンソルは次に同じ名前と形状のバッチを送ったときに上書きされる
+    ホスト側のテンソルは、前のバッチのコピーが終わったことをCUDAのイベントで確かめてから上書きする
+    """
+
+    def __init__(self, torch_device, memory_format=torch.contiguous_format):
+        """
+
+        :param torch_device: 送り先のデバイス
+        :param memory_format: 4次元の入力に使うメモリ配置 torch.channels_lastなど
+        """
+        self.__torch_device = torch.device(torch_device)
+        self.__memory_format = memory_format
+        self.__host_buffers = {}
+        self.__device_buffers = {}
+        self.__copy_events = {}
+
+    @property
+    def memory_format(self):
+        return self.__memory_format
+
+    def set_memory_format(self, memory_format):
+        self.__memory_format = memory_format
+        self.__device_buffers = {}
+
+    def use_memory_format(self, tensor: torch.Tensor):
+        return self.__memory_format if tensor.dim() == 4 else torch.contiguous_format
+
+    def get_buffer(self, buffers: Dict[Tuple, torch.Tensor], key: Tuple, build_buffer) -> torch.Tensor:
+        buffer = buffers.get(key)
+        if buffer is None:
+            buffer = build_buffer()
+            buffers[key] = buffer
+        return buffer
+
+    def to_device(self, name: str, param: np.ndarray, dtype) -> torch.Tensor:
+        """
+        バッチをデバイスに送る
+        :param name: 使い回すテンソルを区別する名前 xとyなど
+        :param param: 送るバッチ
+        :param dtype: 送り先での型
+        :return: デバイス上のテンソル
+        """
+        source = torch.from_numpy(param)
+        memory_format = self.use_memory_format(source)
+        key = (name, tuple(source.shape), source.dtype, dtype)
+        if self.__torch_device.type != "cuda":
+            if source.dtype == dtype and memory_format == torch.contiguous_format:
+                return source
+            buffer = self.get_buffer(self.__device_buffers,
+                                     key,
+                                     lambda: torch.empty(source.shape, dtype=dtype, memory_format=memory_format))
+            return buffer.copy_(source)
+        host_buffer = self.get_buffer(self.__host_buffers,
+                                      key,
+                                      lambda: torch.empty(source.shape, dtype=source.dtype).pin_memory())
+        copy_event = self.__copy_events.get(key)
+        if copy_event is None:
+            copy_event = torch.cuda.Event()
+            self.__copy_events[key] = copy_event
+        else:
+            # 前のバッチのnon_blockingなコピーが読み終わる前にホスト側を上書きしないよう待つ
+            copy_event.synchronize()
+        host_buffer.copy_(source)
+        device_buffer = self.get_buffer(self.__device_buffers,
+                                        key,
+                                        lambda: torch.empty(source.shape,
+                                                            dtype=dtype,
+                                                            device=self.__torch_device,
+                                                            memory_format=memory_format))
+        device_buffer.copy_(host_buffer, non_blocking=True)
+        copy_event.record()
+        return device_buffer
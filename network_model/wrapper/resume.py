@@ -0,0 +1,180 @@
+import os
+import json
+import pickle
+from time import monotonic
+from typing import Callable
+from typing import List
+from typing import Optional
+from network_model.wrapper.callbacks import Callback
+from network_model.wrapper.sequence import Sequence
+
+RESUME_CALLBACK_ATTRIBUTES = ("best", "wait", "stopped_epoch", "epochs_since_last_save")
+
+
+def atomic_write(file_path: str, write: Callable[[str], None]):
+    """
+    一時ファイルに書き込んでから置き換える
+    書き込み中に中断されても前回の内容が壊れない
+    :param file_path: 書き込み先のパス
+    :param write: 渡されたパスに書き込む関数
+    """
+    dir_path = os.path.dirname(file_path)
+    if dir_path != "" and os.path.exists(dir_path) is False:
+        os.makedirs(dir_path)
+    temp_path = file_path + ".%d.tmp" % os.getpid()
+    write(temp_path)
+    os.replace(temp_path, file_path)
+
+
+def write_pickle(file_path: str, state: dict):
+    with open(file_path, "wb") as fw:
+        pickle.dump(state, fw)
+
+
+def read_pickle(file_path: str) -> dict:
+    with open(file_path, "rb") as fr:
+        return pickle.load(fr)
+
+
+def build_callback_states(callbacks: Optional[list]) -> List[dict]:
+    if callbacks is None:
+        return []
+    return [{name: getattr(callback, name) for name in RESUME_CALLBACK_ATTRIBUTES if hasattr(callback, name)}
+            for callback in callbacks]
+
+
+def restore_callback_states(callbacks: Optional[list], states: List[dict]):
+    if callbacks is None or len(callbacks) != len(states):
+        print("skip restoring callback states")
+        return
+    for callback, state in zip(callbacks, states):
+        for name, value in state.items():
+            setattr(callback, name, value)
+
+
+def build_history_state(history) -> Optional[dict]:
+    if history is None:
+        return None
+    return {"epoch": list(getattr(history, "epoch", [])), "history": dict(getattr(history, "history", {}))}
+
+
+def restore_history_state(history, state: Optional[dict]):
+    if history is None or state is None:
+        return
+    history.epoch = state["epoch"]
+    history.history = state["history"]
+
+
+class ResumeCheckpointer(object):
+    """
+    中断した学習を再開するための状態を定期的に保存する
+    """
+
+    def __init__(self,
+                 checkpoint_dir: str,
+                 every_steps: int = 0,
+                 every_minutes: float = 0.,
+                 write_state: Callable[[str, dict], None] = write_pickle,
+                 read_state: Callable[[str], dict] = read_pickle):
+        """
+
+        :param checkpoint_dir: 状態を保存するディレクトリ
+        :param every_steps: このステップ数ごとに保存する 0ならステップ数では保存しない
+        :param every_minutes: この分数ごとに保存する 0なら時間では保存しない
+        :param write_state: 状態をファイルに書き込む関数
+        :param read_state: ファイルから状態を読み込む関数
+        """
+        self.__checkpoint_dir = checkpoint_dir
+        self.__every_steps = every_steps
+        self.__every_minutes = every_minutes
+        self.__write_state = write_state
+        self.__read_state = read_state
+        self.__steps_from_saved = 0
+        self.__saved_time = monotonic()
+
+    @property
+    def file_path(self) -> str:
+        return os.path.join(self.__checkpoint_dir, "resume_state.pkl")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.file_path)
+
+    def count_step(self) -> bool:
+        """
+        1ステップ進めて、保存するタイミングかどうかを返す
+        """
+        self.__steps_from_saved += 1
+        if 0 < self.__every_steps <= self.__steps_from_saved:
+            return True
+        return 0 < self.__every_minutes and self.__every_minutes * 60 <= monotonic() - self.__saved_time
+
+    def save(self, state: dict):
+        atomic_write(self.file_path, lambda file_path: self.__write_state(file_path, state))
+        self.__steps_from_saved = 0
+        self.__saved_time = monotonic()
+        print("saved resume state", self.file_path, "epoch", state.get("epoch"), "step", state.get("steps_done"))
+
+    def load(self) -> dict:
+        print("load resume state", self.file_path)
+        return self.__read_state(self.file_path)
+
+
+class RemainingSequence(Sequence):
+    """
+    中断したエポックの残りのバッチだけを返すSequence
+    並び順は元のSequenceのものをそのまま使い、エポック終了時の並び替えは呼び出し側で行う
+    """
+
+    def __init__(self, sequence, offset: int):
+        self.__sequence = sequence
+        self.__offset = offset
+
+    def __getitem__(self, idx):
+        return self.__sequence[idx + self.__offset]
+
+    def __len__(self):
+        return len(self.__sequence) - self.__offset
+
+    def on_epoch_end(self):
+        pass
+
+
+class ResumeCallback(Callback):
+    """
+    kerasのfitで学習する場合にエポックの終わりごとに再開用の状態を保存する
+    """
+
+    def __init__(self, save_state: Callable[[int], None]):
+        """
+
+        :param save_state: 次に始めるエポック数を受け取って状態を保存する関数
+        """
+        super(ResumeCallback, self).__init__()
+        self.__save_state = save_state
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.__save_state(epoch + 1)
+
+
+class FoldProgress(object):
+    """
+    交差検証でどの分割まで学習し終えたかを記録する
+    """
+
+    def __init__(self, file_path: str):
+        self.__file_path = file_path
+        self.__finished = []
+        if os.path.exists(file_path):
+            with open(file_path, "r", encoding="utf8") as fr:
+                self.__finished = json.load(fr)
+
+    def is_finished(self, fold_name: str) -> bool:
+        return fold_name in self.__finished
+
+    def finish(self, fold_name: str):
+        self.__finished.append(fold_name)
+
+        def write(file_path: str):
+            with open(file_path, "w", encoding="utf8") as fw:
+                json.dump(self.__finished, fw, ensure_ascii=False)
+        atomic_write(self.__file_path, write)
@@ -0,0 +1,29 @@
+from abc import ABC, abstractmethod
+
+
+class Sequence(ABC):
+    """
+    kerasに依存しないSequenceの基底クラス kerasのSequenceと同じく__getitem__でi番目のバッチを返す
+    """
+
+    @abstractmethod
+    def __getitem__(self, index):
+        pass
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    def on_epoch_end(self):
+        pass
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def is_sequence(data) -> bool:
+    """
+    kerasのSequenceとこのモジュールのSequenceのどちらも、バッチ単位で読み込めるデータとして扱う
+    """
+    return hasattr(data, "__getitem__") and hasattr(data, "__len__") and hasattr(data, "on_epoch_end")
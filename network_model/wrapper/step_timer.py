@@ -0,0 +1,156 @@
+import json
+import os
+from time import perf_counter
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+
+
+class StepTimer(object):
+    """
+    独自のエポックループの1ステップごとの処理時間を計測する
+    lapを呼ぶたびに前回のlapからの経過時間を指定した区間に加算していくので、
+    計測したい処理の直後にlapを挟むだけで内訳を記録できる
+    1ステップはend_batchから次のend_batchまでとするので、on_batch_endのコールバックは次のステップに計上される
+    無効な場合は何も記録しない
+    """
+
+    def __init__(self,
+                 enabled: bool = False,
+                 synchronize: Optional[Callable[[], None]] = None,
+                 log_path: Optional[str] = None):
+        """
+
+        :param enabled: Trueなら計測する
+        :param synchronize: 区間を区切る前に呼ぶ関数 GPUの非同期実行を待つ場合に渡す
+        :param log_path: エポックごとの集計結果を書き出すjsonファイルのパス 指定しなければ書き出さない
+        """
+        self.__enabled = enabled
+        self.__synchronize = synchronize
+        self.__log_path = log_path
+        self.__last_time = perf_counter()
+        self.__batch_start_time = self.__last_time
+        self.__batch_times = {}
+        self.__batch_size = 0
+        self.__epoch_totals = {}
+        self.__epoch_extra_times = {}
+        self.__epoch_step_num = 0
+        self.__epoch_sample_num = 0
+        self.__epoch_seconds = 0.
+        self.__epoch_summaries = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.__enabled
+
+    @property
+    def epoch_summaries(self) -> List[Dict[str, float]]:
+        return self.__epoch_summaries
+
+    def start_epoch(self):
+        if self.__enabled is False:
+            return
+        self.__batch_times = {}
+        self.__batch_start_time = perf_counter()
+        self.__last_time = self.__batch_start_time
+
+    def set_batch_size(self, batch_size: int):
+        self.__batch_size = batch_size
+
+    def add_epoch_time(self, name: str, seconds: float):
+        """
+        検証などエポック単位で行う処理の時間を記録する
+        """
+        if self.__enabled is False:
+            return
+        self.__epoch_extra_times[name] = self.__epoch_extra_times.get(name, 0.) + seconds
+
+    def add(self, name: str, seconds: float):
+        if self.__enabled is False:
+            return
+        self.__batch_times[name] = self.__batch_times.get(name, 0.) + seconds
+
+    def lap(self, name: str, will_synchronize: bool = False, included_times: Optional[Dict[str, float]] = None):
+        """
+        前回のlapからの経過時間を区間nameに加算する
+        :param name: 区間名
+        :param will_synchronize: Trueならsynchronizeを呼んでから計測する
+        :param included_times: 経過時間に含まれる内訳の区間名と時間 その分は区間nameから除いてそれぞれの区間に加算する
+        """
+        if self.__enabled is False:
+            return
+        if will_synchronize and self.__synchronize is not None:
+            self.__synchronize()
+        now = perf_counter()
+        elapsed = now - self.__last_time
+        for included_name, seconds in (included_times or {}).items():
+            self.add(included_name, seconds)
+            elapsed -= seconds
+        self.add(name, max(elapsed, 0.))
+        self.__last_time = now
+
+    def end_batch(self, batch_logs: Optional[dict] = None) -> Optional[dict]:
+        """
+        1ステップ分の計測を終えてbatch_logsに書き込む
+        :param batch_logs: 書き込み先
+        :return: 書き込んだbatch_logs
+        """
+        if self.__enabled is False:
+            return batch_logs
+        now = perf_counter()
+        self.add("other", now - self.__last_time)
+        step_seconds = now - self.__batch_start_time
+        batch_times = self.__batch_times
+        for name, seconds in batch_times.items():
+            self.__epoch_totals[name] = self.__epoch_totals.get(name, 0.) + seconds
+        self.__epoch_step_num += 1
+        self.__epoch_sample_num += self.__batch_size
+        self.__epoch_seconds += step_seconds
+        self.__batch_times = {}
+        self.__batch_start_time = now
+        self.__last_time = now
+        if batch_logs is None:
+            return batch_logs
+        for name, seconds in batch_times.items():
+            batch_logs["time_" + name] = seconds
+        batch_logs["time_step"] = step_seconds
+        batch_logs["images_per_sec"] = self.__batch_size / step_seconds if step_seconds > 0 else 0.
+        return batch_logs
+
+    def end_epoch(self, epoch: int, epoch_logs: Optional[dict] = None) -> Optional[dict]:
+        """
+        1エポック分の集計結果をepoch_logsに書き込み、jsonに書き出す
+        epoch_logsに入れておけばTensorBoardのコールバックがそのまま記録する
+        :param epoch: エポック数
+        :param epoch_logs: 書き込み先
+        :return: 書き込んだepoch_logs
+        """
+        if self.__enabled is False:
+            return epoch_logs
+        step_num = max(self.__epoch_step_num, 1)
+        summary = {"time_" + name + "_per_step": seconds / step_num for name, seconds in self.__epoch_totals.items()}
+        summary["time_step_per_step"] = self.__epoch_seconds / step_num
+        summary["images_per_sec"] = self.__epoch_sample_num / self.__epoch_seconds if self.__epoch_seconds > 0 else 0.
+        summary["input_bound_rate"] = self.__epoch_totals.get("data_wait", 0.) / self.__epoch_seconds \
+            if self.__epoch_seconds > 0 else 0.
+        summary.update({"time_" + name: seconds for name, seconds in self.__epoch_extra_times.items()})
+        if epoch_logs is not None:
+            epoch_logs.update({"epoch_" + name: value for name, value in summary.items()})
+        self.__epoch_summaries.append(dict(summary, epoch=epoch, steps=self.__epoch_step_num))
+        self.__epoch_totals = {}
+        self.__epoch_extra_times = {}
+        self.__epoch_step_num = 0
+        self.__epoch_sample_num = 0
+        self.__epoch_seconds = 0.
+        self.write_json()
+        return epoch_logs
+
+    def write_json(self):
+        if self.__log_path is None:
+            return
+        dir_path = os.path.dirname(self.__log_path)
+        if dir_path != "" and os.path.exists(dir_path) is False:
+            os.makedirs(dir_path)
+        with open(self.__log_path, "w") as fw:
+            json.dump(self.__epoch_summaries, fw, indent=2)
@@ -0,0 +1,53 @@
+from network_model.wrapper.sequence import Sequence
+import numpy as np
+
+
+class StratifiedSubsetSequence(Sequence):
+    """
+    flow_from_directoryで作った検証データからクラスの比率を保ったまま一部だけを取り出すSequence
+    取り出すデータはseedで固定するので、毎回同じデータで検証する
+    """
+
+    def __init__(self, sequence, subset_size: int, seed: int = 0):
+        """
+
+        :param sequence: 元の検証データ classesと_get_batches_of_transformed_samplesを持つもの
+        :param subset_size: 取り出すデータ数
+        :param seed: 取り出すデータを決める乱数のシード
+        """
+        self.__sequence = sequence
+        self.__batch_size = sequence.batch_size
+        self.__index_array = self.build_index_array(np.asarray(sequence.classes), subset_size, seed)
+
+    @staticmethod
+    def can_build(sequence) -> bool:
+        return hasattr(sequence, "classes") and hasattr(sequence, "_get_batches_of_transformed_samples")
+
+    @staticmethod
+    def build_index_array(classes: np.ndarray, subset_size: int, seed: int) -> np.ndarray:
+        """
+        各クラスのデータ数に比例した数ずつ、クラスごとに重複なく選ぶ
+        :param classes: 各データのクラス
+        :param subset_size: 選ぶデータ数
+        :param seed: 乱数のシード
+        :return: 選んだデータのインデックス
+        """
+        if subset_size >= len(classes):
+            return np.arange(len(classes))
+        random_state = np.random.RandomState(seed)
+        class_values, class_counts = np.unique(classes, return_counts=True)
+        pick_nums = np.maximum(np.round(class_counts * subset_size / len(classes)).astype(int), 1)
+        pick_nums = np.minimum(pick_nums, class_counts)
+        indices = [random_state.choice(np.flatnonzero(classes == class_value), pick_num, replace=False)
+                   for class_value, pick_num in zip(class_values, pick_nums)]
+        return np.sort(np.concatenate(indices))
+
+    def __len__(self):
+        return (len(self.__index_array) + self.__batch_size - 1) // self.__batch_size
+
+    def __getitem__(self, idx):
+        index_array = self.__index_array[self.__batch_size * idx:self.__batch_size * (idx + 1)]
+        return self.__sequence._get_batches_of_transformed_samples(index_array)
+
+    def on_epoch_end(self):
+        pass
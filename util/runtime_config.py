@@ -0,0 +1,200 @@
+import os
+import sys
+from typing import Dict
+from typing import List
+from typing import Optional
+
+ROLES = ["compute", "decode", "augment"]
+
+
+def get_available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+class RuntimeConfig(object):
+    """
+    モデルの計算、画像の読み込み、前処理、TensorFlowのセッションが使うスレッド数とCPUコアをまとめて決める
+    どれも既定では全コアを使おうとするので、そのまま並行させるとコア数以上のスレッドが奪い合いになる
+    decodeはエンキューのワーカー(画像の読み込みとImageDataGeneratorの変換)、augmentはdata_preprocessを実行するスレッド
+    コアは使用できるコアの先頭から、decode、augment、computeの順に割り当てる
+    """
+
+    def __init__(self,
+                 compute_threads: Optional[int] = None,
+                 interop_threads: Optional[int] = None,
+                 decode_workers: int = 1,
+                 decode_threads: int = 1,
+                 augment_threads: int = 1,
+                 tf_intra_threads: Optional[int] = None,
+                 tf_inter_threads: Optional[int] = None,
+                 will_pin_cores: bool = False):
+        """
+
+        :param compute_threads: torchの演算に使うスレッド数 指定しなければ読み込みと前処理に割り当てた残りのコア数
+        :param interop_threads: torchの演算間の並列に使うスレッド数 指定しなければtorchの既定のまま
+        :param decode_workers: エンキューのワーカー数 自動調整する場合の上限にもなる
+        :param decode_threads: OpenCVが内部で使うスレッド数 ワーカー自体が並列なので既定は1
+        :param augment_threads: data_preprocessを実行するスレッドに割り当てるコア数
+        :param tf_intra_threads: TensorFlowの演算内の並列に使うスレッド数 指定しなければcompute_threadsと同じ
+        :param tf_inter_threads: TensorFlowの演算間の並列に使うスレッド数 指定しなければinterop_threadsと同じ
+        :param will_pin_cores: Trueなら各スレッドを割り当てたコアに固定する
+        """
+        self.__interop_threads = interop_threads
+        self.__decode_workers = max(decode_workers, 1)
+        self.__decode_threads = decode_threads
+        self.__augment_threads = max(augment_threads, 1)
+        self.__will_pin_cores = will_pin_cores
+        self.__core_layout = self.build_core_layout(get_available_cores(), compute_threads)
+        self.__compute_threads = len(self.__core_layout["compute"]) if compute_threads is None else compute_threads
+        self.__tf_intra_threads = self.__compute_threads if tf_intra_threads is None else tf_intra_threads
+        self.__tf_inter_threads = interop_threads if tf_inter_threads is None else tf_inter_threads
+
+    @property
+    def compute_threads(self) -> int:
+        return self.__compute_threads
+
+    @property
+    def interop_threads(self) -> Optional[int]:
+        return self.__interop_threads
+
+    @property
+    def decode_workers(self) -> int:
+        return self.__decode_workers
+
+    @property
+    def decode_threads(self) -> int:
+        return self.__decode_threads
+
+    @property
+    def augment_threads(self) -> int:
+        return self.__augment_threads
+
+    @property
+    def will_pin_cores(self) -> bool:
+        return self.__will_pin_cores
+
+    @property
+    def core_layout(self) -> Dict[str, List[int]]:
+        return self.__core_layout
+
+    def build_core_layout(self, cores: List[int], compute_threads: Optional[int]) -> Dict[str, List[int]]:
+        """
+        使用できるコアを役割ごとに分ける コアが足りない場合は先頭に戻って他の役割と共有する
+        """
+        loader_num = self.__decode_workers + self.__augment_threads
+        compute_num = max(len(cores) - loader_num, 1) if compute_threads is None else max(compute_threads, 1)
+
+        def pick(start: int, num: int) -> List[int]:
+            return sorted({cores[(start + index) % len(cores)] for index in range(num)})
+        return {"decode": pick(0, self.__decode_workers),
+                "augment": pick(self.__decode_workers, self.__augment_threads),
+                "compute": pick(loader_num, compute_num)}
+
+    def pin_current_thread(self, role: str):
+        """
+        呼び出したスレッドをroleに割り当てたコアに固定する 既に固定されている場合は何もしない
+        """
+        if self.__will_pin_cores is False or hasattr(os, "sched_setaffinity") is False:
+            return
+        cores = self.__core_layout[role]
+        # Linuxではpid 0を指定すると呼び出したスレッドだけが対象になる
+        if os.sched_getaffinity(0) != set(cores):
+            os.sched_setaffinity(0, cores)
+
+    def apply_torch(self):
+        try:
+            import torch
+        except ImportError:
+            return
+        if torch.get_num_threads() != self.__compute_threads:
+            torch.set_num_threads(self.__compute_threads)
+        if self.__interop_threads is None or torch.get_num_interop_threads() == self.__interop_threads:
+            return
+        try:
+            torch.set_num_interop_threads(self.__interop_threads)
+        except RuntimeError as e:
+            # 一度でも並列の演算を実行した後は変更できない
+            print("skip setting torch interop threads:", e)
+
+    def apply_opencv(self):
+        try:
+            import cv2
+        except ImportError:
+            return
+        cv2.setNumThreads(self.__decode_threads)
+
+    def apply_tensorflow(self):
+        """
+        TensorFlowのスレッド数を設定する
+        セッションを作るとGPUのメモリを確保するので、kerasを読み込んでいない場合は何もしない
+        """
+        if "keras" not in sys.modules:
+            return
+        try:
+            from keras import backend as K
+            if K.backend() != "tensorflow":
+                return
+            import tensorflow as tf
+        except ImportError:
+            return
+        if hasattr(tf, "ConfigProto") and hasattr(K, "set_session"):
+            config = tf.ConfigProto(intra_op_parallelism_threads=self.__tf_intra_threads,
+                                    inter_op_parallelism_threads=self.__tf_inter_threads or 0)
+            K.set_session(tf.Session(config=config))
+            return
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(self.__tf_intra_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(self.__tf_inter_threads or 0)
+        except RuntimeError as e:
+            # セッションの初期化後は変更できない
+            print("skip setting tensorflow threads:", e)
+
+    def apply(self, will_use_tensorflow: bool = True):
+        """
+        各ライブラリのスレッド数を設定し、呼び出したスレッドを計算用のコアに固定する
+        後から起動するプロセスも同じスレッド数になるよう、環境変数も設定する
+        :param will_use_tensorflow: Falseなら、Pytorchのモデルを学習する場合など、TensorFlowの設定をしない
+        """
+        os.environ["OMP_NUM_THREADS"] = str(self.__compute_threads)
+        os.environ["MKL_NUM_THREADS"] = str(self.__compute_threads)
+        self.apply_torch()
+        self.apply_opencv()
+        if will_use_tensorflow:
+            self.apply_tensorflow()
+        self.pin_current_thread("compute")
+        self.print_layout()
+        return self
+
+    def print_layout(self):
+        print("runtime layout:",
+              "compute threads", self.__compute_threads,
+              "interop threads", self.__interop_threads,
+              "decode workers", self.__decode_workers,
+              "opencv threads", self.__decode_threads,
+              "augment threads", self.__augment_threads,
+              "tf intra/inter threads", self.__tf_intra_threads, self.__tf_inter_threads)
+        if self.__will_pin_cores:
+            print("runtime cores:", ", ".join(role + " " + str(self.__core_layout[role]) for role in ROLES))
+
+
+_runtime_config = None
+
+
+def set_runtime_config(runtime_config: RuntimeConfig, will_use_tensorflow: bool = True) -> RuntimeConfig:
+    """
+    プロセス全体の設定としてruntime_configを適用する
+    :param runtime_config:
+    :param will_use_tensorflow: Falseなら、TensorFlowの設定をしない
+    """
+    global _runtime_config
+    _runtime_config = runtime_config.apply(will_use_tensorflow)
+    return _runtime_config
+
+
+def get_runtime_config() -> Optional[RuntimeConfig]:
+    """
+    set_runtime_configで適用した設定 適用していなければNone
+    """
+    return _runtime_config
@@ -4,3 +4,6 @@ from collections import namedtuple
 GanPair = namedtuple("GanPair", ("builder", "discriminator"))
 
 CycleInput = Tuple[GanPair, GanPair]
+
+# Siameseネットワークの入力 dataは1度だけ埋め込むバッチ、pair_indexは組にするデータのインデックスの2行の配列
+SiameseIndexedInput = namedtuple("SiameseIndexedInput", ("data", "pair_index"))